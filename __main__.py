@@ -1,9 +1,138 @@
-"""Guraffic Park 3D Scene. Run with `python .` or `python main_scene.py`.s
+"""Guraffic Park 3D Scene. Run with `python .` or `python main_scene.py`.
+
+Pass `--headless --frames N` to render N frames offscreen, without a window, e.g. on a server.
 """
 
-from main_scene import MainScene
+import argparse
 
 if __name__ == "__main__":
-    scene = MainScene()
+    parser = argparse.ArgumentParser(description="Guraffic Park 3D Scene")
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="render offscreen with EGL (or OSMesa if PYOPENGL_PLATFORM=osmesa)",
+    )
+    parser.add_argument(
+        "--frames", type=int, default=None, help="number of frames to render"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record a CPU trace and save it as Chrome trace JSON on exit",
+    )
+    parser.add_argument(
+        "--capture-spikes",
+        metavar="DIRECTORY",
+        help="save traces of frames much slower than the median to this directory",
+    )
+    parser.add_argument(
+        "--collect-in-slack",
+        action="store_true",
+        help="freeze startup objects and only collect garbage at the end of fast frames",
+    )
+    parser.add_argument(
+        "--telemetry",
+        metavar="FILE",
+        help="periodically export frame time histograms to a .csv, .json or .prom file",
+    )
+    parser.add_argument(
+        "--telemetry-interval",
+        type=float,
+        default=60.0,
+        help="seconds between telemetry exports (default 60)",
+    )
+    parser.add_argument(
+        "--texture-format",
+        default="rgba8",
+        choices=["none", "rgba8", "bc1", "bc3", "bc7", "etc2"],
+        help="process textures into mipmaps in this format, none uploads them as they are",
+    )
+    parser.add_argument(
+        "--mip-filter",
+        default="kaiser",
+        choices=["box", "kaiser"],
+        help="filter used to downsample mipmaps (default kaiser)",
+    )
+    parser.add_argument(
+        "--texture-arrays",
+        action="store_true",
+        help="pack each model's textures into one texture array as it's loaded",
+    )
+    parser.add_argument(
+        "--stream-city",
+        action="store_true",
+        help="split the city into cells and only load the cells near the camera",
+    )
+    parser.add_argument(
+        "--no-mesh-optimisation",
+        action="store_true",
+        help="keep the triangle and vertex order of models as they are in the files",
+    )
+    parser.add_argument(
+        "--no-lods",
+        action="store_true",
+        help="don't generate simplified levels of detail for meshes as they're loaded",
+    )
+    parser.add_argument(
+        "--occlusion-culling",
+        action="store_true",
+        help="skip drawing meshes hidden behind others, found with occlusion queries",
+    )
+    parser.add_argument(
+        "--gpu-driven",
+        action="store_true",
+        help="cull and draw the static models on the GPU with multi-draw indirect",
+    )
+    parser.add_argument(
+        "--command-lists",
+        action="store_true",
+        help="record the draws of the static models once and replay them each frame",
+    )
+    args = parser.parse_args()
+
+    if args.headless:
+        # Has to happen before anything imports OpenGL
+        from offscreen import use_offscreen_platform
+
+        use_offscreen_platform()
+
+    from main_scene import MainScene
+    from mesh import Mesh
+    from streaming import StreamedModel
+    from texture import Texture
+    from texture_array import TextureArray
+    from tracing import Tracer
+
+    Tracer.current_tracer.enabled = args.trace is not None
+    Texture.processing_format = (
+        None if args.texture_format == "none" else args.texture_format
+    )
+    Texture.mip_filter = args.mip_filter
+    TextureArray.pack_materials = args.texture_arrays
+    Mesh.optimise_on_import = not args.no_mesh_optimisation
+    StreamedModel.enabled = args.stream_city
+    Mesh.generate_lods_on_import = not args.no_lods
+
+    scene = MainScene(headless=args.headless)
+    scene.occlusion.enabled = args.occlusion_culling
+    scene.indirect.enabled = args.gpu_driven
+    scene.command_lists.enabled = args.command_lists
+
+    if args.capture_spikes is not None:
+        scene.spike_detector.directory = args.capture_spikes
+        scene.spike_detector.set_enabled(True)
+
+    # After loading, so that every startup object is frozen
+    scene.gc_policy.set_enabled(args.collect_in_slack)
+
+    if args.telemetry is not None:
+        scene.telemetry.set_export_path(args.telemetry)
+        scene.telemetry.export_interval = args.telemetry_interval
+
+    scene.start(frames=args.frames)
+
+    if args.telemetry is not None:
+        scene.telemetry.end_interval()
 
-    scene.start()
+    if args.trace is not None:
+        Tracer.current_tracer.export_chrome_trace(args.trace)
@@ -0,0 +1,330 @@
+"""Per-frame memory allocation telemetry and garbage collection scheduling.
+
+`AllocationTracker` measures the memory allocated inside named scopes (each frame phase by default)
+with `tracemalloc`, so temporaries created every frame can be found and budgeted.
+`GarbageCollectionPolicy` stops Python's cyclic garbage collector from running at random points
+in a frame, and runs it at the end of frames that finished early instead.
+"""
+
+import gc
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Self
+
+import imgui
+
+
+class AllocationStats:
+    """Memory allocated inside a scope, summed over every time it ran in a frame."""
+
+    __slots__ = ("blocks", "calls", "peak_bytes", "retained_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        # Most memory in use at once above what was in use when the scope started,
+        # i.e. how much the scope's temporaries cost
+        self.peak_bytes = 0
+        # Memory still in use when the scope ended
+        self.retained_bytes = 0
+        # Change in the number of memory blocks Python has allocated
+        self.blocks = 0
+
+
+class TrackedScope:
+    __slots__ = ("name", "peak", "start_blocks", "start_bytes")
+
+    def __init__(self, name: str, start_bytes: int, start_blocks: int):
+        self.name = name
+        self.start_bytes = start_bytes
+        self.peak = start_bytes
+        self.start_blocks = start_blocks
+
+
+class AllocationTracker:
+    """Records the memory allocated in named scopes each frame.
+
+    Scopes can be nested. `tracemalloc` is process wide, so scopes running at the same time on
+    other threads, e.g. the pipelined simulation, are counted in each other's peaks.
+    """
+
+    current_tracker: Self = None  # type: ignore
+
+    def __init__(self):
+        self.enabled = False
+        self.started_tracemalloc = False
+
+        # Stats of each scope in the frame being recorded, and the last complete frame
+        self.frame: dict[str, AllocationStats] = {}
+        self.last_frame: dict[str, AllocationStats] = {}
+        # Garbage collections of each generation in the last complete frame
+        self.collections = [0, 0, 0]
+        self.last_collections = [0, 0, 0]
+
+        # Most peak bytes allowed in a frame, by scope. Over budget scopes are shown in red.
+        self.budgets: dict[str, int] = {}
+
+        self.local = threading.local()
+
+    def set_enabled(self, enabled: bool):
+        """Start or stop tracking. Tracking slows everything down, so only turn it on when needed."""
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+
+        if enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracemalloc = True
+            gc.callbacks.append(self.on_garbage_collection)
+        else:
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+            gc.callbacks.remove(self.on_garbage_collection)
+            self.frame = {}
+            self.last_frame = {}
+
+    def on_garbage_collection(self, phase: str, info: dict):
+        if phase == "stop":
+            self.collections[info["generation"]] += 1
+
+    @property
+    def stack(self) -> list[TrackedScope]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def enter(self, name: str):
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self.stack
+        if stack:
+            # The peak is about to be reset, so the enclosing scope keeps its peak so far
+            stack[-1].peak = max(stack[-1].peak, peak)
+        tracemalloc.reset_peak()
+        stack.append(TrackedScope(name, current, sys.getallocatedblocks()))
+
+    def exit(self):
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self.stack
+        scope = stack.pop()
+        peak = max(scope.peak, peak)
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+
+        stats = self.frame.get(scope.name)
+        if stats is None:
+            stats = self.frame[scope.name] = AllocationStats()
+        stats.calls += 1
+        stats.peak_bytes = max(stats.peak_bytes, peak - scope.start_bytes)
+        stats.retained_bytes += current - scope.start_bytes
+        stats.blocks += sys.getallocatedblocks() - scope.start_blocks
+
+    @contextmanager
+    def scope(self, name: str):
+        """Track the memory allocated inside the `with` block."""
+        if not self.enabled or not tracemalloc.is_tracing():
+            yield
+            return
+
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.frame = {}
+        self.collections = [0, 0, 0]
+        self.enter("frame")
+
+    def end_frame(self):
+        if not self.enabled or not self.stack:
+            return
+        self.exit()
+        self.last_frame = self.frame
+        self.last_collections = self.collections
+
+    def over_budget(self) -> dict[str, tuple[int, int]]:
+        """Scopes of the last frame that allocated more than their budget.
+
+        Returns:
+            dict[str, tuple[int, int]]: (peak bytes, budget) by scope name
+        """
+        return {
+            name: (self.last_frame[name].peak_bytes, budget)
+            for name, budget in self.budgets.items()
+            if name in self.last_frame and self.last_frame[name].peak_bytes > budget
+        }
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        enabled_changed, enabled = imgui.checkbox("Track allocations", self.enabled)
+        if enabled_changed:
+            self.set_enabled(enabled)
+        if not self.enabled:
+            return
+
+        over_budget = self.over_budget()
+        for name, stats in self.last_frame.items():
+            text = (
+                f"{name}: {stats.peak_bytes / 1024:.1f}KiB peak,"
+                f" {stats.retained_bytes / 1024:+.1f}KiB retained,"
+                f" {stats.blocks:+d} blocks"
+            )
+            if name in over_budget:
+                imgui.text_colored(
+                    f"{text} (budget {self.budgets[name] / 1024:.1f}KiB)", 1.0, 0.3, 0.3
+                )
+            else:
+                imgui.text(text)
+
+        imgui.text(
+            "GC collections: "
+            + ", ".join(
+                f"gen {generation} x{count}"
+                for generation, count in enumerate(self.last_collections)
+            )
+        )
+
+
+AllocationTracker.current_tracker = AllocationTracker()
+
+
+def track_allocations(name: str):
+    """Track the memory allocated inside a `with` block, if allocation tracking is on."""
+    return AllocationTracker.current_tracker.scope(name)
+
+
+@contextmanager
+def allocation_budget(max_bytes: int, max_blocks: int | None = None):
+    """Fail if the code inside the `with` block allocates too much. For use in tests, e.g.
+
+        with allocation_budget(64 * 1024):
+            scene.draw()
+
+    Args:
+        max_bytes (int): Most bytes of temporaries allowed in use at once
+        max_blocks (int, optional): Most memory blocks allowed to be left allocated
+
+    Raises:
+        AssertionError: If the budget was exceeded
+    """
+    tracker = AllocationTracker()
+    tracker.set_enabled(True)
+    tracker.enter("budget")
+    try:
+        yield
+    finally:
+        tracker.exit()
+        stats = tracker.frame["budget"]
+        tracker.set_enabled(False)
+
+    if stats.peak_bytes > max_bytes:
+        raise AssertionError(
+            f"(E) Allocated {stats.peak_bytes} bytes, over the budget of {max_bytes}"
+        )
+    if max_blocks is not None and stats.blocks > max_blocks:
+        raise AssertionError(
+            f"(E) Left {stats.blocks} blocks allocated, over the budget of {max_blocks}"
+        )
+
+
+class GarbageCollectionPolicy:
+    """Runs the cyclic garbage collector only at the end of frames with time to spare.
+
+    When enabled, every object alive at that point (models, textures, shaders, ...) is moved
+    to a permanent generation with `gc.freeze`, so later collections don't keep scanning them.
+    Automatic collection is then turned off, and `collect_in_slack` runs whichever generation
+    is due once a frame has finished, if it is expected to fit in the time left. A collection
+    that keeps being put off is forced eventually, so memory can't grow without bound.
+    """
+
+    def __init__(self, overdue_factor=10):
+        """
+        Args:
+            overdue_factor (int, optional): Force a collection once a generation is this many
+                times over its threshold. Defaults to 10.
+        """
+        self.enabled = False
+        self.overdue_factor = overdue_factor
+        # Running estimate of how long a collection of each generation takes, in seconds
+        self.collection_times = [0.0, 0.0, 0.0]
+        self.collections = [0, 0, 0]
+        self.forced_collections = 0
+        self.frozen_objects = 0
+
+    def set_enabled(self, enabled: bool):
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+
+        if enabled:
+            gc.collect()
+            gc.freeze()
+            self.frozen_objects = gc.get_freeze_count()
+            gc.disable()
+        else:
+            gc.unfreeze()
+            gc.enable()
+
+    def collect_in_slack(self, slack: float):
+        """Run a due garbage collection if it should fit in the time left this frame.
+
+        Args:
+            slack (float): Seconds until the next frame should start
+        """
+        if not self.enabled:
+            return
+
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        due = [
+            generation
+            for generation in range(3)
+            if thresholds[generation] > 0
+            and counts[generation] >= thresholds[generation]
+        ]
+        if not due:
+            return
+
+        # Collecting a generation also collects the younger ones
+        generation = max(due)
+        fits = self.collection_times[generation] <= slack
+        if not fits and counts[0] < thresholds[0] * self.overdue_factor:
+            return
+
+        start = time.perf_counter()
+        gc.collect(generation)
+        elapsed = time.perf_counter() - start
+
+        self.collection_times[generation] = (
+            elapsed
+            if self.collections[generation] == 0
+            else 0.8 * self.collection_times[generation] + 0.2 * elapsed
+        )
+        self.collections[generation] += 1
+        if not fits:
+            self.forced_collections += 1
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        enabled_changed, enabled = imgui.checkbox(
+            "Collect garbage between frames", self.enabled
+        )
+        if enabled_changed:
+            self.set_enabled(enabled)
+        if not self.enabled:
+            return
+
+        imgui.text(f"{self.frozen_objects} startup objects frozen")
+        for generation in range(3):
+            imgui.text(
+                f"Gen {generation}: {self.collections[generation]} collections,"
+                f" ~{self.collection_times[generation] * 1000:.2f}ms"
+            )
+        imgui.text(f"{self.forced_collections} collections didn't fit in a frame")
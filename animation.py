@@ -0,0 +1,427 @@
+"""Keyframe animation. Clips of position, rotation and scale tracks are bound to entities,
+and every bound track in the scene is evaluated together in one batch each tick.
+"""
+
+from typing import Type
+
+import numpy as np
+import quaternion
+from numpy.typing import ArrayLike, NDArray
+
+from entity import Entity
+
+POSITION = "position"
+ROTATION = "rotation"
+SCALE = "scale"
+
+# Number of floats stored per keyframe for each kind of track.
+# Rotations are stored as (w, x, y, z) quaternion components.
+TRACK_WIDTHS = {POSITION: 3, ROTATION: 4, SCALE: 1}
+
+
+def lerp(start: NDArray, end: NDArray, t: NDArray) -> NDArray:
+    """Vectorised linear interpolation between rows of two arrays.
+
+    Args:
+        start (NDArray): (N, M) array of start values
+        end (NDArray): (N, M) array of end values
+        t (NDArray): (N,) array of interpolation parameters in [0, 1]
+
+    Returns:
+        NDArray: (N, M) array of interpolated values
+    """
+    return start + (end - start) * t[:, np.newaxis]
+
+
+def slerp(start: NDArray, end: NDArray, t: NDArray) -> NDArray:
+    """Vectorised spherical linear interpolation between rows of two quaternion arrays.
+    See https://en.wikipedia.org/wiki/Slerp
+
+    Args:
+        start (NDArray): (N, 4) array of unit quaternions as (w, x, y, z)
+        end (NDArray): (N, 4) array of unit quaternions as (w, x, y, z)
+        t (NDArray): (N,) array of interpolation parameters in [0, 1]
+
+    Returns:
+        NDArray: (N, 4) array of interpolated unit quaternions
+    """
+    dot = np.einsum("ij,ij->i", start, end)
+
+    # q and -q are the same rotation, flip one so we always take the shortest path
+    end = np.where(dot[:, np.newaxis] < 0.0, -end, end)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+
+    # Nearly identical rotations would divide by zero, so fall back to a linear blend
+    nearly_parallel = sin_theta < 1e-6
+    sin_theta = np.where(nearly_parallel, 1.0, sin_theta)
+    start_weight = np.where(
+        nearly_parallel, 1.0 - t, np.sin((1.0 - t) * theta) / sin_theta
+    )
+    end_weight = np.where(nearly_parallel, t, np.sin(t * theta) / sin_theta)
+
+    result = start * start_weight[:, np.newaxis] + end * end_weight[:, np.newaxis]
+    return result / np.linalg.norm(result, axis=1, keepdims=True)
+
+
+class Track:
+    """A list of keyframes animating one property (position, rotation or scale) of an entity."""
+
+    def __init__(self, target: str, times: ArrayLike, values: ArrayLike):
+        """Create a new Track.
+
+        Args:
+            target (str): The property to animate. One of `POSITION`, `ROTATION` or `SCALE`.
+            times (ArrayLike): Increasing keyframe times in seconds.
+            values (ArrayLike): One value per keyframe. Rotations may be given as np.quaternion.
+        """
+        if target not in TRACK_WIDTHS:
+            raise ValueError(f"(E) Unknown animation track target {target}")
+
+        self.target = target
+        self.times = np.array(times, dtype=np.float64).reshape(-1)
+
+        if target == ROTATION and np.asarray(values).dtype == np.quaternion:
+            values = quaternion.as_float_array(values)
+
+        self.values = np.array(values, dtype=np.float64).reshape(
+            -1, TRACK_WIDTHS[target]
+        )
+
+        if len(self.times) != len(self.values) or len(self.times) == 0:
+            raise ValueError("(E) A track needs one value for every keyframe time")
+
+        if np.any(np.diff(self.times) < 0):
+            raise ValueError("(E) Keyframe times must be increasing")
+
+        # Every track needs at least two keyframes so there is always a segment to sample
+        if len(self.times) == 1:
+            self.times = np.repeat(self.times, 2)
+            self.values = np.repeat(self.values, 2, axis=0)
+
+
+class AnimationClip:
+    """A named collection of tracks that play together."""
+
+    def __init__(self, name: str, tracks: list[Track], loop=True):
+        """Create a new AnimationClip.
+
+        Args:
+            name (str): The name of the clip
+            tracks (list[Track]): The tracks in the clip. At most one track per target.
+            loop (bool, optional): Whether the clip repeats after its last keyframe. Defaults to True.
+        """
+        self.name = name
+        self.tracks = tracks
+        self.loop = loop
+        self.duration = max(track.times[-1] for track in tracks)
+
+        targets = [track.target for track in tracks]
+        if len(set(targets)) != len(targets):
+            raise ValueError(f"(E) Clip {name} animates the same property twice")
+
+
+class AnimationBinding:
+    """A clip bound to an entity. A lightweight handle into an `AnimationSystem`,
+    the playback state itself is stored in the system's arrays.
+    """
+
+    def __init__(self, system: "AnimationSystem", index: int, clip, entity):
+        self.system = system
+        self.index = index
+        self.clip: AnimationClip = clip
+        self.entity: Type[Entity] = entity
+
+    @property
+    def time(self) -> float:
+        """The playback time of the clip in seconds"""
+        return float(self.system.times[self.index])
+
+    @time.setter
+    def time(self, value: float):
+        self.system.times[self.index] = value
+
+    @property
+    def speed(self) -> float:
+        """Playback speed. Set to 0 to drive `time` manually."""
+        return float(self.system.speeds[self.index])
+
+    @speed.setter
+    def speed(self, value: float):
+        self.system.speeds[self.index] = value
+
+    @property
+    def playing(self) -> bool:
+        return bool(self.system.playing[self.index])
+
+    @playing.setter
+    def playing(self, value: bool):
+        self.system.playing[self.index] = value
+
+
+class _TrackBatch:
+    """Every track of one target kind, flattened into contiguous arrays."""
+
+    def __init__(self, target: str, bindings: list[AnimationBinding]):
+        self.target = target
+
+        tracks = [
+            (binding, track)
+            for binding in bindings
+            for track in binding.clip.tracks
+            if track.target == target
+        ]
+
+        self.size = len(tracks)
+        self.binding_index = np.array(
+            [binding.index for binding, _ in tracks], dtype=np.intp
+        )
+        self.duration = np.array([binding.clip.duration for binding, _ in tracks])
+        self.loop = np.array([binding.clip.loop for binding, _ in tracks], dtype=bool)
+
+        if self.size == 0:
+            return
+
+        # Shift every track into its own disjoint range of time, so that a single
+        # `searchsorted` over the flattened keyframes finds the segment for all tracks at once.
+        span = max(track.times[-1] - track.times[0] for _, track in tracks) + 1.0
+        self.offset = np.arange(self.size) * span
+        self.first_time = np.array([track.times[0] for _, track in tracks])
+        self.last_time = np.array([track.times[-1] for _, track in tracks])
+
+        self.times = np.concatenate([
+            track.times - track.times[0] + offset
+            for (_, track), offset in zip(tracks, self.offset)
+        ])
+        self.values = np.concatenate([track.values for _, track in tracks])
+
+        counts = np.array([len(track.times) for _, track in tracks])
+        self.first_key = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        self.last_segment = self.first_key + counts - 2
+
+    def sample(self, binding_times: NDArray) -> NDArray:
+        """Sample every track in the batch at the playback time of its binding."""
+        time = binding_times[self.binding_index]
+
+        # Wrap looping clips, clamp the others to their duration
+        wrapped = np.mod(time, np.where(self.duration > 0, self.duration, 1.0))
+        time = np.where(self.loop, wrapped, np.clip(time, 0.0, self.duration))
+        time = np.clip(time, self.first_time, self.last_time)
+
+        query = time - self.first_time + self.offset
+        segment = np.searchsorted(self.times, query, side="right") - 1
+        segment = np.clip(segment, self.first_key, self.last_segment)
+
+        segment_start = self.times[segment]
+        segment_length = self.times[segment + 1] - segment_start
+        t = np.divide(
+            query - segment_start,
+            segment_length,
+            out=np.zeros_like(query),
+            where=segment_length > 0,
+        )
+
+        start = self.values[segment]
+        end = self.values[segment + 1]
+
+        if self.target == ROTATION:
+            return slerp(start, end, t)
+        return lerp(start, end, t)
+
+
+class AnimationSystem:
+    """Evaluates every bound animation clip in the scene together.
+    Keyframes are flattened into one array per target kind, so the cost of an update
+    is a handful of numpy operations, regardless of how many entities are animated.
+    """
+
+    def __init__(self):
+        self.bindings: list[AnimationBinding] = []
+        self.times = np.zeros(0)
+        self.speeds = np.zeros(0)
+        self.playing = np.zeros(0, dtype=bool)
+
+        # Times the bindings were last written to their entities, NaN forces a write
+        self.evaluated_times = np.zeros(0)
+        self.batches: list[_TrackBatch] = []
+        self.batches_dirty = False
+
+    def bind(
+        self, clip: AnimationClip, entity: Type[Entity], speed=1.0, time=0.0
+    ) -> AnimationBinding:
+        """Bind an animation clip to an entity and start playing it.
+
+        Args:
+            clip (AnimationClip): The clip to play
+            entity (Entity): The entity the clip animates
+            speed (float, optional): Playback speed, 0 to drive the time manually. Defaults to 1.0.
+            time (float, optional): Initial playback time in seconds. Defaults to 0.0.
+
+        Returns:
+            AnimationBinding: Handle used to control playback.
+        """
+        binding = AnimationBinding(self, len(self.bindings), clip, entity)
+        self.bindings.append(binding)
+
+        self.times = np.append(self.times, time)
+        self.speeds = np.append(self.speeds, speed)
+        self.playing = np.append(self.playing, True)
+        self.evaluated_times = np.append(self.evaluated_times, np.nan)
+        self.batches_dirty = True
+
+        return binding
+
+    def unbind(self, binding: AnimationBinding):
+        """Remove a binding. Its entity keeps its last animated transform."""
+        index = binding.index
+        del self.bindings[index]
+
+        self.times = np.delete(self.times, index)
+        self.speeds = np.delete(self.speeds, index)
+        self.playing = np.delete(self.playing, index)
+        self.evaluated_times = np.delete(self.evaluated_times, index)
+
+        for i, other in enumerate(self.bindings):
+            other.index = i
+        self.batches_dirty = True
+
+    def update(self, delta_time: float):
+        """Advance every playing binding by `delta_time` seconds and write the
+        sampled transforms to the entities whose animation time changed.
+        """
+        if len(self.bindings) == 0:
+            return
+
+        if self.batches_dirty:
+            self.batches = [
+                _TrackBatch(target, self.bindings) for target in TRACK_WIDTHS
+            ]
+            self.batches_dirty = False
+
+        self.times += delta_time * self.speeds * self.playing
+
+        # Only touch entities whose animation moved, setting a transform clears the entity cache
+        changed = self.playing & (self.times != self.evaluated_times)
+        if not np.any(changed):
+            return
+        self.evaluated_times[changed] = self.times[changed]
+
+        updates: dict[int, dict] = {}
+        for batch in self.batches:
+            if batch.size == 0:
+                continue
+
+            active = changed[batch.binding_index]
+            if not np.any(active):
+                continue
+
+            values = batch.sample(self.times)[active]
+            if batch.target == ROTATION:
+                values = quaternion.as_quat_array(values)
+            elif batch.target == SCALE:
+                values = values[:, 0]
+
+            for binding_index, value in zip(batch.binding_index[active], values):
+                updates.setdefault(binding_index, {})[batch.target] = value
+
+        for binding_index, transform in updates.items():
+            self.bindings[binding_index].entity.set_transform(**transform)
+
+
+class TransformInterpolator:
+    """Blends entity transforms between the last two simulation steps for rendering.
+    The simulation runs at a fixed rate, so without this anything moving would stutter
+    whenever the render rate isn't a multiple of the simulation rate.
+    """
+
+    def __init__(self):
+        self.entities: list[Type[Entity]] = []
+        self.previous = self._empty_state()
+        self.current = self._empty_state()
+        self.moving = np.zeros(0, dtype=bool)
+        self.applied = False
+
+    @staticmethod
+    def _empty_state() -> dict[str, NDArray]:
+        return {target: np.zeros((0, width)) for target, width in TRACK_WIDTHS.items()}
+
+    def track(self, entity: Type[Entity]):
+        """Interpolate the transform of `entity` when rendering."""
+        if entity not in self.entities:
+            self.entities.append(entity)
+
+    def untrack(self, entity: Type[Entity]):
+        if entity in self.entities:
+            self.entities.remove(entity)
+
+    def _capture(self) -> dict[str, NDArray]:
+        if len(self.entities) == 0:
+            return self._empty_state()
+
+        return {
+            POSITION: np.array([entity.position for entity in self.entities]),
+            ROTATION: quaternion.as_float_array([
+                entity.rotation for entity in self.entities
+            ]),
+            SCALE: np.array(
+                [entity.scale for entity in self.entities], dtype=np.float64
+            ).reshape(-1, 1),
+        }
+
+    def store_previous(self):
+        """Record the transforms before a simulation step."""
+        self.previous = self._capture()
+
+    def apply(self, alpha: float):
+        """Set every tracked entity to its transform `alpha` of the way between the
+        previous and current simulation steps. Call `restore` before simulating again.
+        """
+        self.current = self._capture()
+        if len(self.entities) == 0 or len(self.previous[POSITION]) != len(
+            self.entities
+        ):
+            return
+
+        # Only entities that moved in the last step need their transform (and cache) touching
+        self.moving = np.zeros(len(self.entities), dtype=bool)
+        for target in TRACK_WIDTHS:
+            self.moving |= np.any(self.previous[target] != self.current[target], axis=1)
+        if not np.any(self.moving):
+            return
+
+        t = np.full(np.count_nonzero(self.moving), alpha)
+        position = lerp(
+            self.previous[POSITION][self.moving], self.current[POSITION][self.moving], t
+        )
+        rotation = quaternion.as_quat_array(
+            slerp(
+                self.previous[ROTATION][self.moving],
+                self.current[ROTATION][self.moving],
+                t,
+            )
+        )
+        scale = lerp(
+            self.previous[SCALE][self.moving], self.current[SCALE][self.moving], t
+        )[:, 0]
+
+        for i, entity_index in enumerate(np.flatnonzero(self.moving)):
+            self.entities[entity_index].set_transform(
+                position=position[i], rotation=rotation[i], scale=float(scale[i])
+            )
+        self.applied = True
+
+    def restore(self):
+        """Put the simulation transforms back after rendering."""
+        if not self.applied:
+            return
+
+        rotation = quaternion.as_quat_array(self.current[ROTATION])
+        for entity_index in np.flatnonzero(self.moving):
+            self.entities[entity_index].set_transform(
+                position=self.current[POSITION][entity_index],
+                rotation=rotation[entity_index],
+                scale=float(self.current[SCALE][entity_index, 0]),
+            )
+        self.applied = False
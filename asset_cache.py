@@ -0,0 +1,57 @@
+"""A disk cache for data derived from assets.
+
+Work done on assets as they're imported (simplified meshes, optimised index buffers, ...) is
+saved under `cache/` as .npz files, keyed by a hash of the inputs and the settings used, so
+it only happens again when either changes.
+"""
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+CACHE_DIRECTORY = "./cache"
+
+
+def content_key(*arrays, **settings) -> str:
+    """Hash of arrays' contents, shapes and types, and any settings that change the result."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.data)
+    digest.update(repr(sorted(settings.items())).encode())
+    return digest.hexdigest()
+
+
+def cache_file(kind: str, key: str) -> str:
+    return os.path.join(CACHE_DIRECTORY, kind, f"{key}.npz")
+
+
+def load_arrays(kind: str, key: str) -> dict[str, np.ndarray] | None:
+    """Load cached arrays, or None if they haven't been saved or can't be read.
+
+    Args:
+        kind (str): What the arrays are, the folder they're saved in, e.g. "lods"
+        key (str): Key from `content_key`
+    """
+    file_name = cache_file(kind, key)
+    if not os.path.exists(file_name):
+        return None
+    try:
+        with np.load(file_name) as arrays:
+            return dict(arrays)
+    except (OSError, ValueError) as error:
+        print(f"(W) Ignoring unreadable cache file {file_name}: {error}")
+        return None
+
+
+def save_arrays(kind: str, key: str, arrays: dict[str, np.ndarray]):
+    """Save arrays to the cache, so that other processes never read half a file."""
+    file_name = cache_file(kind, key)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    temporary_file = f"{file_name}.{threading.get_ident()}.tmp"
+    with open(temporary_file, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(temporary_file, file_name)
@@ -0,0 +1,277 @@
+"""Deterministic fly-through benchmark of the London scene.
+
+Renders the scene offscreen while the camera follows a scripted path, with a fixed time step,
+a fixed wall clock for Big Ben and a fixed dinosaur animation time, so every run draws the
+same frames. Per-frame CPU times of each phase and GPU times of each render pass are
+summarised as JSON, and optionally compared against a stored baseline.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --baseline baseline.json --save-baseline
+    python benchmark.py --baseline baseline.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import quaternion
+from numpy.typing import ArrayLike
+
+from offscreen import use_offscreen_platform
+
+# (time in seconds, camera position, point the camera looks at)
+FLY_THROUGH = [
+    (0.0, (-40.0, 25.0, 20.0), (-18.0, 5.0, 4.0)),
+    (3.0, (-20.0, 12.0, 15.0), (-18.0, 5.0, 0.0)),
+    (6.0, (-45.0, 8.0, -10.0), (-10.0, 2.0, -30.0)),
+    (9.0, (-30.0, 30.0, -60.0), (10.0, 0.0, -40.0)),
+    (12.0, (10.0, 45.0, -80.0), (10.0, 0.0, -30.0)),
+    (15.0, (55.0, 20.0, -60.0), (15.0, 0.0, -30.0)),
+    (18.0, (30.0, 6.0, -20.0), (0.0, 3.0, -10.0)),
+    (21.0, (0.0, 60.0, 30.0), (5.0, 0.0, -30.0)),
+    (24.0, (-40.0, 25.0, 20.0), (-18.0, 5.0, 4.0)),
+]
+
+# Percentiles reported for each phase and the whole frame
+PERCENTILES = (50, 95, 99)
+
+# A fixed wall clock time, so the clock hands are always in the same place
+FIXED_WALL_CLOCK = time.struct_time((2023, 12, 1, 10, 8, 0, 4, 335, 0))
+
+
+def look_rotation(position: ArrayLike, target: ArrayLike):
+    """The rotation of a camera at `position` looking at `target`, with +y up.
+    Cameras look down their -z axis.
+    """
+    backwards = np.asarray(position, dtype=float) - np.asarray(target, dtype=float)
+    backwards /= np.linalg.norm(backwards)
+
+    right = np.cross([0.0, 1.0, 0.0], backwards)
+    right /= np.linalg.norm(right)
+    up = np.cross(backwards, right)
+
+    rotation = np.identity(3)
+    rotation[:, 0] = right
+    rotation[:, 1] = up
+    rotation[:, 2] = backwards
+    return quaternion.from_rotation_matrix(rotation)
+
+
+def fly_through_clip():
+    """An animation clip moving a camera along `FLY_THROUGH`."""
+    from animation import POSITION, ROTATION, AnimationClip, Track
+
+    times = [time for time, _, _ in FLY_THROUGH]
+    positions = [position for _, position, _ in FLY_THROUGH]
+    rotations = [look_rotation(position, target) for _, position, target in FLY_THROUGH]
+
+    return AnimationClip(
+        "fly_through",
+        [Track(POSITION, times, positions), Track(ROTATION, times, rotations)],
+    )
+
+
+def summarise(samples: ArrayLike) -> dict[str, float]:
+    """Summarise frame times in seconds as statistics in milliseconds."""
+    samples = np.asarray(samples, dtype=float) * 1000.0
+    summary = {"mean": float(np.mean(samples))}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}"] = float(np.percentile(samples, percentile))
+    summary["max"] = float(np.max(samples))
+    return summary
+
+
+def run_benchmark(
+    frames=1440, warmup=60, width=960, height=720, pipelined=False
+) -> dict:
+    """Run the fly-through and return the summarised results.
+
+    Args:
+        frames (int, optional): Number of measured frames. Defaults to 1440, one lap at 60 FPS.
+        warmup (int, optional): Frames to draw before measuring, to fill caches. Defaults to 60.
+        width (int, optional): Render width. Defaults to 960.
+        height (int, optional): Render height. Defaults to 720.
+        pipelined (bool, optional): Simulate on a worker thread. Defaults to False.
+
+    Returns:
+        dict: Benchmark results
+    """
+    from OpenGL import GL as gl
+
+    from main_scene import MainScene
+
+    scene = MainScene(width=width, height=height, headless=True)
+    scene.pipelined = pipelined
+    scene.fps_max = 0
+    scene.fixed_delta_time = 1.0 / scene.simulation_rate
+    scene.wall_clock = lambda: FIXED_WALL_CLOCK
+
+    scene.camera = scene.free_camera
+    scene.animations.bind(fly_through_clip(), scene.free_camera)
+    scene.interpolation.track(scene.free_camera)
+
+    scene.start(frames=warmup)
+    # Don't count the warm up frames still in flight on the GPU
+    scene.gpu_timer.resolve(wait=True)
+
+    scene.timer.history = []
+    scene.gpu_timer.history = []
+    scene.start(frames=frames)
+    scene.gpu_timer.resolve(wait=True)
+
+    frame_times = [frame_time for frame_time, _ in scene.timer.history]
+    phase_names = sorted({name for _, phases in scene.timer.history for name in phases})
+    # Phases that didn't happen in a frame took no time
+    phase_times = {
+        name: [phases.get(name, 0.0) for _, phases in scene.timer.history]
+        for name in phase_names
+    }
+    gpu_pass_names = sorted({
+        name for _, passes in scene.gpu_timer.history for name in passes
+    })
+    gpu_pass_times = {
+        name: [passes.get(name, 0.0) for _, passes in scene.gpu_timer.history]
+        for name in gpu_pass_names
+    }
+
+    results = {
+        "benchmark": "fly_through",
+        "frames": frames,
+        "warmup": warmup,
+        "resolution": [width, height],
+        "pipelined": pipelined,
+        "renderer": gl.glGetString(gl.GL_RENDERER).decode(),
+        "frame": summarise(frame_times),
+        "phases": {phase: summarise(times) for phase, times in phase_times.items()},
+    }
+    if scene.gpu_timer.history:
+        results["gpu"] = {
+            "frame": summarise([
+                frame_time for frame_time, _ in scene.gpu_timer.history
+            ]),
+            "passes": {
+                name: summarise(times) for name, times in gpu_pass_times.items()
+            },
+        }
+    return results
+
+
+def flatten_statistics(results: dict) -> dict[str, dict[str, float]]:
+    """The statistics of the frame, each phase, and each GPU pass, by name."""
+    statistics = {"frame": results["frame"], **results.get("phases", {})}
+    if "gpu" in results:
+        statistics["gpu frame"] = results["gpu"]["frame"]
+        for name, stats in results["gpu"]["passes"].items():
+            statistics[f"gpu {name}"] = stats
+    return statistics
+
+
+def compare(
+    results: dict, baseline: dict, threshold: float, metrics: list[str]
+) -> list[str]:
+    """Compare results against a baseline.
+
+    Args:
+        results (dict): Results from `run_benchmark`
+        baseline (dict): Earlier results to compare against
+        threshold (float): Allowed fractional slow down, e.g. 0.1 for 10%
+        metrics (list[str]): Statistics to compare, e.g. ["mean", "p95"]
+
+    Returns:
+        list[str]: A description of every regression, empty if there were none
+    """
+    current = flatten_statistics(results)
+    previous = flatten_statistics(baseline)
+
+    regressions = []
+    for name, stats in current.items():
+        if name not in previous:
+            continue
+        for metric in metrics:
+            before = previous[name].get(metric)
+            after = stats.get(metric)
+            if before is None or after is None or before <= 0:
+                continue
+            change = after / before - 1.0
+            if change > threshold:
+                regressions.append(
+                    f"{name} {metric}: {before:.3f}ms -> {after:.3f}ms"
+                    f" (+{change * 100:.1f}%)"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--frames", type=int, default=1440)
+    parser.add_argument("--warmup", type=int, default=60)
+    parser.add_argument("--width", type=int, default=960)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument(
+        "--pipelined", action="store_true", help="simulate on a worker thread"
+    )
+    parser.add_argument("--output", help="write the results JSON to this file")
+    parser.add_argument("--baseline", help="baseline results JSON to compare against")
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store these results as the baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fail if a metric is this fraction slower than the baseline (default 0.1)",
+    )
+    parser.add_argument(
+        "--metrics",
+        default="mean,p95",
+        help="comma separated statistics to compare (default mean,p95)",
+    )
+    args = parser.parse_args()
+
+    # Has to happen before anything imports OpenGL
+    use_offscreen_platform()
+
+    results = run_benchmark(
+        frames=args.frames,
+        warmup=args.warmup,
+        width=args.width,
+        height=args.height,
+        pipelined=args.pipelined,
+    )
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+
+    if args.baseline is None:
+        return 0
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            file.write(output)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+
+    regressions = compare(results, baseline, args.threshold, args.metrics.split(","))
+    if regressions:
+        print(f"(E) {len(regressions)} regression(s) over {args.threshold * 100:.0f}%:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+
+    print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
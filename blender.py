@@ -11,6 +11,10 @@ import numpy as np
 
 from material import Material, MaterialLibrary
 from mesh import Mesh
+from mesh_optimise import optimise_mesh
+from texture import Texture
+from texture_array import TextureArray, pack_library_textures
+from tracing import traced
 
 
 def find_file(name: str, subfolders: list[str] = None) -> str:
@@ -101,6 +105,7 @@ def process_line(line):
     return (label, [float(token) for token in fields[1:]])
 
 
+@traced
 def load_material_library(file_name):
     """Load a material library .mtl file"""
     library = MaterialLibrary()
@@ -137,15 +142,33 @@ def load_material_library(file_name):
 
     library.add_material(material)
 
+    # Start decoding the textures while the model is loaded
+    Texture.prefetch({
+        material.texture
+        for material in library.materials
+        if isinstance(material.texture, str)
+    })
+
     # print("- Done, loaded {} materials".format(len(library.materials)))
 
     return library
 
 
+@traced
 def load_obj_file(file_name):
     """Function for loading a Blender3D object file. minimalistic, and partial,
     but sufficient for this course. You do not really need to worry about it.
     """
+    return create_meshes_from_blender(*parse_obj_file(file_name))
+
+
+def parse_obj_file(file_name):
+    """Read the vertices, faces and materials from a Blender3D object file, without creating any meshes.
+
+    Returns:
+        tuple: vertices, faces, material names, vertex textures, material library and mesh ids,
+            the arguments of `create_meshes_from_blender`.
+    """
     vertices = []  # list of vertices
     vertex_textures = []  # list of texture vectors
     faces = []  # list of polygonal faces
@@ -214,7 +237,7 @@ def load_obj_file(file_name):
                 material = library.names[data[1]]
                 mesh_id += 1
 
-    return create_meshes_from_blender(
+    return (
         vertices,
         faces,
         material_names,
@@ -227,6 +250,10 @@ def load_obj_file(file_name):
 def create_meshes_from_blender(
     vertices, faces, material_names, vertex_textures, library, mesh_list
 ):
+    # Before the meshes are created, so they use the array instead of each texture
+    if TextureArray.pack_materials:
+        pack_library_textures(library)
+
     start_face = 0
     mesh_id = 1
     meshes = []
@@ -308,12 +335,24 @@ def create_mesh(varray, tarray, flist, fstart, f, library, material):
     if textures is not None:
         textures = textures[vmin:vmax, :]
 
-    return Mesh(
-        vertices=varray[vmin:vmax, :],
-        faces=farray[:, :, 0] - vmin - 1,
+    vertices = varray[vmin:vmax, :]
+    faces = farray[:, :, 0] - vmin - 1
+    if Mesh.optimise_on_import:
+        # Reorder for the vertex cache and overdraw, then the vertices to match
+        faces, order = optimise_mesh(vertices, faces)
+        vertices = vertices[order]
+        if textures is not None:
+            textures = textures[order]
+
+    mesh = Mesh(
+        vertices=vertices,
+        faces=faces,
         material=library.materials[material],
         texture_coords=textures,
     )
+    if Mesh.generate_lods_on_import:
+        mesh.generate_lods()
+    return mesh
 
 
 def fix_blender_textures(textures, faces, vertices):
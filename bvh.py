@@ -0,0 +1,543 @@
+"""A bounding volume hierarchy over the world space bounds of the scene's meshes.
+
+The tree is built top down, splitting items at the median of their centres along the longest
+axis, and stored as flat arrays in depth first order, so every subtree's items are contiguous.
+When things move the tree is refit, recomputing the bounds of each level from the one below,
+and only rebuilt when meshes are added or removed.
+
+Queries are answered for many queries at once, walking the tree one level at a time with the
+(query, node) pairs still overlapping as numpy arrays, so the Python overhead grows with the
+depth of the tree rather than the number of objects.
+"""
+
+import math
+import threading
+import time
+
+import imgui
+import numpy as np
+
+
+def expand_ranges(starts, counts) -> tuple[np.ndarray, np.ndarray]:
+    """Every index in the ranges `starts[i]` to `starts[i] + counts[i]`, and the range each
+    came from.
+    """
+    owners = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets, owners
+
+
+def transform_bounds(lower, upper, poses) -> tuple[np.ndarray, np.ndarray]:
+    """World space bounding boxes of local bounding boxes moved by 4x4 poses.
+
+    Args:
+        lower (NDArray): (items, 3) local minimum corners
+        upper (NDArray): (items, 3) local maximum corners
+        poses (NDArray): (items, 4, 4) world poses
+
+    Returns:
+        tuple[NDArray, NDArray]: (items, 3) world minimum and maximum corners
+    """
+    centres = (lower + upper) / 2
+    extents = (upper - lower) / 2
+    world_centres = np.einsum("nij,nj->ni", poses[:, :3, :3], centres) + poses[:, :3, 3]
+    world_extents = np.einsum("nij,nj->ni", np.abs(poses[:, :3, :3]), extents)
+    return world_centres - world_extents, world_centres + world_extents
+
+
+def frustum_planes(matrix) -> np.ndarray:
+    """The six planes of the frustum of a projection view matrix, pointing inwards.
+
+    Returns:
+        NDArray: (6, 4) planes (a, b, c, d), where a point is inside when ax + by + cz + d >= 0
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return np.array([
+        matrix[3] + matrix[0],
+        matrix[3] - matrix[0],
+        matrix[3] + matrix[1],
+        matrix[3] - matrix[1],
+        matrix[3] + matrix[2],
+        matrix[3] - matrix[2],
+    ])
+
+
+class BVH:
+    """Bounding volume hierarchy over axis aligned boxes."""
+
+    # Most items in a leaf
+    leaf_size = 4
+
+    def __init__(self, lower, upper):
+        """Build a tree over boxes.
+
+        Args:
+            lower (NDArray): (items, 3) minimum corners
+            upper (NDArray): (items, 3) maximum corners
+        """
+        self.item_lower = np.asarray(lower, dtype=np.float64)
+        self.item_upper = np.asarray(upper, dtype=np.float64)
+        centres = (self.item_lower + self.item_upper) / 2
+
+        # Node arrays, filled in depth first order
+        children = []
+        first_item = []
+        item_count = []
+        depth = []
+        order = []
+
+        def build(items, level):
+            node = len(children)
+            children.append([-1, -1])
+            first_item.append(len(order))
+            item_count.append(len(items))
+            depth.append(level)
+            if len(items) <= self.leaf_size:
+                order.extend(items.tolist())
+                return node
+
+            spread = centres[items].max(axis=0) - centres[items].min(axis=0)
+            axis = int(spread.argmax())
+            items = items[np.argsort(centres[items, axis], kind="stable")]
+            half = len(items) // 2
+            left = build(items[:half], level + 1)
+            right = build(items[half:], level + 1)
+            children[node] = [left, right]
+            return node
+
+        if len(centres):
+            build(np.arange(len(centres)), 0)
+
+        self.children = np.array(children, dtype=np.int64).reshape(-1, 2)
+        self.first_item = np.array(first_item, dtype=np.int64)
+        self.item_count = np.array(item_count, dtype=np.int64)
+        self.depth = np.array(depth, dtype=np.int64)
+        # Items in leaf order, so each node's items are `items[first:first + count]`
+        self.items = np.array(order, dtype=np.int64)
+
+        self.leaves = np.flatnonzero(self.children[:, 0] < 0)
+        # Internal nodes of each level, deepest first, for refitting
+        internal = self.children[:, 0] >= 0
+        self.levels = [
+            np.flatnonzero(internal & (self.depth == level))
+            for level in range(int(self.depth.max(initial=0)), -1, -1)
+        ]
+
+        self.lower = np.zeros((len(self.children), 3))
+        self.upper = np.zeros((len(self.children), 3))
+        self.refit(self.item_lower, self.item_upper)
+
+    @property
+    def node_count(self) -> int:
+        return len(self.children)
+
+    @property
+    def height(self) -> int:
+        return int(self.depth.max(initial=-1)) + 1
+
+    def refit(self, lower, upper):
+        """Update the node bounds for new item bounds, keeping the tree's shape.
+
+        Args:
+            lower (NDArray): (items, 3) minimum corners
+            upper (NDArray): (items, 3) maximum corners
+        """
+        self.item_lower = np.asarray(lower, dtype=np.float64)
+        self.item_upper = np.asarray(upper, dtype=np.float64)
+        # Nodes as Python lists for `nearest_along_ray`, made again when it's next used
+        self.node_lists = None
+        if len(self.leaves) == 0:
+            return
+
+        sorted_lower = self.item_lower[self.items]
+        sorted_upper = self.item_upper[self.items]
+        starts = self.first_item[self.leaves]
+        self.lower[self.leaves] = np.minimum.reduceat(sorted_lower, starts)
+        self.upper[self.leaves] = np.maximum.reduceat(sorted_upper, starts)
+
+        for nodes in self.levels:
+            left, right = self.children[nodes, 0], self.children[nodes, 1]
+            self.lower[nodes] = np.minimum(self.lower[left], self.lower[right])
+            self.upper[nodes] = np.maximum(self.upper[left], self.upper[right])
+
+    def traverse(self, query_count: int, test) -> tuple[np.ndarray, np.ndarray]:
+        """Find every (query, item) pair whose boxes pass a test, for many queries at once.
+
+        Args:
+            query_count (int): Number of queries
+            test (Callable): Called with (queries, lower, upper) arrays, returns whether each
+                box overlaps its query, and whether it's completely inside it (or None)
+
+        Returns:
+            tuple[NDArray, NDArray]: Query and item index of each pair
+        """
+        found_queries = []
+        found_items = []
+        if self.node_count == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+        queries = np.arange(query_count)
+        nodes = np.zeros(query_count, dtype=np.int64)
+        while len(nodes):
+            overlaps, inside = test(queries, self.lower[nodes], self.upper[nodes])
+
+            # Every item of a node entirely inside the query matches, without testing
+            if inside is not None:
+                accepted = overlaps & inside
+                items, owners = expand_ranges(
+                    self.first_item[nodes[accepted]], self.item_count[nodes[accepted]]
+                )
+                found_queries.append(queries[accepted][owners])
+                found_items.append(self.items[items])
+                overlaps &= ~inside
+
+            # Test each item of overlapping leaves against its own box
+            leaf = overlaps & (self.children[nodes, 0] < 0)
+            items, owners = expand_ranges(
+                self.first_item[nodes[leaf]], self.item_count[nodes[leaf]]
+            )
+            items = self.items[items]
+            owners = queries[leaf][owners]
+            hit, _ = test(owners, self.item_lower[items], self.item_upper[items])
+            found_queries.append(owners[hit])
+            found_items.append(items[hit])
+
+            internal = overlaps & ~leaf
+            queries = np.repeat(queries[internal], 2)
+            nodes = self.children[nodes[internal]].reshape(-1)
+
+        return np.concatenate(found_queries), np.concatenate(found_items)
+
+    @staticmethod
+    def split_by_query(query_count: int, queries, values) -> list[np.ndarray]:
+        order = np.argsort(queries, kind="stable")
+        bounds = np.searchsorted(queries[order], np.arange(1, query_count))
+        return np.split(values[order], bounds)
+
+    def query_frustums(self, planes) -> list[np.ndarray]:
+        """Items whose boxes are at least partly inside each frustum.
+
+        Args:
+            planes (NDArray): (queries, 6, 4) frustum planes from `frustum_planes`
+
+        Returns:
+            list[NDArray]: Item indices for each frustum
+        """
+        planes = np.asarray(planes, dtype=np.float64).reshape(-1, 6, 4)
+
+        def test(queries, lower, upper):
+            normals = planes[queries, :, :3]
+            centres = ((lower + upper) / 2)[:, np.newaxis]
+            extents = ((upper - lower) / 2)[:, np.newaxis]
+            distance = (normals * centres).sum(axis=2) + planes[queries, :, 3]
+            radius = (np.abs(normals) * extents).sum(axis=2)
+            return (distance + radius >= 0).all(axis=1), (distance - radius >= 0).all(
+                axis=1
+            )
+
+        queries, items = self.traverse(len(planes), test)
+        return self.split_by_query(len(planes), queries, items)
+
+    def query_frustum(self, planes) -> np.ndarray:
+        return self.query_frustums(np.asarray(planes)[np.newaxis])[0]
+
+    def query_spheres(self, centres, radii) -> list[np.ndarray]:
+        """Items whose boxes overlap each sphere.
+
+        Args:
+            centres (NDArray): (queries, 3) sphere centres
+            radii (NDArray): (queries,) sphere radii
+
+        Returns:
+            list[NDArray]: Item indices for each sphere
+        """
+        centres = np.asarray(centres, dtype=np.float64).reshape(-1, 3)
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), len(centres))
+
+        def test(queries, lower, upper):
+            centre = centres[queries]
+            outside = np.maximum(np.maximum(lower - centre, centre - upper), 0.0)
+            overlaps = np.square(outside).sum(axis=1) <= np.square(radii[queries])
+            # Inside if the corner furthest from the centre is in the sphere
+            furthest = np.maximum(np.abs(lower - centre), np.abs(upper - centre))
+            inside = np.square(furthest).sum(axis=1) <= np.square(radii[queries])
+            return overlaps, inside
+
+        queries, items = self.traverse(len(centres), test)
+        return self.split_by_query(len(centres), queries, items)
+
+    def query_rays(
+        self, origins, directions, max_distance=math.inf
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Items whose boxes each ray passes through, nearest first.
+
+        Args:
+            origins (NDArray): (queries, 3) ray origins
+            directions (NDArray): (queries, 3) ray directions
+            max_distance (float, optional): Ignore boxes further along the rays than this, in
+                lengths of the direction. Defaults to no limit.
+
+        Returns:
+            list[tuple[NDArray, NDArray]]: Item indices for each ray, and the distance along the
+                ray each box is entered (0 if the ray starts inside it)
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        with np.errstate(divide="ignore"):
+            inverse = 1.0 / directions
+
+        def entry_distance(queries, lower, upper):
+            # Slab test, NaNs from 0 * inf (rays in a box's plane) count as hits
+            with np.errstate(invalid="ignore"):
+                near = (lower - origins[queries]) * inverse[queries]
+                far = (upper - origins[queries]) * inverse[queries]
+            entry = np.fmax(np.fmin(near, far).max(axis=1), 0.0)
+            exit = np.fmin(np.fmax(near, far).min(axis=1), max_distance)
+            return np.where(entry <= exit, entry, np.inf)
+
+        def test(queries, lower, upper):
+            return np.isfinite(entry_distance(queries, lower, upper)), None
+
+        queries, items = self.traverse(len(origins), test)
+        distances = entry_distance(
+            queries, self.item_lower[items], self.item_upper[items]
+        )
+        order = np.lexsort((distances, queries))
+        queries, items, distances = queries[order], items[order], distances[order]
+        bounds = np.searchsorted(queries, np.arange(1, len(origins)))
+        return list(
+            zip(np.split(items, bounds), np.split(distances, bounds), strict=True)
+        )
+
+    def nearest_along_ray(
+        self, origin, direction, intersect, max_distance=math.inf
+    ) -> tuple[float, int]:
+        """The nearest item a single ray hits.
+
+        Rather than finding every box along the ray like `query_rays`, the tree is walked
+        front to back one node at a time, skipping nodes further away than the nearest hit
+        found so far, so usually only a few leaves near the start of the ray are visited.
+
+        Args:
+            origin (NDArray): (3,) ray origin
+            direction (NDArray): (3,) ray direction
+            intersect (Callable): Called with the item indices of a leaf and the distance of
+                the nearest hit so far, returns the distance to the nearest item the ray hits
+                and its index, or (inf, -1)
+            max_distance (float, optional): Ignore hits further along the ray than this, in
+                lengths of the direction. Defaults to no limit.
+
+        Returns:
+            tuple[float, int]: Distance to the nearest item hit and its index, or (inf, -1)
+        """
+        if self.node_count == 0:
+            return math.inf, -1
+        if self.node_lists is None:
+            self.node_lists = (
+                self.lower.tolist(),
+                self.upper.tolist(),
+                self.children.tolist(),
+                self.first_item.tolist(),
+                self.item_count.tolist(),
+            )
+        lower, upper, children, first_item, item_count = self.node_lists
+        origin = [float(value) for value in origin]
+        direction = [float(value) for value in direction]
+
+        def entry_distance(node, limit):
+            # Slab test, written out as it's called for one box at a time
+            entry, exit = 0.0, limit
+            for axis in range(3):
+                start = origin[axis]
+                if direction[axis] == 0.0:
+                    if start < lower[node][axis] or start > upper[node][axis]:
+                        return math.inf
+                    continue
+                near = (lower[node][axis] - start) / direction[axis]
+                far = (upper[node][axis] - start) / direction[axis]
+                if near > far:
+                    near, far = far, near
+                entry = max(entry, near)
+                exit = min(exit, far)
+                if entry > exit:
+                    return math.inf
+            return entry
+
+        nearest, nearest_item = max_distance, -1
+        stack = [(entry_distance(0, nearest), 0)]
+        while stack:
+            entry, node = stack.pop()
+            if entry > nearest:
+                continue
+            left, right = children[node]
+            if left < 0:
+                first = first_item[node]
+                distance, item = intersect(
+                    self.items[first : first + item_count[node]], nearest
+                )
+                if distance < nearest:
+                    nearest, nearest_item = distance, item
+                continue
+
+            # Push the further child first, so the nearer one is visited next
+            left_entry = entry_distance(left, nearest)
+            right_entry = entry_distance(right, nearest)
+            if left_entry > right_entry:
+                left_entry, right_entry, left, right = (
+                    right_entry,
+                    left_entry,
+                    right,
+                    left,
+                )
+            if right_entry <= nearest:
+                stack.append((right_entry, right))
+            if left_entry <= nearest:
+                stack.append((left_entry, left))
+
+        if nearest_item < 0:
+            return math.inf, -1
+        return nearest, nearest_item
+
+
+class SpatialIndex:
+    """Keeps a BVH over the scene's meshes up to date, and culls meshes outside the camera's
+    view with it.
+
+    The tree is rebuilt when the scene's `models_version` changes, and otherwise refit to
+    the meshes that moved, which meshes record with `moved` as their cached pose is cleared.
+    """
+
+    def __init__(self):
+        self.meshes = []
+        self.poses = []
+        self.bvh: BVH | None = None
+        self.lower = np.zeros((0, 3))
+        self.upper = np.zeros((0, 3))
+        self.models_version: int | None = None
+        # Each mesh's item in the tree, and the indices of its model and of it in the model
+        self.items: dict = {}
+        self.sources: list[tuple[int, int]] = []
+
+        # Meshes moved since the last update, recorded from whichever thread moved them,
+        # and those refit in the last update
+        self.moved_meshes: set = set()
+        self.moved_lock = threading.Lock()
+        self.last_moved: set = set()
+
+        # Statistics
+        self.rebuilds = 0
+        self.refits = 0
+        self.update_time = 0.0
+        self.query_time = 0.0
+        self.visible = 0
+
+    def moved(self, mesh):
+        """Refit a mesh's bounds in the next update, called when its world pose is cleared."""
+        with self.moved_lock:
+            self.moved_meshes.add(mesh)
+
+    def update(self, models, models_version: int):
+        """Rebuild the tree if the models changed, or refit it to the meshes that moved.
+
+        Args:
+            models (Iterable[tuple[Sequence[Mesh], Sequence[NDArray] | None]]): Meshes of
+                each model that can be drawn and their world poses, or None for their
+                current poses
+            models_version (int): The scene's `models_version` when the models were gathered
+        """
+        start = time.perf_counter()
+        models = list(models)
+        with self.moved_lock:
+            moved, self.moved_meshes = self.moved_meshes, set()
+
+        if models_version != self.models_version:
+            self.models_version = models_version
+            self.meshes = []
+            self.poses = []
+            self.sources = []
+            for model_index, (meshes, poses) in enumerate(models):
+                self.meshes.extend(meshes)
+                self.poses.extend(
+                    [mesh.world_pose for mesh in meshes] if poses is None else poses
+                )
+                self.sources.extend(
+                    (model_index, mesh_index) for mesh_index in range(len(meshes))
+                )
+            self.items = {mesh: item for item, mesh in enumerate(self.meshes)}
+            self.lower, self.upper = self.world_bounds(np.arange(len(self.meshes)))
+            self.bvh = BVH(self.lower, self.upper)
+            self.rebuilds += 1
+        else:
+            # In pipelined mode a mesh can move while the frame before is drawn, before its
+            # new pose is in a snapshot, so meshes are refit again the update after they move
+            changed = [
+                item
+                for item in map(self.items.get, moved | self.last_moved)
+                if item is not None
+            ]
+            for item in changed:
+                model_index, mesh_index = self.sources[item]
+                meshes, poses = models[model_index]
+                self.poses[item] = (
+                    meshes[mesh_index].world_pose
+                    if poses is None
+                    else poses[mesh_index]
+                )
+            if changed:
+                items = np.array(changed, dtype=np.int64)
+                self.lower[items], self.upper[items] = self.world_bounds(items)
+                self.bvh.refit(self.lower, self.upper)
+                self.refits += 1
+        self.last_moved = moved
+        self.update_time = time.perf_counter() - start
+
+    def world_bounds(self, items) -> tuple[np.ndarray, np.ndarray]:
+        """World space bounds of the meshes of items, at their poses in the index."""
+        return transform_bounds(
+            np.array([self.meshes[item].bounds[0] for item in items]).reshape(-1, 3),
+            np.array([self.meshes[item].bounds[1] for item in items]).reshape(-1, 3),
+            np.array([self.poses[item] for item in items]).reshape(-1, 4, 4),
+        )
+
+    def cull(self, projection_view) -> np.ndarray:
+        """Items of the meshes inside the frustum of a projection view matrix."""
+        start = time.perf_counter()
+        visible = self.bvh.query_frustum(frustum_planes(projection_view))
+        self.visible = len(visible)
+        self.query_time = time.perf_counter() - start
+        return visible
+
+    def meshes_along_ray(self, origin, direction, max_distance=math.inf) -> list:
+        """Meshes whose bounds a ray passes through, nearest first.
+
+        Returns:
+            list[tuple[Mesh, float]]: Each mesh and the distance where the ray enters its bounds
+        """
+        if self.bvh is None:
+            return []
+        items, distances = self.bvh.query_rays(origin, direction, max_distance)[0]
+        return [
+            (self.meshes[item], distance)
+            for item, distance in zip(items.tolist(), distances.tolist())
+        ]
+
+    def meshes_in_sphere(self, centre, radius) -> list:
+        if self.bvh is None:
+            return []
+        return [self.meshes[item] for item in self.bvh.query_spheres(centre, radius)[0]]
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        if self.bvh is None:
+            imgui.text("Not built yet")
+            return
+        imgui.text(
+            f"{len(self.meshes)} meshes, {self.bvh.node_count} nodes,"
+            f" height {self.bvh.height}"
+        )
+        imgui.text(f"{self.rebuilds} rebuilds, {self.refits} refits")
+        imgui.text(
+            f"Update {self.update_time * 1000:.2f}ms,"
+            f" culling {self.query_time * 1000:.2f}ms"
+        )
+        imgui.text(f"{self.visible} meshes in view")
@@ -10,6 +10,7 @@ from pygame.event import Event
 
 from entity import Entity
 from math_utils import translation_matrix
+from tracing import traced
 
 
 class Camera(Entity):
@@ -39,6 +40,7 @@ class Camera(Entity):
             scene.camera = cameras[selected_index]
         super().debug_menu()
 
+    @traced
     def update(self):
         """Update the camera view matrix"""
         # Invert the view matrix to give correct camera world coordinates & rotation
@@ -72,6 +74,7 @@ class FreeCamera(Camera):
             "Movement Speed", self.move_speed, 0.0, 1000.0
         )
 
+    @traced
     def update(self):
         from scene import Scene
 
@@ -141,6 +144,7 @@ class OrbitCamera(Camera):
         super().__init__(**kwargs)
         self.distance = distance
 
+    @traced
     def update(self):
         # Calculate the view matrix for a regular camera
         from scene import Scene
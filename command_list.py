@@ -0,0 +1,328 @@
+"""Retained command lists for drawing the static models.
+
+`Mesh.draw` works out the same state for a static mesh every frame: it looks up its shader,
+textures and uniform locations, converts its material to arrays, and sets the camera and light
+uniforms, and the matrices one mesh at a time. When enabled, the draws of the static models in
+each render pass are instead recorded once into a command list, a flat list of entries holding
+the OpenGL calls each mesh needs with their arguments already resolved and converted. Meshes
+with the same material or textures share a state key, so replaying only makes the calls when
+the state changes from the mesh before.
+
+Each frame a model's entries are replayed in a tight loop, patching only what changes: the
+matrices of all of the model's meshes are computed together, the camera and light uniforms are
+set once per model, and each mesh still picks its level of detail and skips drawing if culled.
+
+A pass's list is recorded again when the static models in it or their shaders change. Call
+`CommandLists.invalidate` after changing the material of a static mesh.
+"""
+
+import ctypes
+
+import imgui
+import numpy as np
+from OpenGL import GL as gl
+
+
+class CommandList:
+    """The recorded draws of the static models in one render pass."""
+
+    def __init__(self, models):
+        """Record the draws of the meshes of models.
+
+        Args:
+            models (list[tuple[Model, Shader]]): Each model, with the shader it's recorded with
+        """
+        # Imported here, as the mesh module needs the scene module, which creates the lists
+        from mesh import UNIFORM_NAMES
+        from shaders import EnvironmentShader
+
+        self.models = models
+        # Each mesh's entry, as (mesh, vertex array, material key, material calls, texture key,
+        # texture calls, model matrix, draw of each level of detail)
+        self.entries = []
+        # Range of entries of each model, its shader and uniform locations, and the world
+        # poses of its meshes, by the model's id
+        self.segments = {}
+        # Texture units the entries bind to, with the target bound on each
+        self.texture_units = set()
+
+        locations_by_program = {}
+        materials = {}
+        textures = {}
+        for model, shader in models:
+            if not shader.compiled:
+                shader.compile()
+            if shader.program_id not in locations_by_program:
+                locations_by_program[shader.program_id] = {
+                    key: gl.glGetUniformLocation(shader.program_id, name)
+                    for key, name in UNIFORM_NAMES.items()
+                }
+            locations = locations_by_program[shader.program_id]
+
+            start = len(self.entries)
+            for mesh in model.meshes:
+                material_calls = self.material_calls(mesh, locations)
+                texture_calls = tuple(
+                    call
+                    for offset, texture in enumerate(mesh.textures)
+                    for call in (
+                        (
+                            gl.glActiveTexture,
+                            (gl.GL_TEXTURE0 + texture.texture_unit + offset,),
+                        ),
+                        (gl.glBindTexture, (texture.target, texture.texture_id)),
+                    )
+                )
+                self.texture_units.update(
+                    (texture.texture_unit + offset, texture.target)
+                    for offset, texture in enumerate(mesh.textures)
+                )
+                self.entries.append((
+                    mesh,
+                    mesh.vertex_array_object,
+                    materials.setdefault(material_calls, len(materials)),
+                    material_calls,
+                    textures.setdefault(texture_calls, len(textures)),
+                    texture_calls,
+                    np.asarray(mesh.world_pose, dtype=np.float32),
+                    self.draw_calls(mesh),
+                ))
+
+            # Uniforms that are the same for every mesh drawn with the shader
+            program_calls = []
+            if isinstance(shader, EnvironmentShader):
+                program_calls.append((
+                    gl.glUniform1i,
+                    (gl.glGetUniformLocation(shader.program_id, "sampler_cube"), 0),
+                ))
+            program_calls.append((gl.glUniform1i, (locations["texture_object"], 0)))
+            program_calls.append((gl.glUniform1i, (locations["texture_array"], 1)))
+            self.segments[id(model)] = (
+                start,
+                len(self.entries),
+                shader,
+                locations,
+                tuple(program_calls),
+                model.world_pose,
+                np.array([mesh.world_pose for mesh in model.meshes]),
+            )
+
+    @staticmethod
+    def material_calls(mesh, locations) -> tuple:
+        """The calls that set a mesh's material uniforms, like `Mesh.set_uniforms`."""
+        material = mesh.material
+        layer = material.texture_layer
+        calls = [
+            (gl.glUniform1i, (locations["has_texture"], 1 if mesh.textures else 0)),
+        ]
+        if mesh.textures:
+            calls.append((
+                gl.glUniform1i,
+                (locations["texture_layer"], -1 if layer is None else layer),
+            ))
+        # Kept as tuples, so identical materials give equal calls
+        calls += [
+            (gl.glUniform3f, (locations["ambient"], *map(float, material.Ka))),
+            (gl.glUniform3f, (locations["diffuse"], *map(float, material.Kd))),
+            (gl.glUniform3f, (locations["specular"], *map(float, material.Ks))),
+            (gl.glUniform1f, (locations["specular_exponent"], float(material.Ns))),
+        ]
+        return tuple(call for call in calls if call[1][0] != -1)
+
+    @staticmethod
+    def draw_calls(mesh) -> list[tuple]:
+        """The draw call of each of a mesh's levels of detail, with its triangle count."""
+        if mesh.faces is None:
+            return [(gl.glDrawArrays, (mesh.primitive, 0, mesh.vertices.shape[0]), 0)]
+        return [
+            (
+                gl.glDrawElements,
+                (primitive, count, gl.GL_UNSIGNED_INT, ctypes.c_void_p(offset)),
+                count // 4 * 2 if primitive == gl.GL_QUADS else count // 3,
+            )
+            for offset, count, primitive, _ in mesh.lods
+        ]
+
+    def replay(self, model, scene) -> int:
+        """Draw a model's meshes from the list, patching in the current matrices, camera and
+        light.
+
+        Returns:
+            int: Triangles drawn
+        """
+        start, end, shader, locations, program_calls, pose, mesh_poses = self.segments[
+            id(model)
+        ]
+        if model.world_pose is not pose:
+            # The model moved since it was recorded
+            mesh_poses = np.array([mesh.world_pose for mesh in model.meshes])
+            self.segments[id(model)] = (
+                start,
+                end,
+                shader,
+                locations,
+                program_calls,
+                model.world_pose,
+                mesh_poses,
+            )
+            self.entries[start:end] = [
+                (*entry[:6], mesh_pose.astype(np.float32), entry[7])
+                for entry, mesh_pose in zip(
+                    self.entries[start:end], mesh_poses, strict=True
+                )
+            ]
+
+        camera = scene.camera
+        light = scene.light
+        view_matrix = camera.view_matrix
+        vm = np.matmul(view_matrix, mesh_poses)
+        pvm = np.matmul(scene.projection_matrix, vm).astype(np.float32)
+        vmit = np.linalg.inv(vm)[:, :3, :3].transpose(0, 2, 1).astype(np.float32)
+        vm = vm.astype(np.float32)
+
+        shader.bind()
+        for function, args in program_calls:
+            function(*args)
+        gl.glUniform3fv(locations["light_pos"], 1, light.position)
+        gl.glUniform3fv(locations["view_pos"], 1, camera.position)
+        gl.glUniformMatrix3fv(locations["vt"], 1, True, view_matrix.transpose()[:3, :3])
+        gl.glUniform3fv(
+            locations["ambient_illumination"], 1, light.ambient_illumination
+        )
+        gl.glUniform3fv(
+            locations["diffuse_illumination"], 1, light.diffuse_illumination
+        )
+        gl.glUniform3fv(
+            locations["specular_illumination"], 1, light.specular_illumination
+        )
+
+        bind_vertex_array = gl.glBindVertexArray
+        set_matrix4 = gl.glUniformMatrix4fv
+        set_matrix3 = gl.glUniformMatrix3fv
+        model_location = locations["model"]
+        pvm_location = locations["pvm"]
+        vm_location = locations["vm"]
+        vmit_location = locations["vmit"]
+        visible_meshes = scene.visible_meshes
+        material = texture = -1
+        triangles = 0
+        for index, (
+            mesh,
+            vertex_array,
+            material_key,
+            material_calls,
+            texture_key,
+            texture_calls,
+            model_matrix,
+            draws,
+        ) in enumerate(self.entries[start:end]):
+            if visible_meshes is not None and mesh not in visible_meshes:
+                continue
+            mesh.select_lod()
+
+            bind_vertex_array(vertex_array)
+            set_matrix4(model_location, 1, True, model_matrix)
+            set_matrix4(pvm_location, 1, True, pvm[index])
+            set_matrix4(vm_location, 1, True, vm[index])
+            set_matrix3(vmit_location, 1, True, vmit[index])
+            if material_key != material:
+                material = material_key
+                for function, args in material_calls:
+                    function(*args)
+            if texture_key != texture:
+                texture = texture_key
+                for function, args in texture_calls:
+                    function(*args)
+
+            function, args, lod_triangles = draws[mesh.lod]
+            function(*args)
+            triangles += lod_triangles
+
+        # Unbind each texture from its own target, and leave unit 0 active as `Mesh.draw` does
+        for unit, target in sorted(self.texture_units):
+            gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+            gl.glBindTexture(target, 0)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        bind_vertex_array(0)
+        return triangles
+
+
+class CommandLists:
+    """Records the draws of the static models in each render pass, and replays them."""
+
+    def __init__(self):
+        self.enabled = False
+        # The list of each render pass, by its name
+        self.lists: dict[str, CommandList] = {}
+
+        # Statistics
+        self.records = 0
+        self.replays = 0
+
+    def invalidate(self):
+        """Record every list again the next time it's drawn, e.g. after a material changes."""
+        self.lists = {}
+
+    def begin_frame(self, models):
+        """Record the lists of passes whose static models or shaders have changed.
+
+        Args:
+            models (list[Model]): Every model in the scene
+        """
+        self.replays = 0
+        if not self.enabled:
+            self.lists = {}
+            return
+
+        passes: dict[str, list] = {}
+        for model in models:
+            if model.static:
+                passes.setdefault(model.render_pass, []).append((model, model.shader))
+
+        lists = {}
+        for render_pass, pass_models in passes.items():
+            command_list = self.lists.get(render_pass)
+            if command_list is None or self.changed(command_list.models, pass_models):
+                command_list = CommandList(pass_models)
+                self.records += 1
+            lists[render_pass] = command_list
+        self.lists = lists
+
+    @staticmethod
+    def changed(recorded, models) -> bool:
+        """Whether the models of a pass or their shaders differ from those recorded."""
+        return len(recorded) != len(models) or any(
+            model is not recorded_model or shader is not recorded_shader
+            for (model, shader), (recorded_model, recorded_shader) in zip(
+                models, recorded
+            )
+        )
+
+    def draw(self, model) -> bool:
+        """Draw a static model by replaying its part of its pass's list.
+
+        Returns:
+            bool: Whether the model was drawn, or has to be drawn as usual
+        """
+        if not self.enabled or not model.static:
+            return False
+        command_list = self.lists.get(model.render_pass)
+        if command_list is None or id(model) not in command_list.segments:
+            return False
+
+        # Imported here, as the scene module creates the lists
+        from scene import Scene
+
+        scene = Scene.current_scene
+        scene.triangles_drawn += command_list.replay(model, scene)
+        self.replays += 1
+        return True
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        _, self.enabled = imgui.checkbox("Retained command lists", self.enabled)
+        entries = sum(len(command_list.entries) for command_list in self.lists.values())
+        imgui.text(
+            f"{len(self.lists)} lists of {entries} meshes, recorded {self.records} times"
+        )
+        imgui.text(f"{self.replays} models replayed last frame")
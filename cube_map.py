@@ -4,6 +4,7 @@
 from OpenGL import GL as gl
 
 from texture import ImageWrapper, Texture
+from texture_cache import prefetch_images
 
 
 class CubeMap(Texture):
@@ -48,6 +49,8 @@ class CubeMap(Texture):
             gl.GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: "front.png",
         }
 
+        self.gpu_bytes = 0
+
         # generate the texture.
         self.texture_id = gl.glGenTextures(1)
 
@@ -80,16 +83,20 @@ class CubeMap(Texture):
         if files is not None:
             self.files = files
 
+        # Decode the faces in parallel, then upload them in order
+        prefetch_images(f"{name}/{value}" for value in self.files.values())
+
+        self.gpu_bytes = 0
         for key, value in self.files.items():
             img = ImageWrapper(f"{name}/{value}")
+            self.gpu_bytes += img.width * img.height * img.pixels.shape[2]
 
-            # convert the python image object to a plain byte array for passsing to OpenGL
             gl.glTexImage2D(
                 key,
                 0,
                 self.texture_format,
-                img.image_data.get_width(),
-                img.image_data.get_height(),
+                img.width,
+                img.height,
                 0,
                 self.texture_format,
                 self.texture_type,
@@ -43,16 +43,15 @@ class Entity:
         self.__scale__ = scale
 
         self.children: list[Type["Entity"]] = []
-        self.parent = parent
-
-        if parent is not None:
-            self.parent.children.append(self)
 
         # We cache all world matrices so they aren't re-calculated unless something changes.
         self.__cache_world_pose__ = None
         self.__cache_world_translation__ = None
         self.__cache_world_rotation__ = None
 
+        self.__parent__ = None
+        self.parent = parent
+
         # NOTE: I use quaternions instead of a matrix to store rotation information
         # Interpolating between two quaternions is much easier, and allows for smooth animations
         # They also avoid euler angle related gimbal lock issues that I was encountering
@@ -77,6 +76,21 @@ class Entity:
         self.clear_entity_cache()
         self.__position__ = np.array(value, dtype=np.float32)
 
+    @property
+    def parent(self):
+        return self.__parent__
+
+    # A property, so the entity is always one of its parent's children, and so has its cache
+    # cleared when the parent moves
+    @parent.setter
+    def parent(self, value):
+        if self.__parent__ is not None:
+            self.__parent__.children.remove(self)
+        self.__parent__ = value
+        if value is not None:
+            value.children.append(self)
+        self.clear_entity_cache()
+
     @property
     def x(self) -> np.float32:
         return self.__position__[0]
@@ -128,6 +142,16 @@ class Entity:
         self.clear_entity_cache()
         self.__scale__ = value
 
+    def set_transform(self, position=None, rotation=None, scale=None):
+        """Set any of the position, rotation and scale at once, only clearing the cache one time."""
+        self.clear_entity_cache()
+        if position is not None:
+            self.__position__ = np.array(position, dtype=np.float32)
+        if rotation is not None:
+            self.__rotation__ = rotation
+        if scale is not None:
+            self.__scale__ = scale
+
     def clear_entity_cache(self):
         """Clear the location, rotation, scale cache for the entity. You should not need to call this outside entity.py"""
         self.__cache_world_pose__ = None
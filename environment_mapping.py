@@ -11,6 +11,7 @@ from cube_map import CubeMap
 from framebuffer import Framebuffer
 from scene import Scene
 from shaders import EnvironmentShader
+from tracing import traced
 
 
 class EnvironmentMappingTexture(CubeMap):
@@ -63,6 +64,7 @@ class EnvironmentMappingTexture(CubeMap):
             ]),
         }
 
+        self.gpu_bytes = 6 * width * height * 4
         self.bind()
         for face, fbo in self.frame_buffers.items():
             gl.glTexImage2D(
@@ -79,6 +81,7 @@ class EnvironmentMappingTexture(CubeMap):
             fbo.prepare(self, face)
         self.unbind()
 
+    @traced
     def update(self):
         """Update the environment map. If you want to update the environment map after it has already been rendered, set `self.rendered` to `False` first"""
         # Don't re-render the map unless necessary
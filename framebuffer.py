@@ -8,6 +8,9 @@ class Framebuffer:
     Basic class to handle rendering to texture using a framebuffer object.
     """
 
+    # The framebuffer to go back to when unbinding, replaced when rendering offscreen
+    default_framebuffer = 0
+
     def __init__(self, attachment=gl.GL_COLOR_ATTACHMENT0, texture=None):
         """
         Initialise the framebuffer
@@ -24,7 +27,7 @@ class Framebuffer:
         gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.frame_buffer_object)
 
     def unbind(self):
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, Framebuffer.default_framebuffer)
 
     def prepare(self, texture, target=None, level=0):
         """
@@ -0,0 +1,156 @@
+"""GPU timing of render passes with OpenGL timestamp queries.
+
+Query results are read back a few frames late, once the GPU has finished with them,
+so measuring never makes the CPU wait for the GPU. Each pass is also labelled with a
+KHR_debug group, so it shows up by name in tools like RenderDoc and apitrace.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+
+import imgui
+import numpy as np
+from OpenGL import GL as gl
+
+
+def top_level_time(timings: list[tuple[str, int, int]]) -> float:
+    """Total seconds covered by (name, start, end) nanosecond timings, not counting nested passes twice."""
+    total = 0
+    covered_until = -1
+    for start, end in sorted((start, end) for _, start, end in timings):
+        if end > covered_until:
+            total += end - max(start, covered_until)
+            covered_until = end
+    return total / 1e9
+
+
+class GPUTimer:
+    """Records how long the GPU spent on each render pass, in seconds."""
+
+    def __init__(self, latency=3):
+        """
+        Args:
+            latency (int, optional): Frames of queries in flight before waiting for the oldest.
+                Defaults to 3.
+        """
+        self.latency = latency
+        self.enabled = True
+
+        # GPU time of each pass in the last measured frame, and their sum
+        self.pass_times: dict[str, float] = {}
+        self.frame_time = 0.0
+
+        # Set to a list to keep the (total GPU time, pass times) of every measured frame,
+        # e.g. when benchmarking
+        self.history: list[tuple[float, dict[str, float]]] | None = None
+
+        # Whether the driver has timestamp queries and debug groups, checked on first use
+        self.timestamps_supported: bool | None = None
+        self.debug_groups_supported = False
+
+        self.free_queries: list[int] = []
+        # (pass name, start query, end query) of each frame that hasn't been read back yet
+        self.pending_frames: deque[list[tuple[str, int, int]]] = deque()
+        self.current_frame: list[tuple[str, int, int]] | None = None
+        self.result = np.zeros(1, dtype=np.int64)
+
+    def check_support(self):
+        self.timestamps_supported = bool(gl.glQueryCounter) and (
+            gl.glGetQueryiv(gl.GL_TIMESTAMP, gl.GL_QUERY_COUNTER_BITS) > 0
+        )
+        self.debug_groups_supported = bool(gl.glPushDebugGroup)
+        if not self.timestamps_supported:
+            print("(W) Timestamp queries aren't supported, GPU pass times are disabled")
+
+    def begin_frame(self):
+        """Start measuring a new frame, and collect the results of earlier frames that are ready."""
+        if self.timestamps_supported is None:
+            self.check_support()
+
+        self.resolve()
+
+        if self.enabled and self.timestamps_supported:
+            self.current_frame = []
+
+    def end_frame(self):
+        if self.current_frame is not None:
+            self.pending_frames.append(self.current_frame)
+            self.current_frame = None
+
+    def query(self) -> int:
+        if not self.free_queries:
+            self.free_queries.extend(int(query) for query in gl.glGenQueries(16))
+        return self.free_queries.pop()
+
+    @contextmanager
+    def render_pass(self, name: str):
+        """Time the OpenGL commands issued inside the `with` block, and label them as a debug group.
+        Passes can be nested. Repeated passes within a frame are summed.
+        """
+        if self.debug_groups_supported:
+            gl.glPushDebugGroup(gl.GL_DEBUG_SOURCE_APPLICATION, 0, -1, name)
+
+        frame = self.current_frame
+        if frame is not None:
+            start = self.query()
+            gl.glQueryCounter(start, gl.GL_TIMESTAMP)
+
+        try:
+            yield
+        finally:
+            if frame is not None:
+                end = self.query()
+                gl.glQueryCounter(end, gl.GL_TIMESTAMP)
+                frame.append((name, start, end))
+
+            if self.debug_groups_supported:
+                gl.glPopDebugGroup()
+
+    def available(self, query: int) -> bool:
+        return bool(gl.glGetQueryObjectiv(query, gl.GL_QUERY_RESULT_AVAILABLE))
+
+    def timestamp(self, query: int) -> int:
+        gl.glGetQueryObjecti64v(query, gl.GL_QUERY_RESULT, self.result)
+        return int(self.result[0])
+
+    def resolve(self, wait=False):
+        """Read back every finished frame, oldest first.
+
+        Args:
+            wait (bool, optional): Wait for the GPU to finish every pending frame. Defaults to False,
+                which only waits when more than `latency` frames are in flight.
+        """
+        while self.pending_frames:
+            frame = self.pending_frames[0]
+            must_wait = wait or len(self.pending_frames) > self.latency
+            if frame and not must_wait and not self.available(frame[-1][2]):
+                # Later frames can't have finished either
+                break
+
+            self.pending_frames.popleft()
+            timings = [
+                (name, self.timestamp(start), self.timestamp(end))
+                for name, start, end in frame
+            ]
+            for _, start, end in frame:
+                self.free_queries += [start, end]
+
+            self.pass_times = {}
+            for name, start, end in timings:
+                self.pass_times[name] = (
+                    self.pass_times.get(name, 0.0) + (end - start) / 1e9
+                )
+            self.frame_time = top_level_time(timings)
+            if self.history is not None:
+                self.history.append((self.frame_time, self.pass_times))
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        _, self.enabled = imgui.checkbox("Measure GPU passes", self.enabled)
+        if not self.timestamps_supported:
+            imgui.text("Timestamp queries are not supported")
+            return
+
+        for name, seconds in self.pass_times.items():
+            imgui.text(f"{name}: {seconds * 1000:.3f}ms")
+        imgui.text(f"GPU total: {self.frame_time * 1000:.3f}ms")
@@ -0,0 +1,461 @@
+"""GPU driven culling and drawing of the static models.
+
+Drawing a mesh the usual way costs a dozen or so PyOpenGL calls for its shader, uniforms,
+textures and draw, so the CPU time of a frame grows with the number of meshes drawn. When
+enabled, the meshes of the static models drawn with the cartoon shader are instead packed once
+into shared vertex and index buffers, with their model matrices, world bounds, materials and
+levels of detail in a shader storage buffer. Each time they're drawn, a compute shader culls
+every mesh against the frustum, chooses its level of detail like `Mesh.select_lod`, and writes
+its `DrawElementsIndirectCommand`, then the whole batch is drawn with one
+`glMultiDrawElementsIndirect` per run of meshes that share a texture. Only a handful of calls
+are made each frame, however many meshes there are.
+
+Culled meshes keep their command, with no instances, so the batch is drawn in the same order
+as the meshes would be one by one. The potentially visible sets and hidden models are applied
+through a mask that's only uploaded when the camera's cell or the models drawn change.
+
+Needs OpenGL 4.3, for compute shaders and shader storage buffers.
+"""
+
+import ctypes
+import math
+from itertools import groupby
+
+import imgui
+import numpy as np
+from OpenGL import GL as gl
+
+from bvh import frustum_planes, transform_bounds
+
+# Levels of detail each mesh can have in the batch, the full mesh and three simplified ones
+MAX_LODS = 4
+# Floats in the MeshData struct of the shaders, 18 vec4s
+MESH_DATA_SIZE = 72
+# Bytes in a DrawElementsIndirectCommand, five uints
+COMMAND_SIZE = 20
+# Invocations in each work group of the culling shader
+WORK_GROUP_SIZE = 64
+
+
+def triangle_indices(faces) -> np.ndarray:
+    """Triangles of faces as a flat index array, with the triangles of each quad together,
+    in the order OpenGL draws quads.
+    """
+    if faces.shape[1] == 4:
+        faces = faces[:, [0, 1, 2, 0, 2, 3]]
+    return faces.reshape(-1).astype(np.uint32)
+
+
+class IndirectRenderer:
+    """Draws the static models with GPU culling and multi-draw indirect."""
+
+    def __init__(self):
+        self.enabled = False
+        self.supported: bool | None = None
+
+        self.shader = None
+        self.cull_shader = None
+        self.uniform_locations = {}
+        self.cull_uniform_locations = {}
+
+        # Models in the batch and their meshes, with the world poses the meshes were packed
+        # with and the texture each run of meshes binds, as (texture, first mesh, meshes)
+        self.models = []
+        self.meshes = []
+        self.poses = []
+        self.groups: list[tuple] = []
+        # Base vertex of each mesh, and the first index, index count and error of its levels
+        self.lod_table: list[tuple] = []
+        # Whether each model can be batched, by the model and its shader
+        self.eligibility: dict[tuple, bool] = {}
+        self.vertex_array_object = None
+        self.buffers = {}
+
+        # Models given to `submit` since the last flush, and what the mask was made from
+        self.submitted = []
+        self.mask_key = None
+
+        # Statistics
+        self.builds = 0
+        self.vertex_bytes = 0
+        self.draw_calls = 0
+
+    def eligible(self, model) -> bool:
+        """Whether a model can be drawn by the batch, which only has the cartoon shader and
+        at most one texture per mesh. Checked once per model and shader.
+        """
+        # Imported here, as the shaders need the scene module, which creates the renderer
+        from shaders import CartoonShader
+
+        key = (id(model), id(model.shader))
+        if key not in self.eligibility:
+            self.eligibility[key] = (
+                model.static
+                and type(model.shader) is CartoonShader
+                and all(
+                    mesh.faces is not None and len(mesh.textures) <= 1
+                    for mesh in model.meshes
+                )
+            )
+        return self.eligibility[key]
+
+    def check_support(self) -> bool:
+        if self.supported is None:
+            version = (
+                gl.glGetIntegerv(gl.GL_MAJOR_VERSION),
+                gl.glGetIntegerv(gl.GL_MINOR_VERSION),
+            )
+            self.supported = version >= (4, 3)
+            if not self.supported:
+                print(
+                    f"(W) GPU driven drawing needs OpenGL 4.3, but only"
+                    f" {version[0]}.{version[1]} is available"
+                )
+        return self.supported
+
+    def submit(self, model) -> bool:
+        """Queue a model to be drawn by the batch at the end of the render pass.
+
+        Returns:
+            bool: Whether the model will be drawn by the batch, or has to be drawn as usual
+        """
+        if not self.enabled or not self.check_support() or not self.eligible(model):
+            return False
+        self.submitted.append(model)
+        return True
+
+    def prepare(self):
+        """Compile the shaders the first time they're needed."""
+        from shaders import IndirectCullShader, IndirectShader
+
+        self.shader = IndirectShader()
+        self.shader.compile()
+        self.cull_shader = IndirectCullShader()
+        self.cull_shader.compile()
+        self.uniform_locations = {
+            name: gl.glGetUniformLocation(self.shader.program_id, name)
+            for name in (
+                "PV",
+                "V",
+                "view_pos",
+                "light_pos",
+                "Ia",
+                "Id",
+                "Is",
+                "textureObject",
+                "textureArray",
+            )
+        }
+        self.cull_uniform_locations = {
+            name: gl.glGetUniformLocation(self.cull_shader.program_id, name)
+            for name in (
+                "mesh_count",
+                "planes",
+                "camera_position",
+                "pixels_per_unit",
+                "lod_pixel_error",
+                "lod_hysteresis",
+                "use_lods",
+            )
+        }
+        self.vertex_array_object = gl.glGenVertexArrays(1)
+        for name in (
+            "position",
+            "normal",
+            "uv",
+            "draw",
+            "index",
+            "meshes",
+            "mask",
+            "lods",
+            "commands",
+        ):
+            self.buffers[name] = gl.glGenBuffers(1)
+
+    def build(self, models):
+        """Pack the meshes of models into the batch's buffers."""
+        self.models = list(models)
+        self.meshes = [mesh for model in self.models for mesh in model.meshes]
+        self.mask_key = None
+        self.builds += 1
+
+        positions = []
+        normals = []
+        uvs = []
+        indices = []
+        lods = []
+        base_vertex = 0
+        first_index = 0
+        for mesh in self.meshes:
+            positions.append(np.asarray(mesh.vertices, dtype=np.float32))
+            normals.append(np.asarray(mesh.normals, dtype=np.float32))
+            uvs.append(
+                np.zeros((len(mesh.vertices), 2), dtype=np.float32)
+                if mesh.texture_coords is None
+                else np.asarray(mesh.texture_coords, dtype=np.float32)
+            )
+
+            # The simplified levels are only kept in the mesh's index buffer
+            levels = [triangle_indices(mesh.faces)]
+            if len(mesh.lods) > 1:
+                gl.glBindVertexArray(mesh.vertex_array_object)
+                for offset, count, *_ in mesh.lods[1:MAX_LODS]:
+                    levels.append(
+                        np.frombuffer(
+                            gl.glGetBufferSubData(
+                                gl.GL_ELEMENT_ARRAY_BUFFER, offset, count * 4
+                            ),
+                            dtype=np.uint32,
+                        )
+                    )
+                gl.glBindVertexArray(0)
+            mesh_lods = []
+            for level, (*_, error) in zip(levels, mesh.lods, strict=False):
+                mesh_lods.append((first_index, level.size, error))
+                first_index += level.size
+            indices.extend(levels)
+            lods.append((base_vertex, mesh_lods))
+            base_vertex += len(mesh.vertices)
+
+        self.lod_table = lods
+        gl.glBindVertexArray(self.vertex_array_object)
+        for location, (name, arrays) in enumerate((
+            ("position", positions),
+            ("normal", normals),
+            ("uv", uvs),
+        )):
+            data = np.concatenate(arrays)
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers[name])
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, data, gl.GL_STATIC_DRAW)
+            gl.glEnableVertexAttribArray(location)
+            gl.glVertexAttribPointer(
+                location, data.shape[1], gl.GL_FLOAT, gl.GL_FALSE, 0, None
+            )
+
+        # Each mesh is drawn as one instance, starting at its own base instance, so this
+        # reads as the mesh's index
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers["draw"])
+        gl.glBufferData(
+            gl.GL_ARRAY_BUFFER,
+            np.arange(len(self.meshes), dtype=np.uint32),
+            gl.GL_STATIC_DRAW,
+        )
+        gl.glEnableVertexAttribArray(3)
+        gl.glVertexAttribIPointer(3, 1, gl.GL_UNSIGNED_INT, 0, None)
+        gl.glVertexAttribDivisor(3, 1)
+
+        index_data = np.concatenate(indices + [np.zeros(0, dtype=np.uint32)])
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.buffers["index"])
+        gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, index_data, gl.GL_STATIC_DRAW)
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        self.vertex_bytes = sum(
+            np.concatenate(arrays).nbytes for arrays in (positions, normals, uvs)
+        )
+        self.vertex_bytes += index_data.nbytes
+
+        self.upload_meshes()
+        for name, data in (
+            ("lods", np.zeros(len(self.meshes), dtype=np.uint32)),
+            ("commands", np.zeros(len(self.meshes) * COMMAND_SIZE, dtype=np.uint8)),
+        ):
+            gl.glBindBuffer(gl.GL_SHADER_STORAGE_BUFFER, self.buffers[name])
+            gl.glBufferData(gl.GL_SHADER_STORAGE_BUFFER, data, gl.GL_DYNAMIC_DRAW)
+        gl.glBindBuffer(gl.GL_SHADER_STORAGE_BUFFER, 0)
+
+        # Runs of meshes sharing a texture are drawn together
+        self.groups = []
+        first = 0
+        for texture, run in groupby(
+            self.meshes, key=lambda mesh: mesh.textures[0] if mesh.textures else None
+        ):
+            count = len(list(run))
+            self.groups.append((texture, first, count))
+            first += count
+
+    def upload_meshes(self):
+        """Upload the matrices, bounds and materials of the meshes in their current poses."""
+        self.poses = [model.world_pose for model in self.models]
+        meshes = self.meshes
+        data = np.zeros((len(meshes), MESH_DATA_SIZE), dtype=np.float32)
+        ints = data.view(np.int32)
+        if not meshes:
+            self.write_buffer("meshes", data)
+            return
+
+        poses = np.array([mesh.world_pose for mesh in meshes])
+        # Matrices are column major in GLSL
+        data[:, 0:16] = poses.transpose(0, 2, 1).reshape(-1, 16)
+        normal_matrices = np.zeros_like(poses)
+        normal_matrices[:, :3, :3] = np.linalg.inv(poses[:, :3, :3]).transpose(0, 2, 1)
+        data[:, 16:32] = normal_matrices.transpose(0, 2, 1).reshape(-1, 16)
+
+        lower, upper = transform_bounds(
+            np.array([mesh.bounds[0] for mesh in meshes]),
+            np.array([mesh.bounds[1] for mesh in meshes]),
+            poses,
+        )
+        data[:, 32:35] = lower
+        data[:, 36:39] = upper
+
+        scales = np.linalg.norm(poses[:, :3, :3], axis=1).max(axis=1)
+        centres = np.array([mesh.bounding_centre for mesh in meshes])
+        data[:, 40:43] = (
+            np.einsum("nij,nj->ni", poses[:, :3, :3], centres) + poses[:, :3, 3]
+        )
+        data[:, 43] = [mesh.bounding_radius for mesh in meshes] * scales
+
+        for row, (mesh, scale, (base_vertex, mesh_lods)) in enumerate(
+            zip(meshes, scales.tolist(), self.lod_table, strict=True)
+        ):
+            material = mesh.material
+            data[row, 44:47] = material.Ka
+            data[row, 47] = material.Ns
+            data[row, 48:51] = material.Kd
+            data[row, 52:55] = material.Ks
+            for level, (first_index, count, error) in enumerate(mesh_lods):
+                data[row, 56 + level] = error * scale
+                ints[row, 60 + level] = first_index
+                ints[row, 64 + level] = count
+            layer = material.texture_layer
+            ints[row, 68:72] = (
+                base_vertex,
+                len(mesh_lods),
+                1 if mesh.textures else 0,
+                -1 if layer is None else layer,
+            )
+        self.write_buffer("meshes", data)
+
+    def write_buffer(self, name, data):
+        gl.glBindBuffer(gl.GL_SHADER_STORAGE_BUFFER, self.buffers[name])
+        gl.glBufferData(gl.GL_SHADER_STORAGE_BUFFER, data, gl.GL_DYNAMIC_DRAW)
+        gl.glBindBuffer(gl.GL_SHADER_STORAGE_BUFFER, 0)
+
+    def update_mask(self, models, pvs):
+        """Upload which meshes can be drawn, if the models drawn or the camera's view cell
+        have changed since it was last uploaded.
+        """
+        key = (tuple(map(id, models)), pvs.current_cell, id(pvs.bits))
+        if key == self.mask_key:
+            return
+        self.mask_key = key
+
+        drawn = {id(model) for model in models}
+        mask = np.array(
+            [
+                id(model) in drawn
+                for model in self.models
+                for _ in range(len(model.meshes))
+            ],
+            dtype=bool,
+        )
+        if pvs.current_cell is not None:
+            pvs_index = {id(mesh): index for index, mesh in enumerate(pvs.meshes)}
+            indices = np.array([pvs_index.get(id(mesh), -1) for mesh in self.meshes])
+            visible = np.append(pvs.visible(pvs.current_cell), True)
+            mask &= visible[indices]
+        self.write_buffer("mask", mask.astype(np.uint32))
+
+    def flush(self, projection_matrix, view_matrix):
+        """Cull and draw every model submitted since the last flush. Call at the end of each
+        render pass, after the other models are drawn.
+        """
+        if not self.submitted:
+            return
+        models, self.submitted = self.submitted, []
+        if self.shader is None:
+            self.prepare()
+
+        # Imported here, as the mesh module needs the scene module, which creates the renderer
+        from mesh import Mesh
+        from scene import Scene
+
+        scene = Scene.current_scene
+        batched = [model for model in scene.models if self.eligible(model)]
+        if len(batched) != len(self.models) or any(
+            model is not other for model, other in zip(batched, self.models)
+        ):
+            self.build(batched)
+        elif any(
+            model.world_pose is not pose for model, pose in zip(self.models, self.poses)
+        ):
+            self.upload_meshes()
+        self.update_mask(models, scene.pvs)
+
+        for binding, name in enumerate(("meshes", "mask", "lods", "commands")):
+            gl.glBindBufferBase(
+                gl.GL_SHADER_STORAGE_BUFFER, binding, self.buffers[name]
+            )
+
+        # Cull and choose levels of detail
+        gl.glUseProgram(self.cull_shader.program_id)
+        locations = self.cull_uniform_locations
+        camera_position = np.linalg.inv(view_matrix)[:3, 3]
+        gl.glUniform1ui(locations["mesh_count"], len(self.meshes))
+        gl.glUniform4fv(
+            locations["planes"],
+            6,
+            frustum_planes(np.matmul(projection_matrix, view_matrix)).astype("f"),
+        )
+        gl.glUniform3fv(locations["camera_position"], 1, camera_position.astype("f"))
+        gl.glUniform1f(
+            locations["pixels_per_unit"],
+            scene.window_size[0] / (2 * math.tan(math.radians(scene.fov) / 2)),
+        )
+        gl.glUniform1f(locations["lod_pixel_error"], Mesh.lod_pixel_error)
+        gl.glUniform1f(locations["lod_hysteresis"], Mesh.lod_hysteresis)
+        gl.glUniform1i(locations["use_lods"], int(Mesh.use_lods))
+        gl.glDispatchCompute(math.ceil(len(self.meshes) / WORK_GROUP_SIZE), 1, 1)
+        gl.glMemoryBarrier(gl.GL_COMMAND_BARRIER_BIT | gl.GL_SHADER_STORAGE_BARRIER_BIT)
+
+        # Draw
+        self.shader.bind()
+        locations = self.uniform_locations
+        light = scene.light
+        gl.glUniformMatrix4fv(
+            locations["PV"], 1, True, np.matmul(projection_matrix, view_matrix)
+        )
+        gl.glUniformMatrix3fv(locations["V"], 1, True, view_matrix[:3, :3])
+        gl.glUniform3fv(locations["view_pos"], 1, scene.camera.position)
+        gl.glUniform3fv(locations["light_pos"], 1, light.position)
+        gl.glUniform3fv(locations["Ia"], 1, np.array(light.ambient_illumination, "f"))
+        gl.glUniform3fv(locations["Id"], 1, np.array(light.diffuse_illumination, "f"))
+        gl.glUniform3fv(locations["Is"], 1, np.array(light.specular_illumination, "f"))
+        # Samplers of different types always have to be on different units, even if unused
+        gl.glUniform1i(locations["textureObject"], 0)
+        gl.glUniform1i(locations["textureArray"], 1)
+
+        gl.glBindVertexArray(self.vertex_array_object)
+        gl.glBindBuffer(gl.GL_DRAW_INDIRECT_BUFFER, self.buffers["commands"])
+        for texture, first, count in self.groups:
+            if texture is not None:
+                gl.glActiveTexture(gl.GL_TEXTURE0 + texture.texture_unit)
+                texture.bind()
+            gl.glMultiDrawElementsIndirect(
+                gl.GL_TRIANGLES,
+                gl.GL_UNSIGNED_INT,
+                ctypes.c_void_p(first * COMMAND_SIZE),
+                count,
+                0,
+            )
+        self.draw_calls = len(self.groups)
+
+        gl.glBindBuffer(gl.GL_DRAW_INDIRECT_BUFFER, 0)
+        gl.glBindVertexArray(0)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        _, self.enabled = imgui.checkbox("GPU driven drawing", self.enabled)
+        if self.supported is False:
+            imgui.text("Needs OpenGL 4.3")
+            return
+        imgui.text(
+            f"{len(self.meshes)} meshes of {len(self.models)} static models,"
+            f" {self.draw_calls} multi-draw calls"
+        )
+        imgui.text(
+            f"{self.vertex_bytes // 1024}KiB of vertices and indices,"
+            f" built {self.builds} times"
+        )
@@ -4,22 +4,61 @@ import time
 
 import imgui
 import numpy as np
-import pygame
 import quaternion
 from geomdl import BSpline, exchange, knotvector
 from OpenGL import GL as gl
 
+from allocations import AllocationTracker
+from animation import ROTATION, AnimationClip, Track
 from camera import Camera, FreeCamera, OrbitCamera
+from entity import get_name
 from environment_mapping import EnvironmentMappingTexture
+from mesh import Mesh
 from model import Model
 from scene import Scene
 from shaders import EnvironmentShader, Shader
 from skybox import SkyBox
+from streaming import StreamedModel
+from texture import TextureRegistry
+from texture_array import TextureArray
+from texture_cache import DecodedImageCache
+from tracing import Tracer
+
+
+def wing_flap_clip(name: str, down_pose) -> AnimationClip:
+    """Create a looping two second animation of a wing flapping between resting and `down_pose`."""
+    wing_resting_pose = np.quaternion(1.0, 0.0, 0.0, 0.0)
+
+    # Sample a trigonometric function to define the easing of the wing flaps
+    times = np.linspace(0.0, 2.0, 17)
+    flap_amount = 0.5 * np.cos(np.pi * times) + 0.5
+
+    # Spherical Linear interpolation between start and end pose
+    # https://en.wikipedia.org/wiki/Slerp
+    rotations = [
+        quaternion.slerp_evaluate(wing_resting_pose, down_pose, amount)
+        for amount in flap_amount
+    ]
+
+    return AnimationClip(name, [Track(ROTATION, times, rotations)])
+
+
+def clock_hand_clip(name: str, direction) -> AnimationClip:
+    """Create a clip that sweeps a clock hand once around a face pointing in `direction`.
+    The clip lasts 1 second, so the playback time is the fraction of the way around the dial.
+    """
+    # A keyframe every quarter turn, slerp fills in the rotation between them
+    fractions = np.linspace(0.0, 1.0, 5)
+    rotations = [
+        direction * quaternion.from_rotation_vector([-fraction * 2 * np.pi, 0, 0])
+        for fraction in fractions
+    ]
+    return AnimationClip(name, [Track(ROTATION, fractions, rotations)])
 
 
 class MainScene(Scene):
-    def __init__(self):
-        Scene.__init__(self)
+    def __init__(self, **kwargs):
+        Scene.__init__(self, **kwargs)
         self.light.position = (-0.2, -1.0, -0.3)
 
         self.reflection_camera = Camera(position=(35, 5, -45))
@@ -29,8 +68,11 @@ class MainScene(Scene):
 
         SkyBox()
 
-        Model.from_obj("london.obj")
-        Model.from_obj("shard.obj", shader=EnvironmentShader())
+        if StreamedModel.enabled:
+            StreamedModel("london.obj")
+        else:
+            Model.from_obj("london.obj", static=True)
+        Model.from_obj("shard.obj", shader=EnvironmentShader(), static=True)
 
         #
         # Define the parts for the dinosaur
@@ -47,6 +89,18 @@ class MainScene(Scene):
         self.dino_right_wing = Model.from_obj(
             "dino_right.obj", position=(-2.5, 0, 2), parent=self.dino
         )
+        self.animations.bind(
+            wing_flap_clip(
+                "left_wing_flap", quaternion.from_rotation_vector((0, 0, -np.pi / 4))
+            ),
+            self.dino_left_wing,
+        )
+        self.animations.bind(
+            wing_flap_clip(
+                "right_wing_flap", quaternion.from_rotation_vector((0, 0, np.pi / 4))
+            ),
+            self.dino_right_wing,
+        )
 
         # Creates a piecewise polynomial to represent the dinosaurs path.
         # See lecture Week 9 Lecture 1, https://en.wikipedia.org/wiki/B-spline,
@@ -92,53 +146,55 @@ class MainScene(Scene):
             "minute_hand.obj", name="face3_minute", position=face3_center
         )
 
-        # Load the credits into memory to display on the GUI
-        with open("./credits.txt", encoding="utf-8") as credits_list:
-            self.credits = credits_list.read()
-
-    def run(self):
-        """Run the scene each tick. No rendering is done, but any moving entities/interactions should be calculated."""
-
-        #
-        # Wing animations
-        #
-
-        # Animation parameter
-        t = 500 * np.cos((np.pi / 1000) * pygame.time.get_ticks()) + 500
-        # Trigonometric function to define animation of wing flaps
-
-        wing_resting_pose = np.quaternion(1.0, 0.0, 0.0, 0.0)
-        left_wing_down_pose = quaternion.from_rotation_vector((0, 0, -np.pi / 4))
-        right_wing_down_pose = quaternion.from_rotation_vector((0, 0, np.pi / 4))
+        # Clock hands are driven by the wall clock, so their playback time is set manually.
+        # Replace `wall_clock` with a function returning a fixed time for reproducible runs.
+        self.wall_clock = time.localtime
+        face_directions = [
+            np.quaternion(1.0, 0.0, 0.0, 0.0),
+            quaternion.from_rotation_vector([0, np.pi / 2, 0]),
+            quaternion.from_rotation_vector([0, np.pi, 0]),
+        ]
+        face_clips = [
+            clock_hand_clip(f"clock_face{i + 1}", direction)
+            for i, direction in enumerate(face_directions)
+        ]
+        self.hour_hands = [
+            self.animations.bind(clip, hand, speed=0.0)
+            for clip, hand in zip(
+                face_clips, [self.face1_hour, self.face2_hour, self.face3_hour]
+            )
+        ]
+        self.minute_hands = [
+            self.animations.bind(clip, hand, speed=0.0)
+            for clip, hand in zip(
+                face_clips, [self.face1_minute, self.face2_minute, self.face3_minute]
+            )
+        ]
 
-        flap_start = 0
-        flap_end = 1000  # Take this many milliseconds to rotate
+        # Blend everything the simulation moves when rendering between steps
+        for entity in [self.dino, self.dino_left_wing, self.dino_right_wing]:
+            self.interpolation.track(entity)
 
-        # Spherical Linear interpolation between start and end pose
-        # https://en.wikipedia.org/wiki/Slerp
-        left_wing_rotation = quaternion.slerp(
-            wing_resting_pose, left_wing_down_pose, flap_start, flap_end, t
-        )
-        right_wing_rotation = quaternion.slerp(
-            wing_resting_pose, right_wing_down_pose, flap_start, flap_end, t
+        # The clock hands can only move when the minute changes
+        self.scheduler.every_frame("Dinosaur path", self.update_dino_path)
+        self.scheduler.on_change(
+            "Clock hands", self.update_clock_hands, key=lambda: self.wall_clock().tm_min
         )
 
-        self.dino_left_wing.rotation = left_wing_rotation
-        self.dino_right_wing.rotation = right_wing_rotation
+        self.pvs.load(self.static_meshes())
 
-        #
-        # Dinosaur Path/Movement Animations
-        #
+        # Load the credits into memory to display on the GUI
+        with open("./credits.txt", encoding="utf-8") as credits_list:
+            self.credits = credits_list.read()
 
+    def update_dino_path(self, delta_time: float):
+        """Move the dinosaur along its path. Runs every simulation step."""
         # Animation parameter
-        t = (pygame.time.get_ticks() / 30000) % 1
+        t = (self.simulation_time / 30) % 1
 
         # Calculate path and its 1st derivative (normal)
         path_derivatives = self.dino_path.derivatives(t, order=1)
 
-        # 0th derivative at t, i.e. the original function at t
-        self.dino.position = path_derivatives[0]
-
         # Path normal, aka forward vector on the path
         forward = path_derivatives[1] / np.linalg.norm(path_derivatives[1])
 
@@ -155,36 +211,23 @@ class MainScene(Scene):
         rotation[:, 1] = up
         rotation[:, 2] = forward
 
-        self.dino.rotation = quaternion.from_rotation_matrix(rotation)
+        # 0th derivative at t, i.e. the original function at t
+        self.dino.set_transform(
+            position=path_derivatives[0],
+            rotation=quaternion.from_rotation_matrix(rotation),
+        )
 
-        #
-        # Big Ben Clock hand animations
-        #
-        t = time.localtime()
+    def update_clock_hands(self, delta_time: float):
+        """Point the Big Ben clock hands at the current time. Only runs when the minute changes."""
+        t = self.wall_clock()
 
         minute_decimal = t.tm_min / 60
         hour_decimal = ((t.tm_hour % 12) / 12) + (minute_decimal / 10)
 
-        minute_rotation = quaternion.from_rotation_vector([
-            -minute_decimal * 2 * np.pi, 0, 0
-        ])
-        hour_rotation = quaternion.from_rotation_vector([
-            -hour_decimal * 2 * np.pi, 0, 0
-        ])
-
-        face2_direction = quaternion.from_rotation_vector([0, np.pi / 2, 0])
-        face3_direction = quaternion.from_rotation_vector([0, np.pi, 0])
-
-        self.face1_hour.rotation = hour_rotation
-        self.face1_minute.rotation = minute_rotation
-
-        self.face2_hour.rotation = face2_direction * hour_rotation
-        self.face2_minute.rotation = face2_direction * minute_rotation
-
-        self.face3_hour.rotation = face3_direction * hour_rotation
-        self.face3_minute.rotation = face3_direction * minute_rotation
-
-        super().run()
+        for hour_hand in self.hour_hands:
+            hour_hand.time = hour_decimal
+        for minute_hand in self.minute_hands:
+            minute_hand.time = minute_decimal
 
     def draw(self):
         """
@@ -193,15 +236,36 @@ class MainScene(Scene):
         """
         self.camera.update()
 
-        self.environment.update()
+        with self.gpu_timer.render_pass("environment probe"):
+            self.environment.update()
 
-        for model in self.models:
-            model.draw()
+        self.draw_models()
 
         # Unbind the shader
         gl.glUseProgram(0)
         Shader.current_shader = 0
 
+    def prepare_frame(self):
+        with self.gpu_timer.render_pass("environment probe"):
+            self.environment.update()
+
+    def draw_snapshot(self, snapshot):
+        super().draw_snapshot(snapshot)
+
+        # Unbind the shader
+        gl.glUseProgram(0)
+        Shader.current_shader = 0
+
+    def looking_at(self) -> str | None:
+        """Name of the nearest model whose bounds are in the middle of the view."""
+        inverse_view = np.linalg.inv(self.camera.view_matrix)
+        for mesh, _ in self.spatial_index.meshes_along_ray(
+            inverse_view[:3, 3], -inverse_view[:3, 2], self.far_clipping
+        ):
+            if mesh.parent.pickable:
+                return get_name(mesh.parent)
+        return None
+
     def debug_menu(self):
         """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
         with imgui.begin("Menu", flags=imgui.WINDOW_ALWAYS_AUTO_RESIZE):
@@ -212,7 +276,16 @@ class MainScene(Scene):
             )
 
             if imgui.tree_node("Settings"):
-                _, self.fps_max = imgui.slider_float("Max FPS", self.fps_max, 15, 600)
+                _, self.fps_max = imgui.slider_float(
+                    "Max FPS (0 = uncapped)", self.fps_max, 0, 600
+                )
+                _, self.simulation_rate = imgui.slider_int(
+                    "Simulation rate", self.simulation_rate, 10, 240
+                )
+                vsync_changed, self.vsync = imgui.checkbox("VSync", self.vsync)
+                _, self.pipelined = imgui.checkbox(
+                    "Simulate on worker thread", self.pipelined
+                )
 
                 _, self.x_sensitivity = imgui.slider_float(
                     "Horizontal mouse sensitivity", self.x_sensitivity, -10, 10
@@ -229,7 +302,12 @@ class MainScene(Scene):
                 )
                 fov_changed, self.fov = imgui.slider_float("FOV", self.fov, 30, 150)
 
-                if near_clip_changed or far_clip_changed or fov_changed:
+                if (
+                    near_clip_changed
+                    or far_clip_changed
+                    or fov_changed
+                    or vsync_changed
+                ):
                     self.update_viewport()
 
                 imgui.tree_pop()
@@ -246,6 +324,72 @@ class MainScene(Scene):
                     scale_min=0.0,
                 )
 
+                if imgui.tree_node("Frame timing"):
+                    self.frame_timing_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Tracing"):
+                    Tracer.current_tracer.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Spike capture"):
+                    self.spike_detector.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Memory"):
+                    AllocationTracker.current_tracker.debug_menu()
+                    imgui.separator()
+                    self.gc_policy.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Updates"):
+                    self.scheduler.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Textures"):
+                    TextureRegistry.current_registry.debug_menu()
+                    TextureArray.debug_menu()
+                    imgui.separator()
+                    DecodedImageCache.current_cache.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Spatial index"):
+                    _, self.frustum_culling = imgui.checkbox(
+                        "Frustum culling", self.frustum_culling
+                    )
+                    self.spatial_index.debug_menu()
+                    imgui.text(f"Looking at: {self.looking_at()}")
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Potentially visible sets"):
+                    self.pvs.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Occlusion culling"):
+                    self.occlusion.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("GPU driven drawing"):
+                    self.indirect.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Command lists"):
+                    self.command_lists.debug_menu()
+                    imgui.tree_pop()
+
+                if imgui.tree_node("Level of detail"):
+                    _, Mesh.use_lods = imgui.checkbox(
+                        "Use levels of detail", Mesh.use_lods
+                    )
+                    _, Mesh.lod_pixel_error = imgui.slider_float(
+                        "Error (pixels)", Mesh.lod_pixel_error, 0.1, 20.0
+                    )
+                    _, Mesh.lod_hysteresis = imgui.slider_float(
+                        "Hysteresis", Mesh.lod_hysteresis, 0.0, 0.9
+                    )
+                    imgui.text(f"{self.last_triangles_drawn} triangles drawn")
+                    imgui.tree_pop()
+
                 wireframe_changed, self.wireframe = imgui.checkbox(
                     "Wireframe", self.wireframe
                 )
@@ -257,9 +401,24 @@ class MainScene(Scene):
                 imgui.tree_pop()
 
             imgui.separator()
+            # Open the menu of a model that's just been picked, and close the rest
+            selection_changed = self.selection_changed
+            self.selection_changed = False
+            if selection_changed and self.selected_model is not None:
+                imgui.set_next_item_open(True, imgui.ALWAYS)
             if imgui.tree_node("Models"):
+                imgui.text("Right click on a model to select it")
+                if self.last_pick is not None:
+                    imgui.text(
+                        f"Selected: {get_name(self.selected_model)}"
+                        f" ({self.last_pick.elapsed * 1000:.3f}ms to pick)"
+                    )
                 # Render every models debug menu
                 for model in self.models:
+                    if selection_changed:
+                        imgui.set_next_item_open(
+                            model is self.selected_model, imgui.ALWAYS
+                        )
                     if imgui.tree_node(model.name):
                         model.debug_menu()
                         imgui.tree_pop()
@@ -287,6 +446,27 @@ class MainScene(Scene):
             if imgui.button("Quit"):
                 self.running = False
 
+    def frame_timing_menu(self):
+        """Show the CPU time of each frame phase next to the GPU time of each render pass."""
+        phases = self.timer.last_frame_phases
+        for name, seconds in phases.items():
+            imgui.text(f"{name}: {seconds * 1000:.3f}ms")
+
+        # Presenting waits for the GPU, so it isn't CPU work
+        cpu_time = sum(seconds for name, seconds in phases.items() if name != "present")
+        imgui.text(f"CPU total: {cpu_time * 1000:.3f}ms")
+
+        imgui.separator()
+        self.gpu_timer.debug_menu()
+
+        if self.gpu_timer.enabled and self.gpu_timer.timestamps_supported:
+            bound = "GPU" if self.gpu_timer.frame_time > cpu_time else "CPU"
+            imgui.text(f"Likely {bound} bound")
+
+        imgui.separator()
+        imgui.text("Since startup:")
+        self.telemetry.debug_menu()
+
 
 # Run the scene if this file is called
 if __name__ == "__main__":
@@ -12,6 +12,7 @@ class Material:
         Ks: list[float] = None,
         Ns=10.0,
         texture=None,
+        texture_layer=None,
     ):
         """Create a new Material.
 
@@ -22,6 +23,8 @@ class Material:
             Ks (list[float], optional): The material specular. Defaults to None.
             Ns (float, optional): _description_. Defaults to 10.0.
             texture (Texture, optional): The image texture. Defaults to None.
+            texture_layer (int, optional): The layer of the image, if the texture is a texture
+                array. Defaults to None.
         """
         self.name = name
         self.Ka = Ka if Ka is not None else [1.0, 1.0, 1.0]
@@ -29,6 +32,7 @@ class Material:
         self.Ks = Ks if Ks is not None else [1.0, 1.0, 1.0]
         self.Ns = Ns if Ns is not None else [1.0, 1.0, 1.0]
         self.texture = texture
+        self.texture_layer = texture_layer
 
 
 class MaterialLibrary:
@@ -1,12 +1,74 @@
+import ctypes
+import math
+
 import numpy as np
 from OpenGL import GL as gl
 
+import asset_cache
 from entity import Entity
 from material import Material
 from math_utils import scale_matrix, translation_matrix
+from mesh_optimise import VERTEX_CACHE_SIZE, optimise_triangles
 from scene import Scene
 from shaders import CartoonShader, EnvironmentShader, Shader
-from texture import Texture
+from simplify import simplify_lods
+from texture import Texture, TextureRegistry
+from tracing import traced
+
+# Names of the uniforms set by `Mesh.set_uniforms` in the shaders, by their key in
+# `Mesh.uniform_locations`
+UNIFORM_NAMES = {
+    "view_pos": "view_pos",
+    "light_pos": "light_pos",
+    "model": "model",
+    "pvm": "PVM",
+    "vm": "VM",
+    "vt": "VT",
+    "vmit": "VMiT",
+    "texture_object": "textureObject",
+    "has_texture": "has_texture",
+    "texture_array": "textureArray",
+    "texture_layer": "texture_layer",
+    "ambient": "Ka",
+    "diffuse": "Kd",
+    "specular": "Ks",
+    "specular_exponent": "Ns",
+    "ambient_illumination": "Ia",
+    "diffuse_illumination": "Id",
+    "specular_illumination": "Is",
+}
+
+
+def uniform_matrices(world_pose, view_matrix, projection_matrix):
+    """Calculate the matrices passed to the shaders for a mesh.
+
+    Returns:
+        tuple: The view-model matrix, projection-view-model matrix, inverse transpose of the
+            view-model matrix (for normals) and the transposed view rotation.
+    """
+    vm = np.matmul(view_matrix, world_pose)
+    pvm = np.matmul(projection_matrix, vm)
+    vmit = np.linalg.inv(vm)[:3, :3].transpose()
+    vt = view_matrix.transpose()[:3, :3]
+    return vm, pvm, vmit, vt
+
+
+def vertex_normals(vertices, faces) -> np.ndarray:
+    """Vertex normals as the area weighted average of the normals of the faces around them,
+    like `Mesh.calculate_normals` but without looping over faces in Python.
+
+    Returns:
+        NDArray: (vertices, 3) float32 unit normals
+    """
+    corners = vertices[faces[:, :3]]
+    face_normals = np.cross(
+        corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    )
+    normals = np.zeros((len(vertices), 3))
+    for corner in range(faces.shape[1]):
+        np.add.at(normals, faces[:, corner], face_normals)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, lengths, out=normals, where=lengths > 0).astype("f")
 
 
 class Mesh(Entity):
@@ -15,6 +77,21 @@ class Mesh(Entity):
     and normals.
     """
 
+    # Reorder the triangles and vertices of meshes loaded from files, see `mesh_optimise`
+    optimise_on_import = True
+    # Generate simplified levels of detail for meshes loaded from files, see `generate_lods`
+    generate_lods_on_import = True
+    # Fraction of the triangles kept by each level of detail
+    lod_ratios = (0.5, 0.25, 0.125)
+    # Meshes smaller than this aren't worth simplifying
+    lod_min_triangles = 512
+    # Choose the simplest level of detail whose error is at most this many pixels on screen
+    use_lods = True
+    lod_pixel_error = 1.0
+    # Only switch to a simpler level once its error is this fraction below the limit, so
+    # meshes near the limit don't flicker between levels
+    lod_hysteresis = 0.25
+
     def __init__(
         self,
         vertices=None,
@@ -64,7 +141,7 @@ class Mesh(Entity):
             texture = (
                 material.texture
                 if isinstance(material.texture, Texture)
-                else Texture(material.texture)
+                else TextureRegistry.current_registry.acquire(material.texture)
             )
             self.textures.append(texture)
 
@@ -72,6 +149,30 @@ class Mesh(Entity):
         if self.faces.shape[1] == 4:
             self.primitive = gl.GL_QUADS
 
+        # Bounding box, for the scene's spatial index
+        self.bounds = np.array([self.vertices.min(axis=0), self.vertices.max(axis=0)])
+
+        # Whether the mesh was hidden behind others when the occlusion culler last checked,
+        # and its query that hasn't been read back yet
+        self.occluded = False
+        self.occlusion_query = None
+
+        # Bounding sphere, for choosing levels of detail
+        self.bounding_centre = (
+            self.vertices.min(axis=0) + self.vertices.max(axis=0)
+        ) / 2
+        self.bounding_radius = float(
+            np.linalg.norm(self.vertices - self.bounding_centre, axis=1).max()
+        )
+
+        # Levels of detail in the index buffer as (byte offset, index count, primitive,
+        # error), starting with the full mesh
+        self.lods = [(0, self.faces.size, self.primitive, 0.0)]
+        self.lod = 0
+
+        # BVH over the triangles for picking, built the first time the mesh is picked
+        self.triangle_bvh = None
+
         self.bind()
         self.bind_shader(self.shader)
 
@@ -120,68 +221,23 @@ class Mesh(Entity):
             self.tangents /= np.linalg.norm(self.tangents, axis=1, keepdims=True)
             self.binormals /= np.linalg.norm(self.binormals, axis=1, keepdims=True)
 
-    def set_uniforms(self):
+    @traced
+    def set_uniforms(self, world_pose=None):
         camera = Scene.current_scene.camera
         projection_matrix = Scene.current_scene.projection_matrix
         view_matrix = camera.view_matrix
         light = Scene.current_scene.light
 
-        vm = np.matmul(view_matrix, self.world_pose)
-        pvm = np.matmul(projection_matrix, vm)
-        vmit = np.linalg.inv(vm)[:3, :3].transpose()
-        vt = view_matrix.transpose()[:3, :3]
+        if world_pose is None:
+            world_pose = self.world_pose
+
+        vm, pvm, vmit, vt = uniform_matrices(world_pose, view_matrix, projection_matrix)
 
         if not bool(self.uniform_locations):
             # If location dict is empty
             self.uniform_locations = {
-                "view_pos": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="view_pos"
-                ),
-                "light_pos": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="light_pos"
-                ),
-                "model": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="model"
-                ),
-                "pvm": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="PVM"
-                ),
-                "vm": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="VM"
-                ),
-                "vt": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="VT"
-                ),
-                "vmit": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="VMiT"
-                ),
-                "texture_object": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="textureObject"
-                ),
-                "has_texture": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="has_texture"
-                ),
-                "ambient": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="Ka"
-                ),
-                "diffuse": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="Kd"
-                ),
-                "specular": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="Ks"
-                ),
-                "specular_exponent": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="Ns"
-                ),
-                "ambient_illumination": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="Ia"
-                ),
-                "diffuse_illumination": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="Id"
-                ),
-                "specular_illumination": gl.glGetUniformLocation(
-                    program=self.shader.program_id, name="Is"
-                ),
+                key: gl.glGetUniformLocation(program=self.shader.program_id, name=name)
+                for key, name in UNIFORM_NAMES.items()
             }
 
         if isinstance(self.shader, EnvironmentShader):
@@ -196,7 +252,7 @@ class Mesh(Entity):
 
         gl.glUniform3fv(self.uniform_locations["view_pos"], 1, camera.position)
 
-        gl.glUniformMatrix4fv(self.uniform_locations["model"], 1, True, self.world_pose)
+        gl.glUniformMatrix4fv(self.uniform_locations["model"], 1, True, world_pose)
 
         gl.glUniformMatrix4fv(self.uniform_locations["pvm"], 1, True, pvm)
 
@@ -206,9 +262,15 @@ class Mesh(Entity):
 
         gl.glUniformMatrix3fv(self.uniform_locations["vt"], 1, True, vt)
 
+        # Samplers of different types always have to be on different units, even if unused
+        gl.glUniform1i(self.uniform_locations["texture_object"], 0)
+        gl.glUniform1i(self.uniform_locations["texture_array"], 1)
         if len(self.textures) > 0:
-            gl.glUniform1i(self.uniform_locations["texture_object"], 0)
             gl.glUniform1i(self.uniform_locations["has_texture"], 1)
+            layer = self.material.texture_layer
+            gl.glUniform1i(
+                self.uniform_locations["texture_layer"], -1 if layer is None else layer
+            )
         else:
             gl.glUniform1i(self.uniform_locations["has_texture"], 0)
 
@@ -244,38 +306,178 @@ class Mesh(Entity):
             np.array(light.specular_illumination, "f"),
         )
 
-    def draw(self):
-        """Draw the mesh to the window"""
+    def draw(self, world_pose=None):
+        """Draw the mesh to the window
+
+        Args:
+            world_pose (NDArray, optional): Draw with this world pose instead of the current one.
+        """
         gl.glBindVertexArray(self.vertex_array_object)
 
         self.shader.bind()
-        self.set_uniforms()
+        self.set_uniforms(world_pose)
 
         for offset, texture in enumerate(self.textures):
-            gl.glActiveTexture(gl.GL_TEXTURE0 + offset)
+            gl.glActiveTexture(gl.GL_TEXTURE0 + texture.texture_unit + offset)
             texture.bind()
 
         if self.faces is not None:
+            offset, count, primitive, _ = self.lods[self.lod]
             gl.glDrawElements(
-                self.primitive,
-                self.faces.flatten().shape[0],
-                gl.GL_UNSIGNED_INT,
-                None,
+                primitive, count, gl.GL_UNSIGNED_INT, ctypes.c_void_p(offset)
+            )
+            Scene.current_scene.triangles_drawn += (
+                count // 4 * 2 if primitive == gl.GL_QUADS else count // 3
             )
         else:
             gl.glDrawArrays(self.primitive, 0, self.vertices.shape[0])
 
         gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        if self.textures and self.textures[-1].texture_unit != 0:
+            gl.glActiveTexture(gl.GL_TEXTURE0)
         gl.glBindVertexArray(0)
 
+    @classmethod
+    def lod_arrays(
+        cls, vertices, faces, normals, texture_coords=None
+    ) -> dict[str, np.ndarray] | None:
+        """Simplify a mesh into the levels of detail in `lod_ratios`, through the asset cache.
+        Doesn't touch OpenGL, so it can run on another thread before the mesh is created.
+
+        Returns:
+            dict[str, NDArray] | None: The indices of every level one after another, with the
+                index count and error of each, or None if the mesh is too small to simplify
+        """
+        if faces is None or len(faces) < cls.lod_min_triangles:
+            return None
+
+        # Normals and UVs choose between copies of vertices on seams
+        attributes = np.concatenate(
+            [
+                attribute
+                for attribute in (normals, texture_coords)
+                if attribute is not None
+            ],
+            axis=1,
+        )
+        key = asset_cache.content_key(
+            vertices,
+            faces,
+            attributes,
+            ratios=cls.lod_ratios,
+            optimise=cls.optimise_on_import and VERTEX_CACHE_SIZE,
+        )
+        arrays = asset_cache.load_arrays("lods", key)
+        if arrays is None:
+            lods = simplify_lods(vertices, faces, cls.lod_ratios, attributes=attributes)
+            if cls.optimise_on_import:
+                lods = [
+                    (optimise_triangles(vertices, triangles), error)
+                    for triangles, error in lods
+                ]
+            arrays = {
+                "indices": np.concatenate(
+                    [triangles.reshape(-1) for triangles, _ in lods]
+                    + [np.zeros(0, dtype=np.uint32)]
+                ),
+                "counts": np.array(
+                    [triangles.size for triangles, _ in lods], dtype=int
+                ),
+                "errors": np.array([error for _, error in lods], dtype=float),
+            }
+            asset_cache.save_arrays("lods", key, arrays)
+        return arrays
+
+    def generate_lods(self, arrays: dict[str, np.ndarray] | None = None):
+        """Simplify the mesh into the levels of detail in `lod_ratios`, and add them to the
+        end of the index buffer. Simplified meshes are saved in the asset cache, so this is only
+        slow the first time a mesh is loaded.
+
+        Args:
+            arrays (dict[str, NDArray], optional): Levels of detail already made by
+                `lod_arrays`. Defaults to making them now.
+        """
+        if arrays is None:
+            arrays = self.lod_arrays(
+                self.vertices, self.faces, self.normals, self.texture_coords
+            )
+        if arrays is None:
+            return
+
+        offset = self.faces.nbytes
+        self.lods = self.lods[:1]
+        for count, error in zip(arrays["counts"].tolist(), arrays["errors"].tolist()):
+            self.lods.append((offset, count, gl.GL_TRIANGLES, error))
+            offset += count * 4
+        self.lod = 0
+
+        # The element buffer is part of the vertex array's state
+        gl.glBindVertexArray(self.vertex_array_object)
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+        gl.glBufferData(
+            gl.GL_ELEMENT_ARRAY_BUFFER,
+            np.concatenate([
+                self.faces.reshape(-1).astype(np.uint32),
+                arrays["indices"].astype(np.uint32),
+            ]),
+            gl.GL_STATIC_DRAW,
+        )
+        gl.glBindVertexArray(0)
+
+    def select_lod(self, world_pose=None):
+        """Choose the simplest level of detail that looks the same as the full mesh from the
+        current camera, from the size of its error on screen.
+
+        Args:
+            world_pose (NDArray, optional): Choose for this world pose instead of the current one.
+        """
+        if not self.use_lods or len(self.lods) == 1:
+            self.lod = 0
+            return
+
+        if world_pose is None:
+            world_pose = self.world_pose
+        scene = Scene.current_scene
+
+        # Distance from the camera to the nearest point of the bounding sphere
+        centre = np.matmul(
+            np.matmul(scene.camera.view_matrix, world_pose),
+            np.append(self.bounding_centre, 1.0),
+        )
+        scale = float(np.linalg.norm(world_pose[:3, :3], axis=0).max())
+        distance = float(np.linalg.norm(centre[:3])) - self.bounding_radius * scale
+        if distance <= 0:
+            self.lod = 0
+            return
+
+        # The field of view is horizontal
+        pixels_per_unit = scene.window_size[0] / (
+            2 * distance * math.tan(math.radians(scene.fov) / 2)
+        )
+        errors = [error * scale * pixels_per_unit for *_, error in self.lods]
+
+        lod = min(self.lod, len(self.lods) - 1)
+        while lod > 0 and errors[lod] > self.lod_pixel_error:
+            lod -= 1
+        while lod + 1 < len(self.lods) and errors[lod + 1] <= self.lod_pixel_error * (
+            1 - self.lod_hysteresis
+        ):
+            lod += 1
+        self.lod = lod
+
     def vbo__del__(self):
         """
         Release all VBO objects when finished.
         """
-        for vbo in self.vertex_buffer_objects.items():
-            gl.glDeleteBuffers(1, vbo)
+        for vbo in self.vertex_buffer_objects.values():
+            gl.glDeleteBuffers(1, [vbo])
+        if self.index_buffer is not None:
+            gl.glDeleteBuffers(1, [self.index_buffer])
 
-        gl.glDeleteVertexArrays(1, self.vertex_array_object.tolist())
+        gl.glDeleteVertexArrays(1, [self.vertex_array_object])
+
+        for texture in self.textures:
+            TextureRegistry.current_registry.release(texture)
 
     def bind(self):
         """
@@ -339,6 +541,12 @@ class Mesh(Entity):
         gl.glBufferData(gl.GL_ARRAY_BUFFER, data, gl.GL_STATIC_DRAW)
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
 
+    def clear_entity_cache(self):
+        super().clear_entity_cache()
+        # The spatial index refits the mesh's bounds to its new pose
+        if Scene.current_scene is not None:
+            Scene.current_scene.spatial_index.moved(self)
+
     def bind_shader(self, shader: Shader):
         """
         If a new shader is bound, we need to re-link it to ensure attributes are correctly linked.
@@ -0,0 +1,321 @@
+"""Reordering index and vertex buffers so meshes draw faster.
+
+OBJ files list faces in whatever order the modelling tool saved them, which makes the GPU
+transform the same vertices again and again and draw hidden triangles before the ones in front
+of them. Meshes are optimised in three steps, after Sander, Nehab and Barczak's "Fast Triangle
+Reordering for Vertex Locality and Reduced Overdraw":
+
+1. Tipsify orders triangles so vertices are reused while they're still in the post-transform
+   vertex cache.
+2. The ordered triangles are split into clusters, where cache use is still good within each
+   cluster, and the clusters are sorted so the ones facing out from the middle of the mesh, the
+   ones most likely to hide others, are drawn first.
+3. Vertices are renumbered in the order the triangles first use them, so the vertex buffers
+   are read front to back.
+
+Run this file to report the average cache miss ratio (ACMR), the number of vertices transformed
+per triangle, of the models before and after optimising them.
+"""
+
+import argparse
+import glob
+import os
+import sys
+from collections import deque
+
+import numpy as np
+
+import asset_cache
+
+# Entries of the post-transform vertex cache that's optimised for. Real caches differ, but
+# orders that are good for one size are good for others.
+VERTEX_CACHE_SIZE = 16
+# Clusters for overdraw sorting are split wherever this does not make the ACMR more than this
+# many times worse than Tipsify's
+OVERDRAW_THRESHOLD = 1.05
+
+
+def acmr(triangles, cache_size=VERTEX_CACHE_SIZE) -> float:
+    """Average cache miss ratio of drawing triangles with a FIFO vertex cache.
+
+    Returns:
+        float: Vertices transformed per triangle, from 3 with no reuse to about 0.5 for a
+            large regular grid
+    """
+    cache = deque()
+    cached = set()
+    misses = 0
+    for vertex in np.asarray(triangles).reshape(-1).tolist():
+        if vertex in cached:
+            continue
+        misses += 1
+        if len(cache) == cache_size:
+            cached.discard(cache.popleft())
+        cache.append(vertex)
+        cached.add(vertex)
+    return misses / max(len(triangles), 1)
+
+
+def tipsify(
+    triangles, vertex_count: int, cache_size=VERTEX_CACHE_SIZE
+) -> tuple[np.ndarray, list[int]]:
+    """Order triangles for the vertex cache by fanning around vertices, choosing the next
+    vertex to fan around from those that will still be in the cache.
+
+    Args:
+        triangles (NDArray): (triangles, 3) vertex indices
+        vertex_count (int): Number of vertices
+        cache_size (int, optional): Vertex cache entries. Defaults to VERTEX_CACHE_SIZE.
+
+    Returns:
+        tuple[NDArray, list[int]]: The reordered triangles, and where in them the order jumped
+            to a vertex that isn't in the cache
+    """
+    triangles = np.asarray(triangles)
+    corners = triangles.tolist()
+
+    # Triangles using each vertex
+    flat = triangles.reshape(-1)
+    by_vertex = np.argsort(flat, kind="stable") // 3
+    starts = np.concatenate([[0], np.cumsum(np.bincount(flat, minlength=vertex_count))])
+    adjacency = [
+        by_vertex[start:end].tolist()
+        for start, end in zip(starts[:-1].tolist(), starts[1:].tolist())
+    ]
+
+    live = [len(triangle_list) for triangle_list in adjacency]
+    cache_time = [0] * vertex_count
+    time = cache_size + 1
+    emitted = [False] * len(corners)
+    dead_ends = []
+    cursor = 0
+
+    order = []
+    jumps = []
+    fan = 0 if vertex_count else -1
+    while fan >= 0:
+        candidates = []
+        for triangle in adjacency[fan]:
+            if emitted[triangle]:
+                continue
+            emitted[triangle] = True
+            order.append(triangle)
+            for vertex in corners[triangle]:
+                dead_ends.append(vertex)
+                candidates.append(vertex)
+                live[vertex] -= 1
+                if time - cache_time[vertex] > cache_size:
+                    cache_time[vertex] = time
+                    time += 1
+
+        # Fan around the candidate that has been in the cache longest, as long as fanning
+        # around it won't push it out
+        fan = -1
+        best_priority = -1
+        for vertex in candidates:
+            if live[vertex] == 0:
+                continue
+            priority = 0
+            if time - cache_time[vertex] + 2 * live[vertex] <= cache_size:
+                priority = time - cache_time[vertex]
+            if priority > best_priority:
+                fan = vertex
+                best_priority = priority
+        if fan >= 0:
+            continue
+
+        # Dead end, go back to a recently used vertex, or failing that the next unused one
+        jumps.append(len(order))
+        while dead_ends:
+            vertex = dead_ends.pop()
+            if live[vertex] > 0:
+                fan = vertex
+                break
+        else:
+            while cursor < vertex_count:
+                if live[cursor] > 0:
+                    fan = cursor
+                    break
+                cursor += 1
+
+    return triangles[order], jumps
+
+
+def split_clusters(
+    triangles,
+    jumps: list[int],
+    threshold=OVERDRAW_THRESHOLD,
+    cache_size=VERTEX_CACHE_SIZE,
+) -> list[int]:
+    """Split ordered triangles into clusters that can be drawn in any order without losing
+    much cache efficiency. Each cluster is ended once its ACMR, starting with an empty cache,
+    is within `threshold` times the ACMR of the whole order, or at a jump.
+
+    Returns:
+        list[int]: Index of the first triangle of each cluster
+    """
+    target = threshold * acmr(triangles, cache_size)
+    jumps = set(jumps)
+
+    clusters = []
+    cache = deque()
+    cached = set()
+    misses = 0
+    for triangle, corners in enumerate(np.asarray(triangles).tolist()):
+        if (
+            triangle in jumps
+            or not clusters
+            or misses <= target * (triangle - clusters[-1])
+        ):
+            if not clusters or triangle != clusters[-1]:
+                clusters.append(triangle)
+            cache.clear()
+            cached.clear()
+            misses = 0
+        for vertex in corners:
+            if vertex in cached:
+                continue
+            misses += 1
+            if len(cache) == cache_size:
+                cached.discard(cache.popleft())
+            cache.append(vertex)
+            cached.add(vertex)
+    return clusters
+
+
+def sort_clusters(positions, triangles, clusters: list[int]) -> np.ndarray:
+    """Reorder clusters of triangles so the ones facing away from the centre of the mesh are
+    drawn first, as they're the most likely to hide the rest.
+
+    Returns:
+        NDArray: The reordered triangles
+    """
+    if len(clusters) < 2:
+        return triangles
+
+    corners = np.asarray(positions, dtype=np.float64)[triangles]
+    # Twice each triangle's area weighted normal
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1)
+    centroids = corners.mean(axis=1)
+
+    cluster_areas = np.add.reduceat(areas, clusters)
+    cluster_normals = np.add.reduceat(normals, clusters)
+    cluster_centroids = np.add.reduceat(centroids * areas[:, np.newaxis], clusters)
+    cluster_centroids /= np.maximum(cluster_areas, 1e-12)[:, np.newaxis]
+    mesh_centroid = (centroids * areas[:, np.newaxis]).sum(axis=0) / max(
+        areas.sum(), 1e-12
+    )
+
+    lengths = np.linalg.norm(cluster_normals, axis=1, keepdims=True)
+    cluster_normals /= np.maximum(lengths, 1e-12)
+    facing = np.einsum("ij,ij->i", cluster_centroids - mesh_centroid, cluster_normals)
+
+    bounds = [*clusters, len(triangles)]
+    return np.concatenate([
+        triangles[bounds[cluster] : bounds[cluster + 1]]
+        for cluster in np.argsort(-facing, kind="stable")
+    ])
+
+
+def optimise_triangles(
+    positions, triangles, cache_size=VERTEX_CACHE_SIZE, threshold=OVERDRAW_THRESHOLD
+) -> np.ndarray:
+    """Reorder triangles for the vertex cache and then for overdraw, keeping their vertices.
+
+    Args:
+        positions (NDArray): (vertices, 3) vertex positions
+        triangles (NDArray): (triangles, 3) vertex indices
+
+    Returns:
+        NDArray: The same triangles in a new order
+    """
+    if len(triangles) == 0:
+        return triangles
+    ordered, jumps = tipsify(triangles, len(positions), cache_size)
+    clusters = split_clusters(ordered, jumps, threshold, cache_size)
+    return sort_clusters(positions, ordered, clusters)
+
+
+def reorder_vertices(triangles, vertex_count: int) -> tuple[np.ndarray, np.ndarray]:
+    """Renumber vertices in the order the triangles first use them. Unused vertices are dropped.
+
+    Returns:
+        tuple[NDArray, NDArray]: The renumbered triangles, and the old index of each vertex,
+            for reordering the vertex attributes
+    """
+    flat = np.asarray(triangles).reshape(-1)
+    used, first_use = np.unique(flat, return_index=True)
+    order = used[np.argsort(first_use)]
+    remap = np.zeros(vertex_count, dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return remap[triangles].astype(np.asarray(triangles).dtype), order
+
+
+def optimise_mesh(positions, triangles) -> tuple[np.ndarray, np.ndarray]:
+    """Reorder a mesh's triangles and vertices, through the asset cache.
+
+    Args:
+        positions (NDArray): (vertices, 3) vertex positions
+        triangles (NDArray): (triangles, 3) vertex indices
+
+    Returns:
+        tuple[NDArray, NDArray]: The optimised triangles, and the old index of each vertex,
+            for reordering the vertex attributes
+    """
+    key = asset_cache.content_key(
+        positions,
+        triangles,
+        cache_size=VERTEX_CACHE_SIZE,
+        threshold=OVERDRAW_THRESHOLD,
+    )
+    arrays = asset_cache.load_arrays("optimised", key)
+    if arrays is None:
+        optimised, order = reorder_vertices(
+            optimise_triangles(positions, triangles), len(positions)
+        )
+        arrays = {"triangles": optimised, "order": order}
+        asset_cache.save_arrays("optimised", key, arrays)
+    return arrays["triangles"], arrays["order"]
+
+
+def main() -> int:
+    # Imported here, as loading material libraries pulls in the texture modules
+    from blender import parse_obj_file
+
+    parser = argparse.ArgumentParser(
+        description="Report the vertex cache efficiency of models before and after optimising"
+    )
+    parser.add_argument(
+        "names", nargs="*", help="obj files in the models folder (default all)"
+    )
+    parser.add_argument("--cache-size", type=int, default=VERTEX_CACHE_SIZE)
+    args = parser.parse_args()
+
+    names = args.names or sorted(
+        os.path.basename(file) for file in glob.glob("./models/*.obj")
+    )
+    print(f"{'model':<20} {'triangles':>9} {'ACMR before':>11} {'after':>6}")
+    for name in names:
+        vertices, faces, _, _, _, mesh_list = parse_obj_file(name)
+        positions = np.array(vertices, dtype="f")
+        # Position indices of each face, which start at 1
+        triangles = np.array([[corner[0] for corner in face] for face in faces]) - 1
+        mesh_ids = np.array(mesh_list)
+        starts = np.flatnonzero(np.diff(mesh_ids, prepend=-1))
+
+        before = after = 0.0
+        for start, end in zip(starts, [*starts[1:], len(triangles)]):
+            mesh = triangles[start:end]
+            before += acmr(mesh, args.cache_size) * len(mesh)
+            optimised = optimise_triangles(positions, mesh, args.cache_size)
+            after += acmr(optimised, args.cache_size) * len(mesh)
+        print(
+            f"{name:<20} {len(triangles):>9} {before / len(triangles):>11.3f}"
+            f" {after / len(triangles):>6.3f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,443 @@
+"""Micro-benchmarks of the CPU side subsystems. No OpenGL context or window is needed.
+
+Each subsystem is run on synthetic inputs of increasing size, and on the bundled models,
+reporting the throughput, peak memory and how the run time scales with the input size.
+
+Usage:
+    python micro_benchmarks.py
+    python micro_benchmarks.py --max-faces 10000000 --only parse_obj_file,calculate_normals
+    python micro_benchmarks.py --output micro_benchmarks.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Any, NamedTuple
+from unittest import mock
+
+import numpy as np
+from geomdl import BSpline, exchange, knotvector
+
+from blender import (
+    fix_blender_textures,
+    load_material_library,
+    parse_obj_file,
+    process_line,
+)
+from camera import Camera
+from entity import Entity
+from mesh import Mesh, uniform_matrices
+
+
+class BenchmarkResult(NamedTuple):
+    """The result of running one subsystem on one input."""
+
+    subsystem: str
+    input: str
+    size: int
+    unit: str
+    seconds: float
+    throughput: float
+    peak_bytes: int
+
+
+def measure(run: Callable[[], Any], repeat: int) -> float:
+    """Best time in seconds of `repeat` runs. The best run is the least disturbed by the rest of the system."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_peak_memory(run: Callable[[], Any]) -> int:
+    """Peak bytes allocated by Python and numpy during one run. Measured separately from
+    the time, because tracing allocations slows everything down.
+    """
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+#
+# Synthetic inputs
+#
+
+
+def grid_mesh(faces: int):
+    """A flat triangulated grid with about `faces` triangles and texture coordinates.
+
+    Returns:
+        tuple: vertices (V, 3), faces (F, 3) and texture coordinates (V, 2)
+    """
+    side = max(int(np.sqrt(faces / 2)), 1)
+    u, v = np.meshgrid(np.arange(side + 1), np.arange(side + 1))
+    vertices = np.stack(
+        [u.ravel(), np.sin(u.ravel() * 0.1) * np.cos(v.ravel() * 0.1), v.ravel()],
+        axis=1,
+    ).astype("f")
+    texture_coords = np.stack([u.ravel(), v.ravel()], axis=1).astype("f") / side
+
+    corner = (np.arange(side)[:, np.newaxis] * (side + 1) + np.arange(side)).ravel()
+    triangles = np.concatenate([
+        np.stack([corner, corner + 1, corner + side + 1], axis=1),
+        np.stack([corner + 1, corner + side + 2, corner + side + 1], axis=1),
+    ]).astype(np.uint32)
+
+    return vertices, triangles, texture_coords
+
+
+def write_obj_file(faces: int, directory: str) -> str:
+    """Write a synthetic Wavefront obj file (and its material library) with about `faces` triangles.
+
+    Returns:
+        str: Path to the obj file
+    """
+    vertices, triangles, texture_coords = grid_mesh(faces)
+
+    material_path = os.path.join(directory, "synthetic.mtl")
+    with open(material_path, "w", encoding="utf-8") as file:
+        file.write("newmtl synthetic\nKd 0.8 0.8 0.8\n")
+
+    obj_path = os.path.join(directory, f"synthetic_{faces}.obj")
+    with open(obj_path, "w", encoding="utf-8") as file:
+        file.write(f"mtllib {material_path}\n")
+        file.writelines(f"v {x} {y} {z}\n" for x, y, z in vertices)
+        file.writelines(f"vt {u} {v}\n" for u, v in texture_coords)
+        file.write("usemtl synthetic\n")
+        file.writelines(
+            f"f {a}/{a} {b}/{b} {c}/{c}\n" for a, b, c in triangles.astype(int) + 1
+        )
+
+    return obj_path
+
+
+def entity_tree(count: int, branching: int) -> tuple[Entity, list[Entity]]:
+    """A tree of `count` entities, each with up to `branching` children.
+    A branching factor of 1 makes a chain.
+
+    Returns:
+        tuple[Entity, list[Entity]]: The root, and every entity in the tree
+    """
+    root = Entity(position=(1.0, 0.0, 0.0), scale=1.0)
+    entities = [root]
+    for i in range(1, count):
+        parent = entities[(i - 1) // branching]
+        entities.append(Entity(position=(0.0, 1.0, 0.0), parent=parent))
+    return root, entities
+
+
+def mesh_without_buffers(vertices, faces, texture_coords) -> Mesh:
+    """A Mesh that hasn't been uploaded to OpenGL, enough to run its CPU side methods."""
+    mesh = Mesh.__new__(Mesh)
+    mesh.vertices = vertices
+    mesh.faces = faces
+    mesh.texture_coords = texture_coords
+    return mesh
+
+
+def load_dino_path() -> BSpline.Curve:
+    curve = BSpline.Curve()
+    curve.degree = 3
+    curve.ctrlpts = exchange.import_txt("./dino_path.txt")
+    curve.knotvector = knotvector.generate(curve.degree, curve.ctrlpts_size)
+    return curve
+
+
+#
+# Benchmarks
+#
+
+
+class MicroBenchmarks:
+    """Runs the micro-benchmarks and collects their results."""
+
+    def __init__(self, repeat=3, directory="."):
+        self.repeat = repeat
+        self.directory = directory
+        self.results: list[BenchmarkResult] = []
+
+    def run(
+        self,
+        subsystem: str,
+        input_name: str,
+        size: int,
+        unit: str,
+        function: Callable[[], Any],
+    ):
+        seconds = measure(function, self.repeat)
+        peak_bytes = measure_peak_memory(function)
+        result = BenchmarkResult(
+            subsystem,
+            input_name,
+            size,
+            unit,
+            seconds,
+            size / seconds if seconds > 0 else float("inf"),
+            peak_bytes,
+        )
+        self.results.append(result)
+        print(
+            f"{subsystem:>20} {input_name:>24} {seconds * 1000:>12.3f}ms"
+            f" {result.throughput:>14,.0f} {unit}/s {peak_bytes / 2**20:>10.2f}MiB"
+        )
+
+    def process_line(self, faces: int, obj_path: str, input_name: str):
+        with open(obj_path, encoding="utf-8") as file:
+            lines = file.readlines()
+
+        def run():
+            for line in lines:
+                process_line(line)
+
+        self.run("process_line", input_name, len(lines), "lines", run)
+
+    def parse_obj_file(self, faces: int, obj_path: str, input_name: str):
+        # Only the parsing is timed. The material library is loaded once beforehand, and the
+        # decoding of its textures isn't started, as it depends on the image cache
+        libraries = {}
+
+        def load_library(file_name):
+            if file_name not in libraries:
+                libraries[file_name] = load_material_library(file_name)
+            return libraries[file_name]
+
+        with (
+            mock.patch("blender.load_material_library", load_library),
+            mock.patch("texture.Texture.prefetch"),
+        ):
+            parse_obj_file(obj_path)
+            self.run(
+                "parse_obj_file",
+                input_name,
+                faces,
+                "faces",
+                lambda: parse_obj_file(obj_path),
+            )
+
+    def fix_blender_textures(self, faces: int, obj_path: str, input_name: str):
+        vertices, face_list, _, vertex_textures, _, _ = parse_obj_file(obj_path)
+        vertex_array = np.array(vertices, dtype="f")
+        texture_array = np.array(vertex_textures, dtype="f")
+        face_array = np.array(face_list, dtype=np.uint32)
+        if face_array.shape[2] == 1:
+            return
+
+        self.run(
+            "fix_blender_textures",
+            input_name,
+            len(face_array),
+            "faces",
+            lambda: fix_blender_textures(texture_array, face_array, vertex_array),
+        )
+
+    def calculate_normals(self, vertices, faces, texture_coords, input_name: str):
+        mesh = mesh_without_buffers(vertices, faces, texture_coords)
+        self.run(
+            "calculate_normals",
+            input_name,
+            len(faces),
+            "faces",
+            mesh.calculate_normals,
+        )
+
+    def world_pose(self, count: int, branching: int):
+        existing_entities = len(Entity.all_entities)
+        root, entities = entity_tree(count, branching)
+
+        def run():
+            # Moving the root invalidates the whole tree
+            root.x = root.x
+            for entity in entities:
+                # Only evaluated, for the time it takes to recompute the cached pose
+                _ = entity.world_pose
+
+        shape = "chain" if branching == 1 else f"tree (branching {branching})"
+
+        # world_pose recurses up to the root, so deep chains need more than the default limit
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, count * 4 + 1000))
+        try:
+            self.run("world_pose", f"{shape} of {count}", count, "entities", run)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+            del Entity.all_entities[existing_entities:]
+
+    def camera_update(self, depth: int):
+        existing_entities = len(Entity.all_entities)
+        root, entities = entity_tree(depth, 1)
+        camera = Camera(position=(0.0, 0.0, 5.0), parent=entities[-1])
+
+        def run():
+            for _ in range(1000):
+                root.x = root.x
+                camera.update()
+
+        self.run("Camera.update", f"parent depth {depth}", 1000, "updates", run)
+        del Entity.all_entities[existing_entities:]
+
+    def uniform_matrices(self, calls: int):
+        rng = np.random.default_rng(0)
+        world_poses = rng.random((calls, 4, 4)) + np.identity(4) * 4
+        view_matrix = rng.random((4, 4)) + np.identity(4) * 4
+        projection_matrix = rng.random((4, 4)) + np.identity(4) * 4
+
+        def run():
+            for world_pose in world_poses:
+                uniform_matrices(world_pose, view_matrix, projection_matrix)
+
+        self.run("uniform_matrices", f"{calls} meshes", calls, "meshes", run)
+
+    def dino_path(self, evaluations: int):
+        curve = load_dino_path()
+        parameters = np.linspace(0.0, 1.0, evaluations, endpoint=False)
+
+        def run():
+            for t in parameters:
+                curve.derivatives(t, order=1)
+
+        self.run(
+            "dino_path.derivatives",
+            f"{evaluations} samples",
+            evaluations,
+            "samples",
+            run,
+        )
+
+    def run_all(self, face_counts: list[int], entity_counts: list[int], only=None):
+        def wanted(name):
+            return only is None or name in only
+
+        for faces in face_counts:
+            input_name = f"synthetic {faces:,} faces"
+            obj_path = write_obj_file(faces, self.directory)
+            if wanted("process_line"):
+                self.process_line(faces, obj_path, input_name)
+            if wanted("parse_obj_file"):
+                self.parse_obj_file(faces, obj_path, input_name)
+            if wanted("fix_blender_textures"):
+                self.fix_blender_textures(faces, obj_path, input_name)
+            if wanted("calculate_normals"):
+                self.calculate_normals(*grid_mesh(faces), input_name)
+            os.remove(obj_path)
+
+        # The bundled models
+        for obj_path in sorted(glob.glob("./models/*.obj")):
+            input_name = os.path.basename(obj_path)
+            vertices, faces, _, vertex_textures, _, _ = parse_obj_file(input_name)
+            if wanted("parse_obj_file"):
+                self.parse_obj_file(len(faces), input_name, input_name)
+            if wanted("fix_blender_textures"):
+                self.fix_blender_textures(len(faces), input_name, input_name)
+            if wanted("calculate_normals"):
+                face_array = np.array(faces, dtype=np.uint32)
+                texture_coords = fix_blender_textures(
+                    np.array(vertex_textures, dtype="f"),
+                    face_array,
+                    np.array(vertices, dtype="f"),
+                )
+                self.calculate_normals(
+                    np.array(vertices, dtype="f"),
+                    face_array[:, :, 0] - 1,
+                    texture_coords,
+                    input_name,
+                )
+
+        for count in entity_counts:
+            if wanted("world_pose"):
+                self.world_pose(count, branching=4)
+                self.world_pose(count, branching=1)
+            if wanted("uniform_matrices"):
+                self.uniform_matrices(count)
+            if wanted("dino_path"):
+                self.dino_path(count)
+
+        for depth in [1, 10, 100]:
+            if wanted("camera_update"):
+                self.camera_update(depth)
+
+    def scaling(self) -> dict[str, float]:
+        """Fit how the run time of each subsystem grows with its synthetic input size.
+
+        Returns:
+            dict[str, float]: The exponent k in time ~ size^k. 1 is linear.
+        """
+        exponents = {}
+        for subsystem in {result.subsystem for result in self.results}:
+            points = [
+                (result.size, result.seconds)
+                for result in self.results
+                if result.subsystem == subsystem
+                and not result.input.endswith(".obj")
+                and result.seconds > 0
+            ]
+            if len({size for size, _ in points}) < 2:
+                continue
+            sizes, seconds = np.log(np.array(points)).T
+            exponents[subsystem] = float(np.polyfit(sizes, seconds, 1)[0])
+        return exponents
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument(
+        "--max-faces",
+        type=int,
+        default=100_000,
+        help="largest synthetic mesh, in powers of 10 from 1000 (default 100000)",
+    )
+    parser.add_argument(
+        "--max-entities",
+        type=int,
+        default=10_000,
+        help="largest entity hierarchy, in powers of 10 from 100 (default 10000)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement")
+    parser.add_argument("--only", help="comma separated subsystems to run")
+    parser.add_argument("--output", help="write the results JSON to this file")
+    args = parser.parse_args()
+
+    face_counts = [10**i for i in range(3, 8) if 10**i <= args.max_faces]
+    entity_counts = [10**i for i in range(2, 8) if 10**i <= args.max_entities]
+    only = None if args.only is None else set(args.only.split(","))
+
+    print(
+        f"{'subsystem':>20} {'input':>24} {'time':>14} {'throughput':>20}"
+        f" {'peak memory':>13}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks = MicroBenchmarks(repeat=args.repeat, directory=directory)
+        benchmarks.run_all(face_counts, entity_counts, only)
+
+    scaling = benchmarks.scaling()
+    print("\nScaling exponents (time ~ size^k):")
+    for subsystem, exponent in sorted(scaling.items()):
+        print(f"{subsystem:>20} {exponent:.2f}")
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "results": [result._asdict() for result in benchmarks.results],
+                    "scaling": scaling,
+                },
+                file,
+                indent=2,
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,7 @@ from entity import Entity
 from mesh import Mesh
 from scene import Scene
 from shaders import CartoonShader, EnvironmentShader, Shader, SkyBoxShader
+from tracing import traced
 
 
 class Model(Entity):
@@ -17,11 +18,19 @@ class Model(Entity):
 
     untitled_model_count = 0
 
+    # Name of the render pass the model is drawn in, for GPU timing and debug tools
+    render_pass = "models"
+    # Whether the debug tools can select the model by looking or clicking at it
+    pickable = True
+    # Whether the model's meshes can be skipped when hidden behind others
+    occlusion_culling = True
+
     def __init__(
         self,
         meshes: list[Type[Mesh]],
         name=None,
         shader: Shader = CartoonShader(),
+        static=False,
         **kwargs,
     ) -> None:
         if name is not None:
@@ -32,15 +41,35 @@ class Model(Entity):
             self.name = f"Model.{untitled_model_number}"
 
         super().__init__(**kwargs)
-        self.visible = True
+        self.__visible__ = True
         self.shader = shader
+        # Static models never move, so which of their meshes can be seen from where is baked
+        self.static = static
         self.meshes = meshes
 
         for mesh in self.meshes:
+            # Also makes it a child, so its cached world pose is cleared when the model moves
             mesh.parent = self
             mesh.bind_shader(self.shader)
 
-        Scene.current_scene.models.append(self)
+        scene = Scene.current_scene
+        with scene.models_lock:
+            scene.models.append(self)
+            scene.models_changed()
+
+    @property
+    def visible(self) -> bool:
+        return self.__visible__
+
+    # A property, so the spatial index is rebuilt when the model is shown or hidden
+    @visible.setter
+    def visible(self, value: bool):
+        if value == self.__visible__:
+            return
+        scene = Scene.current_scene
+        with scene.models_lock:
+            self.__visible__ = value
+            scene.models_changed()
 
     @classmethod
     def from_obj(self, obj_name: str, **kwargs) -> Self:
@@ -60,13 +89,37 @@ class Model(Entity):
         model = Model(meshes, **kwargs)
         return model
 
-    def draw(self):
-        """Draw the model to the window."""
-        if not self.visible:
+    @traced
+    def draw(self, world_poses=None):
+        """Draw the model to the window.
+
+        Args:
+            world_poses (list[NDArray], optional): Draw each mesh with these world poses
+                instead of their current ones, e.g. from a `RenderSnapshot`.
+        """
+        if world_poses is None:
+            if not self.visible:
+                return
+            world_poses = [None] * len(self.meshes)
+
+        # Static models never move, so the batch ignores the poses
+        if Scene.current_scene.indirect.submit(self):
             return
 
-        for mesh in self.meshes:
-            mesh.draw()
+        occlusion = Scene.current_scene.occlusion
+        occlusion_culling = self.occlusion_culling and occlusion.enabled
+        if not occlusion_culling and Scene.current_scene.command_lists.draw(self):
+            return
+
+        visible_meshes = Scene.current_scene.visible_meshes
+        for mesh, world_pose in zip(self.meshes, world_poses):
+            if visible_meshes is not None and mesh not in visible_meshes:
+                continue
+            mesh.select_lod(world_pose)
+            if occlusion_culling:
+                occlusion.draw(mesh, world_pose)
+            else:
+                mesh.draw(world_pose)
 
     def set_shader(self, shader: Shader):
         """Update the model shader"""
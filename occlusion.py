@@ -0,0 +1,281 @@
+"""Occlusion culling with hardware occlusion queries and conditional rendering.
+
+Meshes are split by the last result read back for them. Meshes that were visible are drawn
+as normal, and every few frames their bounding boxes are drawn again, with colour and depth
+writes off, after the rest of the pass, to check whether anything drawn in front now hides
+them. Meshes that were hidden get a box query as soon as the visible meshes are drawn, and are
+then drawn inside `glBeginConditionalRender` on that query, so the GPU skips them if their box
+is still hidden. The GPU decides with this frame's depth buffer, so meshes that come out from
+behind others are never a frame late, and the CPU only ever reads results a frame or more
+later, when they're ready, so it never waits for the GPU.
+"""
+
+from collections import deque
+
+import imgui
+import numpy as np
+from OpenGL import GL as gl
+
+from bvh import transform_bounds
+
+# Corners of a unit cube, bit i of each index set for 1 along axis i
+BOX_CORNERS = np.array(
+    [[index & 1, (index >> 1) & 1, (index >> 2) & 1] for index in range(8)], dtype="f"
+)
+BOX_TRIANGLES = np.array(
+    [
+        [0, 2, 6],
+        [0, 6, 4],
+        [1, 5, 7],
+        [1, 7, 3],
+        [0, 4, 5],
+        [0, 5, 1],
+        [2, 3, 7],
+        [2, 7, 6],
+        [0, 1, 3],
+        [0, 3, 2],
+        [4, 6, 7],
+        [4, 7, 5],
+    ],
+    dtype=np.uint8,
+)
+
+
+class OcclusionCuller:
+    """Skips drawing meshes hidden behind others, using what the GPU found in earlier frames."""
+
+    def __init__(self, latency=3):
+        """
+        Args:
+            latency (int, optional): Frames of queries in flight before waiting for the oldest.
+                Defaults to 3.
+        """
+        self.enabled = False
+        self.latency = latency
+        # Visible meshes have their boxes checked once every this many frames
+        self.check_interval = 4
+
+        self.shader = None
+        self.position_location = -1
+        self.pvm_location = -1
+        self.vertex_array_object = None
+
+        self.free_queries: list[int] = []
+        # (mesh, query) of each frame that hasn't been read back yet
+        self.pending_frames: deque[list[tuple]] = deque()
+        self.current_frame: list[tuple] = []
+        self.frame = 0
+        # Visible meshes drawn so far this frame
+        self.visible_draws = 0
+
+        # Meshes hidden at their last check, drawn conditionally at the end of the pass, and
+        # visible meshes that are due a check, as (mesh, world pose)
+        self.deferred: list[tuple] = []
+        self.checks: list[tuple] = []
+
+        # Statistics
+        self.conditional_draws = 0
+        self.box_queries = 0
+        self.hidden = 0
+
+    def prepare(self):
+        """Compile the box shader and upload the unit cube, the first time they're needed."""
+        # Imported here, as the shaders need the scene module, which creates the culler
+        from shaders import OcclusionShader
+
+        self.shader = OcclusionShader()
+        self.shader.compile()
+        self.position_location = gl.glGetAttribLocation(
+            self.shader.program_id, "position"
+        )
+        self.pvm_location = gl.glGetUniformLocation(self.shader.program_id, "PVM")
+
+        self.vertex_array_object = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(self.vertex_array_object)
+        vertex_buffer, index_buffer = gl.glGenBuffers(2)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, vertex_buffer)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, BOX_CORNERS, gl.GL_STATIC_DRAW)
+        gl.glEnableVertexAttribArray(self.position_location)
+        gl.glVertexAttribPointer(
+            self.position_location, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, None
+        )
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, index_buffer)
+        gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, BOX_TRIANGLES, gl.GL_STATIC_DRAW)
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    def query(self) -> int:
+        if not self.free_queries:
+            self.free_queries.extend(int(query) for query in gl.glGenQueries(64))
+        return self.free_queries.pop()
+
+    def begin_frame(self):
+        """Start a new frame, reading back the results of earlier frames that are ready."""
+        if self.current_frame:
+            self.pending_frames.append(self.current_frame)
+            self.current_frame = []
+        self.resolve()
+        self.frame += 1
+        self.visible_draws = 0
+        self.hidden = 0
+        self.conditional_draws = 0
+        self.box_queries = 0
+
+    def resolve(self, wait=False):
+        """Read back every finished frame, oldest first.
+
+        Args:
+            wait (bool, optional): Wait for the GPU to finish every pending frame. Defaults to
+                False, which only waits when more than `latency` frames are in flight.
+        """
+        while self.pending_frames:
+            frame = self.pending_frames[0]
+            must_wait = wait or len(self.pending_frames) > self.latency
+            if not must_wait and not gl.glGetQueryObjectiv(
+                frame[-1][1], gl.GL_QUERY_RESULT_AVAILABLE
+            ):
+                # Later frames can't have finished either
+                break
+
+            self.pending_frames.popleft()
+            for mesh, query in frame:
+                mesh.occluded = not gl.glGetQueryObjectiv(query, gl.GL_QUERY_RESULT)
+                if mesh.occlusion_query == query:
+                    mesh.occlusion_query = None
+                self.free_queries.append(query)
+
+    def draw(self, mesh, world_pose=None):
+        """Draw a mesh now if it was visible when last checked, or at the end of the pass
+        if it was hidden.
+
+        Args:
+            world_pose (NDArray, optional): Draw with this world pose instead of the current one.
+        """
+        if mesh.occluded:
+            self.deferred.append((mesh, world_pose))
+            return
+
+        mesh.draw(world_pose)
+        # Spread the checks of visible meshes over the frames by their order
+        self.visible_draws += 1
+        if (
+            mesh.occlusion_query is None
+            and (self.frame + self.visible_draws) % self.check_interval == 0
+        ):
+            self.checks.append((mesh, world_pose))
+
+    def flush(self, projection_matrix, view_matrix):
+        """Draw the meshes that were hidden, if they still are, and check the visible meshes
+        that are due. Call at the end of each render pass, after everything else is drawn.
+        """
+        if not self.deferred and not self.checks:
+            return
+        if self.shader is None:
+            self.prepare()
+
+        deferred, self.deferred = self.deferred, []
+        checks, self.checks = self.checks, []
+        projection_view = np.matmul(projection_matrix, view_matrix)
+        self.hidden += len(deferred)
+
+        # Boxes of the hidden meshes first, against the depth of the visible ones
+        deferred_queries = self.query_boxes(deferred, projection_view, view_matrix)
+
+        # Whether each hidden mesh is drawn is decided on the GPU, so it's never a frame late
+        for (mesh, world_pose), query in zip(deferred, deferred_queries):
+            if query is None:
+                mesh.draw(world_pose)
+                continue
+            gl.glBeginConditionalRender(query, gl.GL_QUERY_WAIT)
+            mesh.draw(world_pose)
+            gl.glEndConditionalRender()
+            self.conditional_draws += 1
+
+        # Checks of visible meshes last, against everything drawn in the pass
+        self.query_boxes(checks, projection_view, view_matrix)
+
+    def query_boxes(self, meshes, projection_view, view_matrix) -> list[int | None]:
+        """Draw the world space bounding boxes of meshes inside occlusion queries, writing
+        nothing. Boxes the camera is inside, which would be clipped by the near plane, aren't
+        queried, and their meshes are counted as visible.
+
+        Args:
+            meshes (list[tuple[Mesh, NDArray]]): Meshes and their world poses, or None for the
+                current ones
+
+        Returns:
+            list[int | None]: The query of each mesh's box, or None if it wasn't queried
+        """
+        if not meshes:
+            return []
+
+        poses = np.array([
+            mesh.world_pose if world_pose is None else world_pose
+            for mesh, world_pose in meshes
+        ])
+        lower, upper = transform_bounds(
+            np.array([mesh.bounds[0] for mesh, _ in meshes]),
+            np.array([mesh.bounds[1] for mesh, _ in meshes]),
+            poses,
+        )
+
+        # Grow the boxes by the furthest the near plane reaches from the camera
+        camera = np.linalg.inv(view_matrix)[:3, 3]
+        near_corners = np.matmul(
+            [[x, y, -1, 1] for x in (-1, 1) for y in (-1, 1)],
+            np.linalg.inv(projection_view).T,
+        )
+        near_corners = near_corners[:, :3] / near_corners[:, 3:]
+        margin = np.linalg.norm(near_corners - camera, axis=1).max()
+        inside = ((camera >= lower - margin) & (camera <= upper + margin)).all(axis=1)
+
+        # Stretch the unit cube over each box
+        boxes = np.zeros((len(meshes), 4, 4))
+        boxes[:, [0, 1, 2], [0, 1, 2]] = upper - lower
+        boxes[:, :3, 3] = lower
+        boxes[:, 3, 3] = 1
+        matrices = np.matmul(projection_view, boxes).astype("f")
+
+        self.shader.bind()
+        gl.glBindVertexArray(self.vertex_array_object)
+        gl.glColorMask(gl.GL_FALSE, gl.GL_FALSE, gl.GL_FALSE, gl.GL_FALSE)
+        gl.glDepthMask(gl.GL_FALSE)
+
+        queries = []
+        for (mesh, _), matrix, mesh_inside in zip(
+            meshes, matrices, inside.tolist(), strict=True
+        ):
+            if mesh_inside:
+                mesh.occluded = False
+                queries.append(None)
+                continue
+            query = self.query()
+            gl.glBeginQuery(gl.GL_ANY_SAMPLES_PASSED, query)
+            gl.glUniformMatrix4fv(self.pvm_location, 1, True, matrix)
+            gl.glDrawElements(
+                gl.GL_TRIANGLES, BOX_TRIANGLES.size, gl.GL_UNSIGNED_BYTE, None
+            )
+            gl.glEndQuery(gl.GL_ANY_SAMPLES_PASSED)
+            mesh.occlusion_query = query
+            self.current_frame.append((mesh, query))
+            queries.append(query)
+        self.box_queries += len(meshes) - int(inside.sum())
+
+        gl.glDepthMask(gl.GL_TRUE)
+        gl.glColorMask(gl.GL_TRUE, gl.GL_TRUE, gl.GL_TRUE, gl.GL_TRUE)
+        gl.glBindVertexArray(0)
+        return queries
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        _, self.enabled = imgui.checkbox("Occlusion culling", self.enabled)
+        _, self.check_interval = imgui.slider_int(
+            "Frames between checks of visible meshes", self.check_interval, 1, 16
+        )
+        imgui.text(
+            f"{self.hidden} meshes hidden when last checked,"
+            f" {self.conditional_draws} drawn conditionally"
+        )
+        imgui.text(
+            f"{self.box_queries} box queries, {len(self.pending_frames)} frames in flight"
+        )
@@ -0,0 +1,218 @@
+"""Offscreen OpenGL contexts, so scenes can render without a window, input or GUI.
+Works with Mesa software rendering (llvmpipe), e.g. on CI machines and servers without a GPU.
+
+PyOpenGL chooses its platform the first time it is imported, so `use_offscreen_platform`
+has to be called before anything imports `OpenGL`.
+"""
+
+import ctypes
+import os
+import sys
+
+import numpy as np
+from numpy.typing import NDArray
+
+OFFSCREEN_PLATFORMS = ("egl", "osmesa")
+
+
+def use_offscreen_platform(platform: str = "egl"):
+    """Select an offscreen PyOpenGL platform. Call before importing anything that uses OpenGL.
+
+    Args:
+        platform (str, optional): "egl" or "osmesa". Defaults to "egl".
+            An already set `PYOPENGL_PLATFORM` environment variable takes precedence.
+    """
+    if platform not in OFFSCREEN_PLATFORMS:
+        raise ValueError(f"(E) Unknown offscreen platform {platform}")
+
+    if "OpenGL.GL" in sys.modules and offscreen_platform() is None:
+        raise RuntimeError(
+            "(E) OpenGL was imported before an offscreen platform was selected"
+        )
+
+    os.environ.setdefault("PYOPENGL_PLATFORM", platform)
+
+    # Let Mesa create EGL contexts without any display server
+    os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+
+
+def offscreen_platform() -> str | None:
+    """The offscreen platform PyOpenGL is using, or None if it's using a windowing system."""
+    platform = os.environ.get("PYOPENGL_PLATFORM")
+    return platform if platform in OFFSCREEN_PLATFORMS else None
+
+
+class OffscreenContext:
+    """An OpenGL context with no window. Rendering goes to a framebuffer object,
+    which is made the default framebuffer for the rest of the code.
+    """
+
+    def __init__(self, width: int, height: int):
+        """Create an offscreen context and make it current.
+
+        Args:
+            width (int): Width of the render target in pixels
+            height (int): Height of the render target in pixels
+        """
+        self.platform = offscreen_platform()
+        self.width = width
+        self.height = height
+
+        if self.platform == "egl":
+            self._create_egl_context()
+        elif self.platform == "osmesa":
+            self._create_osmesa_context()
+        else:
+            raise RuntimeError(
+                "(E) Headless rendering needs an offscreen platform,"
+                " call offscreen.use_offscreen_platform() before importing OpenGL"
+            )
+
+        # Imported here so that OpenGL is only loaded once the platform is chosen
+        from OpenGL import GL as gl
+
+        from framebuffer import Framebuffer
+
+        self.frame_buffer_object = gl.glGenFramebuffers(1)
+        self.color_buffer = gl.glGenRenderbuffers(1)
+        self.depth_buffer = gl.glGenRenderbuffers(1)
+        self.resize(width, height)
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.frame_buffer_object)
+        gl.glFramebufferRenderbuffer(
+            gl.GL_FRAMEBUFFER,
+            gl.GL_COLOR_ATTACHMENT0,
+            gl.GL_RENDERBUFFER,
+            self.color_buffer,
+        )
+        gl.glFramebufferRenderbuffer(
+            gl.GL_FRAMEBUFFER,
+            gl.GL_DEPTH_ATTACHMENT,
+            gl.GL_RENDERBUFFER,
+            self.depth_buffer,
+        )
+
+        status = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+        if status != gl.GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError(f"(E) Offscreen framebuffer is incomplete ({status})")
+
+        # Anything that unbinds a framebuffer should go back to ours rather than 0
+        Framebuffer.default_framebuffer = self.frame_buffer_object
+
+        print(
+            f"Created {self.platform} offscreen context:"
+            f" OpenGL {gl.glGetString(gl.GL_VERSION).decode()},"
+            f" {gl.glGetString(gl.GL_RENDERER).decode()}"
+        )
+
+    def _create_egl_context(self):
+        from OpenGL import EGL
+
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(
+            self.display, ctypes.pointer(major), ctypes.pointer(minor)
+        ):
+            raise RuntimeError("(E) Could not initialise EGL")
+
+        config = EGL.EGLConfig()
+        config_count = EGL.EGLint()
+        config_attributes = (EGL.EGLint * 5)(
+            EGL.EGL_SURFACE_TYPE,
+            EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RENDERABLE_TYPE,
+            EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE,
+        )
+        EGL.eglChooseConfig(
+            self.display,
+            config_attributes,
+            ctypes.pointer(config),
+            1,
+            ctypes.pointer(config_count),
+        )
+        if config_count.value == 0:
+            raise RuntimeError("(E) No EGL config supports desktop OpenGL")
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+
+        # The shaders use the fixed function vertex array state, so ask for a compatibility profile
+        context_attributes = (EGL.EGLint * 3)(
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+            EGL.EGL_CONTEXT_OPENGL_COMPATIBILITY_PROFILE_BIT,
+            EGL.EGL_NONE,
+        )
+        self.context = EGL.eglCreateContext(
+            self.display, config, EGL.EGL_NO_CONTEXT, context_attributes
+        )
+        if not self.context:
+            raise RuntimeError("(E) Could not create an EGL context")
+
+        # We render into a framebuffer object, so no surface is needed
+        if not EGL.eglMakeCurrent(
+            self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, self.context
+        ):
+            raise RuntimeError("(E) Could not make the EGL context current")
+
+    def _create_osmesa_context(self):
+        from OpenGL import GL as gl
+        from OpenGL import osmesa
+
+        self.context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self.context:
+            raise RuntimeError("(E) Could not create an OSMesa context")
+
+        # OSMesa always needs a buffer to be current, even though we draw to a framebuffer object
+        self.osmesa_buffer = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        if not osmesa.OSMesaMakeCurrent(
+            self.context,
+            self.osmesa_buffer,
+            gl.GL_UNSIGNED_BYTE,
+            self.width,
+            self.height,
+        ):
+            raise RuntimeError("(E) Could not make the OSMesa context current")
+
+    def resize(self, width: int, height: int):
+        """Resize the render target."""
+        from OpenGL import GL as gl
+
+        self.width = width
+        self.height = height
+
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.color_buffer)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, gl.GL_RGBA8, width, height)
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.depth_buffer)
+        gl.glRenderbufferStorage(
+            gl.GL_RENDERBUFFER, gl.GL_DEPTH_COMPONENT24, width, height
+        )
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, 0)
+
+    def bind(self):
+        from OpenGL import GL as gl
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.frame_buffer_object)
+
+    def finish(self):
+        """Wait for every OpenGL command of the frame to complete. The offscreen equivalent of a buffer flip."""
+        from OpenGL import GL as gl
+
+        gl.glFinish()
+
+    def read_pixels(self) -> NDArray:
+        """Read back the rendered image.
+
+        Returns:
+            NDArray: (height, width, 4) RGBA image, with the first row at the top
+        """
+        from OpenGL import GL as gl
+
+        self.bind()
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        pixels = gl.glReadPixels(
+            0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE
+        )
+        image = np.frombuffer(pixels, dtype=np.uint8).reshape(
+            self.height, self.width, 4
+        )
+        return np.flipud(image)
@@ -0,0 +1,198 @@
+"""Picking models with the mouse.
+
+A ray from the camera through the clicked pixel is tested against the bounds of the scene's
+meshes with the spatial index, nearest first. Each mesh it passes through is then tested
+against its exact triangles, using a BVH over the mesh's triangles that's built the first time
+the mesh is picked and kept with the mesh. Meshes further away than the nearest triangle hit so
+far are never tested.
+"""
+
+import math
+import time
+
+import numpy as np
+
+from bvh import BVH
+from simplify import triangulate
+
+
+def ray_from_pixel(x: float, y: float, window_size, projection_view):
+    """The ray from the camera through a pixel.
+
+    Args:
+        x (float): Pixels from the left of the window
+        y (float): Pixels from the top of the window
+        window_size (tuple[int, int]): Width and height of the window
+        projection_view (NDArray): Projection matrix times the view matrix
+
+    Returns:
+        tuple[NDArray, NDArray]: World space origin on the near plane, and direction, with
+            the far plane at a distance of 1
+    """
+    ndc_x = 2 * x / window_size[0] - 1
+    ndc_y = 1 - 2 * y / window_size[1]
+    inverse = np.linalg.inv(projection_view)
+    near = np.matmul(inverse, [ndc_x, ndc_y, -1, 1])
+    far = np.matmul(inverse, [ndc_x, ndc_y, 1, 1])
+    near = near[:3] / near[3]
+    far = far[:3] / far[3]
+    return near, far - near
+
+
+def ray_triangle_distances(origin, direction, corners, first, second) -> np.ndarray:
+    """Distances along a ray to triangles, by the Möller-Trumbore algorithm. Both sides of
+    each triangle are hit.
+
+    Args:
+        origin (NDArray): (3,) ray origin
+        direction (NDArray): (3,) ray direction
+        corners (NDArray): (triangles, 3) first corner of each triangle
+        first (NDArray): (triangles, 3) second corner minus the first
+        second (NDArray): (triangles, 3) third corner minus the first
+
+    Returns:
+        NDArray: (triangles,) distance in lengths of `direction`, inf where the ray misses
+    """
+    # Cross products written out, as np.cross has a lot of overhead for a few triangles
+    p = (
+        direction[[1, 2, 0]] * second[:, [2, 0, 1]]
+        - direction[[2, 0, 1]] * second[:, [1, 2, 0]]
+    )
+    determinant = np.einsum("ij,ij->i", first, p)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1.0 / determinant
+        offset = origin - corners
+        u = np.einsum("ij,ij->i", offset, p) * inverse
+        q = (
+            offset[:, [1, 2, 0]] * first[:, [2, 0, 1]]
+            - offset[:, [2, 0, 1]] * first[:, [1, 2, 0]]
+        )
+        v = np.matmul(q, direction) * inverse
+        t = np.einsum("ij,ij->i", second, q) * inverse
+    hit = (np.abs(determinant) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return np.where(hit, t, np.inf)
+
+
+class TriangleBVH(BVH):
+    """Bounding volume hierarchy over the triangles of a mesh, in the mesh's own space."""
+
+    # Testing a few more triangles at once with numpy is cheaper than visiting more nodes
+    leaf_size = 16
+
+    def __init__(self, vertices, faces):
+        """
+        Args:
+            vertices (NDArray): (vertices, 3) vertex positions
+            faces (NDArray): (faces, 3) triangles or (faces, 4) quads
+        """
+        corners = np.asarray(vertices, dtype=np.float64)[triangulate(np.asarray(faces))]
+        super().__init__(corners.min(axis=1), corners.max(axis=1))
+        self.corners = corners[:, 0]
+        self.first_edges = corners[:, 1] - corners[:, 0]
+        self.second_edges = corners[:, 2] - corners[:, 0]
+        # The last pose the mesh was picked in and its inverse, as poses are replaced rather
+        # than changed when the mesh moves
+        self.pose = None
+        self.inverse_pose = None
+
+    def intersect_ray(self, origin, direction, max_distance=math.inf) -> float:
+        """Distance along a ray to the nearest triangle.
+
+        Returns:
+            float: Distance in lengths of `direction`, inf if the ray misses within
+                `max_distance`
+        """
+
+        def intersect(triangles, _):
+            distances = ray_triangle_distances(
+                origin,
+                direction,
+                self.corners[triangles],
+                self.first_edges[triangles],
+                self.second_edges[triangles],
+            )
+            nearest = int(distances.argmin())
+            return float(distances[nearest]), int(triangles[nearest])
+
+        distance, _ = self.nearest_along_ray(origin, direction, intersect, max_distance)
+        return distance
+
+
+def triangle_bvh(mesh) -> TriangleBVH:
+    """A mesh's triangle BVH, building it the first time it's needed."""
+    if mesh.triangle_bvh is None:
+        mesh.triangle_bvh = TriangleBVH(mesh.vertices, mesh.faces)
+    return mesh.triangle_bvh
+
+
+def intersect_mesh(mesh, world_pose, origin, direction, max_distance=math.inf) -> float:
+    """Distance along a world space ray to the nearest triangle of a mesh.
+
+    Returns:
+        float: Distance in lengths of `direction`, inf if the ray misses within `max_distance`
+    """
+    bvh = triangle_bvh(mesh)
+    if world_pose is not bvh.pose:
+        bvh.pose = world_pose
+        bvh.inverse_pose = np.linalg.inv(world_pose)
+
+    # The ray in the mesh's space, unnormalised so distances are the same
+    inverse = bvh.inverse_pose
+    local_origin = np.matmul(inverse[:3, :3], origin) + inverse[:3, 3]
+    local_direction = np.matmul(inverse[:3, :3], direction)
+    return bvh.intersect_ray(local_origin, local_direction, max_distance)
+
+
+class PickResult:
+    """The mesh hit by a picking ray, and how long finding it took."""
+
+    def __init__(self, mesh, distance: float, position, elapsed: float):
+        self.mesh = mesh
+        self.model = mesh.parent
+        self.distance = distance
+        self.position = position
+        self.elapsed = elapsed
+
+
+def pick(spatial_index, origin, direction, max_distance=1.0) -> PickResult | None:
+    """Find the nearest pickable mesh a ray hits.
+
+    Args:
+        spatial_index (SpatialIndex): The scene's spatial index
+        origin (NDArray): (3,) world space ray origin
+        direction (NDArray): (3,) world space ray direction
+        max_distance (float, optional): Furthest to look, in lengths of `direction`. Defaults
+            to 1, the far plane for rays from `ray_from_pixel`.
+
+    Returns:
+        PickResult | None: The mesh hit, or None if the ray hits nothing
+    """
+    start = time.perf_counter()
+    if spatial_index.bvh is None:
+        return None
+
+    def intersect(items, nearest_distance):
+        nearest = (math.inf, -1)
+        for item in items.tolist():
+            mesh = spatial_index.meshes[item]
+            if not mesh.parent.pickable:
+                continue
+            distance = intersect_mesh(
+                mesh, spatial_index.poses[item], origin, direction, nearest_distance
+            )
+            if distance < nearest_distance:
+                nearest = (distance, item)
+                nearest_distance = distance
+        return nearest
+
+    distance, item = spatial_index.bvh.nearest_along_ray(
+        origin, direction, intersect, max_distance
+    )
+    if item < 0:
+        return None
+    return PickResult(
+        spatial_index.meshes[item],
+        distance,
+        origin + distance * direction,
+        time.perf_counter() - start,
+    )
@@ -0,0 +1,50 @@
+"""Lightweight timing of the phases of each frame (events, simulation, drawing, ...)."""
+
+import time
+from contextlib import contextmanager
+
+from allocations import track_allocations
+from tracing import Tracer, trace
+
+
+class PhaseTimer:
+    """Records how long each phase of the current frame took, in seconds."""
+
+    def __init__(self):
+        self.phases: dict[str, float] = {}
+        # The phases of the last complete frame
+        self.last_frame_phases: dict[str, float] = {}
+        self.frame_start = time.perf_counter()
+        self.frame_time = 0.0
+
+        # Set to a list to keep the (frame time, phases) of every frame, e.g. when benchmarking
+        self.history: list[tuple[float, dict[str, float]]] | None = None
+
+    def begin_frame(self):
+        """Start timing a new frame, forgetting the phases of the previous one."""
+        self.phases = {}
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        self.frame_time = time.perf_counter() - self.frame_start
+        self.last_frame_phases = self.phases
+
+        tracer = Tracer.current_tracer
+        if tracer.enabled:
+            tracer.record(
+                tracer.name_id("Frame"),
+                int(self.frame_start * 1e9),
+                int((self.frame_start + self.frame_time) * 1e9),
+            )
+        if self.history is not None:
+            self.history.append((self.frame_time, self.phases))
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the code inside the `with` block. Repeated phases within a frame are summed."""
+        start = time.perf_counter()
+        try:
+            with trace(name), track_allocations(name):
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
@@ -0,0 +1,395 @@
+"""Potentially visible sets of the static meshes, baked offline.
+
+The space around the static meshes is divided into a grid of view cells, and for each cell
+the set of static meshes that can be seen from anywhere in it is found ahead of time and saved
+as a bitset. Visibility is sampled by rendering the static meshes into an ID buffer on each
+face of a cube around points on a lattice through the cells, shared by neighbouring cells, and
+meshes whose bounds reach into a cell are always visible from it. Sampling can miss a mesh
+seen through a narrow gap from between the points, so each cell's set also takes in those of
+its neighbours. Dynamic models, including streamed city cells, are never culled, and never
+hide anything.
+
+At runtime, meshes outside the set of the cell the camera is in are culled on top of frustum
+culling. When the camera leaves the grid, nothing extra is culled.
+
+Bake the sets for the current models with `python pvs.py`. They're saved in the asset cache,
+keyed by the static meshes, so they need baking again whenever the static meshes change.
+"""
+
+import argparse
+import ctypes
+import math
+import sys
+import time
+
+import imgui
+import numpy as np
+
+import asset_cache
+from bvh import BVH, frustum_planes, transform_bounds
+from offscreen import use_offscreen_platform
+
+# Directions and up vectors of the six faces of a cube around a sample point
+CUBE_FACES = [
+    ((1, 0, 0), (0, 1, 0)),
+    ((-1, 0, 0), (0, 1, 0)),
+    ((0, 1, 0), (0, 0, 1)),
+    ((0, -1, 0), (0, 0, 1)),
+    ((0, 0, 1), (0, 1, 0)),
+    ((0, 0, -1), (0, 1, 0)),
+]
+
+
+def look_at(position, forward, up):
+    """View matrix of a camera at `position` looking along `forward`, down its -z axis."""
+    backwards = -np.asarray(forward, dtype=float)
+    right = np.cross(up, backwards)
+    right /= np.linalg.norm(right)
+    rotation = np.array([right, np.cross(backwards, right), backwards])
+    view = np.identity(4)
+    view[:3, :3] = rotation
+    view[:3, 3] = -np.matmul(rotation, position)
+    return view
+
+
+def world_bounds(meshes) -> tuple[np.ndarray, np.ndarray]:
+    """(meshes, 3) world space minimum and maximum corners of meshes' bounding boxes."""
+    return transform_bounds(
+        np.array([mesh.bounds[0] for mesh in meshes]).reshape(-1, 3),
+        np.array([mesh.bounds[1] for mesh in meshes]).reshape(-1, 3),
+        np.array([mesh.world_pose for mesh in meshes]).reshape(-1, 4, 4),
+    )
+
+
+class PotentiallyVisibleSets:
+    """Culls the static meshes that can't be seen from the camera's view cell."""
+
+    def __init__(self):
+        self.enabled = True
+        self.meshes = []
+        self.key = None
+
+        # The grid of view cells, and the packed set of visible meshes of each cell
+        self.origin = np.zeros(3)
+        self.cell_size = 0.0
+        self.shape = (0, 0, 0)
+        self.bits: np.ndarray | None = None
+
+        # The static meshes that can't be seen from the cell the camera was last in
+        self.hidden: set = set()
+
+        # Statistics
+        self.current_cell: int | None = None
+        self.culled = 0
+
+    @staticmethod
+    def content_key(meshes) -> str:
+        return asset_cache.content_key(
+            *[mesh.vertices for mesh in meshes],
+            *[mesh.faces for mesh in meshes],
+            np.array([mesh.world_pose for mesh in meshes]),
+        )
+
+    def load(self, meshes) -> bool:
+        """Load the sets baked for these static meshes.
+
+        Returns:
+            bool: Whether any had been baked
+        """
+        self.meshes = list(meshes)
+        self.key = self.content_key(self.meshes)
+        self.bits = None
+        self.current_cell = None
+        self.hidden = set()
+        arrays = asset_cache.load_arrays("pvs", self.key)
+        if arrays is None:
+            if self.meshes:
+                print(
+                    "(W) No potentially visible sets are baked for the static meshes,"
+                    " run `python pvs.py` to bake them"
+                )
+            return False
+
+        self.origin = arrays["origin"]
+        self.cell_size = float(arrays["cell_size"])
+        self.shape = tuple(arrays["shape"].tolist())
+        self.bits = arrays["bits"]
+        return True
+
+    def save(self):
+        asset_cache.save_arrays(
+            "pvs",
+            self.key,
+            {
+                "origin": self.origin,
+                "cell_size": np.array(self.cell_size),
+                "shape": np.array(self.shape),
+                "bits": self.bits,
+            },
+        )
+
+    @property
+    def cell_count(self) -> int:
+        return math.prod(self.shape)
+
+    def cell(self, position) -> int | None:
+        """Index of the view cell a point is in, or None if it's outside the grid."""
+        index = np.floor((np.asarray(position) - self.origin) / self.cell_size).astype(
+            int
+        )
+        if (index < 0).any() or (index >= self.shape).any():
+            return None
+        return int(np.ravel_multi_index(index, self.shape))
+
+    def visible(self, cell: int) -> np.ndarray:
+        """Whether each static mesh can be seen from a view cell."""
+        return np.unpackbits(self.bits[cell], count=len(self.meshes)).astype(bool)
+
+    def cull(self, camera_position) -> set:
+        """The static meshes that can't be seen from the camera's view cell.
+
+        Returns:
+            set[Mesh]: The meshes to cull, only worked out again when the camera changes cell
+        """
+        cell = None
+        if self.enabled and self.bits is not None:
+            cell = self.cell(camera_position)
+        if cell is None:
+            self.current_cell = None
+            self.hidden = set()
+        elif cell != self.current_cell:
+            self.current_cell = cell
+            self.hidden = {
+                self.meshes[index]
+                for index in np.flatnonzero(~self.visible(cell)).tolist()
+            }
+        self.culled = len(self.hidden)
+        return self.hidden
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        if self.bits is None:
+            imgui.text("Not baked, run `python pvs.py`")
+            return
+        _, self.enabled = imgui.checkbox("Potentially visible sets", self.enabled)
+        imgui.text(
+            f"{self.cell_count} cells of {self.cell_size:g} units,"
+            f" {self.bits.nbytes // 1024}KiB"
+        )
+        imgui.text(
+            f"Camera in cell {self.current_cell},"
+            f" {self.culled}/{len(self.meshes)} static meshes culled"
+        )
+
+
+def render_visibility(meshes, points, resolution=128, near=0.05, far=1700.0):
+    """Find which meshes can be seen from points, by rendering them into an ID buffer on
+    each face of a cube around every point.
+
+    Args:
+        meshes (list[Mesh]): Meshes to render, at their current world poses
+        points (NDArray): (points, 3) world space points
+        resolution (int, optional): Width and height of each face. Defaults to 128.
+        near (float, optional): Near clipping plane. Defaults to 0.05.
+        far (float, optional): Far clipping plane. Defaults to 1700.
+
+    Returns:
+        NDArray: (points, meshes) whether any pixel of each mesh was seen from each point
+    """
+    from OpenGL import GL as gl
+
+    from framebuffer import Framebuffer
+    from math_utils import frustrum_matrix
+    from shaders import ObjectIdShader, Shader
+
+    shader = ObjectIdShader()
+    shader.compile()
+    pvm_location = gl.glGetUniformLocation(shader.program_id, "PVM")
+    id_location = gl.glGetUniformLocation(shader.program_id, "object_id")
+
+    frame_buffer = gl.glGenFramebuffers(1)
+    colour, depth = gl.glGenRenderbuffers(2)
+    gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, frame_buffer)
+    for renderbuffer, storage, attachment in (
+        (colour, gl.GL_RGBA8, gl.GL_COLOR_ATTACHMENT0),
+        (depth, gl.GL_DEPTH_COMPONENT24, gl.GL_DEPTH_ATTACHMENT),
+    ):
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, renderbuffer)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, storage, resolution, resolution)
+        gl.glFramebufferRenderbuffer(
+            gl.GL_FRAMEBUFFER, attachment, gl.GL_RENDERBUFFER, renderbuffer
+        )
+    gl.glViewport(0, 0, resolution, resolution)
+    gl.glClearColor(0.0, 0.0, 0.0, 0.0)
+
+    # Mesh index plus one in the red, green and blue bytes, so black is no mesh
+    ids = np.arange(1, len(meshes) + 1)
+    colours = (
+        np.stack([ids & 0xFF, (ids >> 8) & 0xFF, (ids >> 16) & 0xFF], axis=1) / 255.0
+    ).astype("f")
+    poses = [mesh.world_pose for mesh in meshes]
+    lower, upper = world_bounds(meshes)
+    bvh = BVH(lower, upper)
+    projection = frustrum_matrix(-near, near, -near, near, near, far)
+
+    shader.bind()
+    visible = np.zeros((len(points), len(meshes)), dtype=bool)
+    for point_index, point in enumerate(points):
+        for forward, up in CUBE_FACES:
+            projection_view = np.matmul(projection, look_at(point, forward, up))
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            # In the order the scene draws them, so coplanar faces hide each other the same way
+            in_view = np.sort(bvh.query_frustum(frustum_planes(projection_view)))
+            for index in in_view.tolist():
+                mesh = meshes[index]
+                offset, count, primitive, _ = mesh.lods[0]
+                gl.glUniformMatrix4fv(
+                    pvm_location, 1, True, np.matmul(projection_view, poses[index])
+                )
+                gl.glUniform3fv(id_location, 1, colours[index])
+                gl.glBindVertexArray(mesh.vertex_array_object)
+                gl.glDrawElements(
+                    primitive, count, gl.GL_UNSIGNED_INT, ctypes.c_void_p(offset)
+                )
+
+            pixels = np.frombuffer(
+                gl.glReadPixels(
+                    0, 0, resolution, resolution, gl.GL_RGB, gl.GL_UNSIGNED_BYTE
+                ),
+                dtype=np.uint8,
+            ).reshape(-1, 3)
+            seen = np.unique(
+                pixels[:, 0].astype(np.int64)
+                | pixels[:, 1].astype(np.int64) << 8
+                | pixels[:, 2].astype(np.int64) << 16
+            )
+            visible[point_index, seen[seen > 0] - 1] = True
+
+    gl.glBindVertexArray(0)
+    gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, Framebuffer.default_framebuffer)
+    gl.glDeleteRenderbuffers(2, [colour, depth])
+    gl.glDeleteFramebuffers(1, [frame_buffer])
+    Shader.current_shader = 0
+    gl.glUseProgram(0)
+    return visible
+
+
+def bake(
+    pvs: PotentiallyVisibleSets,
+    cell_size=20.0,
+    subdivisions=2,
+    resolution=128,
+    dilation=1,
+):
+    """Bake the potentially visible set of every view cell around the loaded static meshes.
+
+    Args:
+        pvs (PotentiallyVisibleSets): Sets to fill in, with the static meshes loaded
+        cell_size (float, optional): Size of the cubic view cells. Defaults to 20.
+        subdivisions (int, optional): Spaces between sample points along each edge of a cell.
+            Points are on a lattice shared with the neighbouring cells. Defaults to 2, the
+            corners, centre, and middles of the edges and faces.
+        resolution (int, optional): Width and height of each face rendered. Defaults to 128.
+        dilation (int, optional): Also count meshes seen from cells up to this many cells
+            away, to cover gaps between the samples. Defaults to 1.
+    """
+    lower, upper = world_bounds(pvs.meshes)
+    pvs.origin = lower.min(axis=0)
+    pvs.cell_size = cell_size
+    pvs.shape = tuple(
+        np
+        .maximum(np.ceil((upper.max(axis=0) - pvs.origin) / cell_size), 1)
+        .astype(int)
+        .tolist()
+    )
+
+    lattice_shape = tuple(size * subdivisions + 1 for size in pvs.shape)
+    points = np.indices(lattice_shape).reshape(3, -1).T
+    print(
+        f"Rendering {len(points)} points for {pvs.cell_count} cells"
+        f" of {len(pvs.meshes)} static meshes"
+    )
+    visible = render_visibility(
+        pvs.meshes, pvs.origin + points * (cell_size / subdivisions), resolution
+    ).reshape(*lattice_shape, -1)
+
+    # Combine the points in each cell, including those on its faces, one axis at a time
+    for axis in range(3):
+        windows = np.lib.stride_tricks.sliding_window_view(
+            visible, subdivisions + 1, axis=axis
+        )
+        starts = np.arange(0, windows.shape[axis], subdivisions)
+        visible = np.take(windows, starts, axis=axis).any(axis=-1)
+
+    for _ in range(dilation):
+        grown = visible.copy()
+        for axis in range(3):
+
+            def along(part, axis=axis):
+                return tuple(
+                    part if other == axis else slice(None) for other in range(4)
+                )
+
+            grown[along(slice(1, None))] |= visible[along(slice(None, -1))]
+            grown[along(slice(None, -1))] |= visible[along(slice(1, None))]
+        visible = grown
+    visible = visible.reshape(pvs.cell_count, -1)
+
+    # Meshes reaching into a cell can be seen from inside their bounds, where sampling
+    # could miss them
+    cell_lower = pvs.origin + np.indices(pvs.shape).reshape(3, -1).T * cell_size
+    visible |= (
+        (lower[np.newaxis] <= cell_lower[:, np.newaxis] + cell_size)
+        & (upper[np.newaxis] >= cell_lower[:, np.newaxis])
+    ).all(axis=2)
+
+    pvs.bits = np.packbits(visible, axis=1)
+    # So the hidden meshes are found again from the new sets
+    pvs.current_cell = None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Bake the potentially visible sets of the static meshes"
+    )
+    parser.add_argument("--cell-size", type=float, default=20.0)
+    parser.add_argument(
+        "--subdivisions",
+        type=int,
+        default=2,
+        help="spaces between sample points along each edge of a cell",
+    )
+    parser.add_argument(
+        "--dilation",
+        type=int,
+        default=1,
+        help="also count meshes seen from cells this many cells away",
+    )
+    parser.add_argument(
+        "--resolution", type=int, default=128, help="size of the ID buffers rendered"
+    )
+    args = parser.parse_args()
+
+    # Has to happen before anything imports OpenGL
+    use_offscreen_platform()
+
+    from main_scene import MainScene
+
+    scene = MainScene(headless=True)
+    pvs = scene.pvs
+
+    start = time.perf_counter()
+    bake(pvs, args.cell_size, args.subdivisions, args.resolution, args.dilation)
+    pvs.save()
+
+    visible = np.unpackbits(pvs.bits, axis=1, count=len(pvs.meshes))
+    print(
+        f"Baked {pvs.cell_count} cells in {time.perf_counter() - start:.1f}s,"
+        f" {visible.mean() * 100:.1f}% of static meshes visible per cell on average,"
+        f" {pvs.bits.nbytes} bytes"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
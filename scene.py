@@ -1,6 +1,9 @@
 """Base class for a PyGame based OpenGL scene."""
 
+import threading
+import time
 from collections import deque
+from itertools import groupby
 from typing import TYPE_CHECKING, Self, Type
 
 import imgui
@@ -9,10 +12,25 @@ import pygame
 from imgui.integrations.pygame import PygameRenderer
 from OpenGL import GL as gl
 
+from allocations import AllocationTracker, GarbageCollectionPolicy
+from animation import AnimationSystem, TransformInterpolator
+from bvh import SpatialIndex
 from camera import Camera, FreeCamera, OrbitCamera
-from entity import Entity
+from command_list import CommandLists
+from gpu_timer import GPUTimer
+from indirect import IndirectRenderer
 from light import Light
 from math_utils import frustrum_matrix
+from occlusion import OcclusionCuller
+from offscreen import OffscreenContext
+from picking import PickResult, pick, ray_from_pixel
+from profiling import PhaseTimer
+from pvs import PotentiallyVisibleSets
+from scheduler import UpdateScheduler
+from snapshot import FramePipeline, RenderSnapshot
+from spikes import SpikeDetector
+from telemetry import FrameTelemetry
+from tracing import trace, traced
 
 if TYPE_CHECKING:
     from model import Model
@@ -27,9 +45,14 @@ class Scene:
 
     def update_viewport(self):
         """Update the viewport if the window size, fov, or clipping planes are changed."""
-        pygame.display.set_mode(
-            self.window_size, pygame.OPENGL | pygame.DOUBLEBUF | pygame.RESIZABLE
-        )
+        if self.headless:
+            self.offscreen.resize(*self.window_size)
+        else:
+            pygame.display.set_mode(
+                self.window_size,
+                pygame.OPENGL | pygame.DOUBLEBUF | pygame.RESIZABLE,
+                vsync=self.vsync,
+            )
         gl.glViewport(0, 0, self.window_size[0], self.window_size[1])
 
         aspect_ratio = self.window_size[1] / self.window_size[0]
@@ -43,10 +66,20 @@ class Scene:
             left, right, top, bottom, self.near_clipping, self.far_clipping
         )
 
-    def __init__(self, width=960, height=720):
-        """Initialises the scene"""
+    def __init__(self, width=960, height=720, headless=False):
+        """Initialises the scene
+
+        Args:
+            width (int, optional): Window width. Defaults to 960.
+            height (int, optional): Window height. Defaults to 720.
+            headless (bool, optional): Render to an offscreen framebuffer with no window, input
+                or GUI. Needs `offscreen.use_offscreen_platform()` to be called before OpenGL is imported.
+        """
         Scene.current_scene = self
         self.window_size = (width, height)
+        self.headless = headless
+        self.offscreen: OffscreenContext | None = None
+        self.frame_count = 0
         self.wireframe = False
         self.fov = 90.0
         self.projection_matrix = None
@@ -54,8 +87,50 @@ class Scene:
         self.far_clipping = 1700.0
         self.x_sensitivity = 3
         self.y_sensitivity = 3
-        self.fps_max = 300
+        self.fps_max = 300  # 0 for uncapped
+        self.vsync = False
+        # The simulation runs in fixed steps, independent of the frame rate
+        self.simulation_rate = 60
+        self.max_simulation_steps = 8
+        self.simulation_time = 0.0
+        self.simulation_accumulator = 0.0
+        # Simulate the next frame on a worker thread while drawing the current one
+        self.pipelined = False
+        self.pipeline = FramePipeline(self)
         self.frame_times = deque(maxlen=100)
+        # Bounding volume hierarchy over the meshes, for culling and picking
+        self.spatial_index = SpatialIndex()
+        self.frustum_culling = True
+        # The meshes to draw this frame, or None to draw every mesh
+        self.visible_meshes: set | None = None
+        # Which static meshes can be seen from each part of the scene, baked offline
+        self.pvs = PotentiallyVisibleSets()
+        # Skips meshes hidden behind others with occlusion queries, off by default
+        self.occlusion = OcclusionCuller()
+        # Culls and draws the static models on the GPU with multi-draw indirect, off by default
+        self.indirect = IndirectRenderer()
+        # Draws the static models by replaying recorded command lists, off by default
+        self.command_lists = CommandLists()
+        # The model last picked by right clicking on it, and the pick that found it
+        self.selected_model: "Model" = None  # type: ignore
+        self.last_pick: PickResult | None = None
+        # Set when a model is picked, until the debug menu has shown it
+        self.selection_changed = False
+        # Triangles drawn so far this frame, and in the whole of the last frame
+        self.triangles_drawn = 0
+        self.last_triangles_drawn = 0
+        # Time spent in each phase of the last frame
+        self.timer = PhaseTimer()
+        # GPU time spent in each render pass, read back a few frames late
+        self.gpu_timer = GPUTimer()
+        # Saves traces of frames that are much slower than usual, off by default
+        self.spike_detector = SpikeDetector()
+        # Optionally runs garbage collection only in the time left at the end of a frame
+        self.gc_policy = GarbageCollectionPolicy()
+        # Histograms of every frame and phase time since startup
+        self.telemetry = FrameTelemetry()
+        # Step every frame by this many seconds instead of the real frame time, for reproducible runs
+        self.fixed_delta_time: float | None = None
         self.clock: pygame.time.Clock = None
         self.delta_time = 0
         self.mouse_locked = True
@@ -63,30 +138,16 @@ class Scene:
 
         pygame.init()
 
-        pygame.display.set_caption("Guraffic Park")
-        pygame.display.set_icon(pygame.image.load("./textures/logo.png"))
-        pygame.display.set_mode(
-            self.window_size, pygame.OPENGL | pygame.DOUBLEBUF | pygame.RESIZABLE
-        )
-
-        # Stops the mouse from being able to leave the window
-        pygame.event.set_grab(True)
-        pygame.mouse.set_visible(False)
-
-        # Center the mouse
-        pygame.mouse.set_pos((self.window_size[0] / 2, self.window_size[1] / 2))
+        if headless:
+            self.mouse_locked = False
+            self.offscreen = OffscreenContext(width, height)
+            self.imgui_impl = None
+        else:
+            self.create_window()
 
         # Print numpy matrices to a reasonable degree of accuracy for debugging
         np.set_printoptions(precision=3, suppress=True)
 
-        # Create the GUI context
-        imgui.create_context()
-        self.imgui_impl = PygameRenderer()
-
-        io = imgui.get_io()
-        io.fonts.add_font_default()
-        io.display_size = self.window_size
-
         self.update_viewport()
 
         # this selects the background color
@@ -105,8 +166,49 @@ class Scene:
         self.camera = self.free_camera
         self.light = Light()
 
+        # Scene logic that runs each simulation step. Register updates here rather than in `run`
+        self.scheduler = UpdateScheduler()
+
+        # Entities moved by the simulation, blended between steps when rendering
+        self.interpolation = TransformInterpolator()
+
+        # Every keyframe animation in the scene, evaluated together once per step.
+        # Runs after other updates so that manually driven clips are applied the same tick.
+        self.animations = AnimationSystem()
+        self.scheduler.every_frame("Animations", self.animations.update, order=100)
+
         # This will maintain a list of models to draw in the scene,
         self.models: list[Type["Model"]] = []
+        # Counts changes to which models are visible and to their meshes, so the spatial
+        # index knows when to rebuild without comparing every mesh. Held while changing them,
+        # as snapshots are captured on the worker thread in pipelined mode
+        self.models_version = 0
+        self.models_lock = threading.Lock()
+
+    def create_window(self):
+        """Open the PyGame window, grab the mouse and create the GUI context."""
+        pygame.display.set_caption("Guraffic Park")
+        pygame.display.set_icon(pygame.image.load("./textures/logo.png"))
+        pygame.display.set_mode(
+            self.window_size,
+            pygame.OPENGL | pygame.DOUBLEBUF | pygame.RESIZABLE,
+            vsync=self.vsync,
+        )
+
+        # Stops the mouse from being able to leave the window
+        pygame.event.set_grab(True)
+        pygame.mouse.set_visible(False)
+
+        # Center the mouse
+        pygame.mouse.set_pos((self.window_size[0] / 2, self.window_size[1] / 2))
+
+        # Create the GUI context
+        imgui.create_context()
+        self.imgui_impl = PygameRenderer()
+
+        io = imgui.get_io()
+        io.fonts.add_font_default()
+        io.display_size = self.window_size
 
     def draw(self):
         """Draw all models in the scene"""
@@ -117,10 +219,116 @@ class Scene:
         self.camera.update()
 
         # then we loop over all models in the list and draw them
-        for model in self.models:
-            model.draw()
+        self.draw_models()
 
-        pygame.display.flip()
+    def models_changed(self):
+        """Call after adding or removing models or meshes, or showing or hiding a model, while
+        holding `models_lock`.
+        """
+        self.models_version += 1
+
+    def cull(self, models, models_version: int):
+        """Update the spatial index with the meshes that could be drawn this frame, and find
+        the ones inside the camera's view.
+
+        Args:
+            models (Iterable[tuple[Sequence[Mesh], Sequence[NDArray] | None]]): Meshes of
+                each visible model and their world poses, or None for their current poses
+            models_version (int): `models_version` when the models were gathered
+        """
+        spatial_index = self.spatial_index
+        spatial_index.update(models, models_version)
+
+        visible = None
+        if self.frustum_culling:
+            meshes = spatial_index.meshes
+            visible = {
+                meshes[item]
+                for item in spatial_index.cull(
+                    np.matmul(self.projection_matrix, self.camera.view_matrix)
+                ).tolist()
+            }
+        else:
+            spatial_index.visible = len(spatial_index.meshes)
+        hidden = self.pvs.cull(np.linalg.inv(self.camera.view_matrix)[:3, 3])
+        if hidden:
+            visible = (
+                set(spatial_index.meshes) if visible is None else visible
+            ) - hidden
+        self.visible_meshes = visible
+
+        self.occlusion.begin_frame()
+        self.command_lists.begin_frame(self.models)
+
+    def static_meshes(self) -> list:
+        """Meshes of every static model, which the potentially visible sets are baked for."""
+        return [mesh for model in self.models if model.static for mesh in model.meshes]
+
+    def draw_models(self):
+        """Draw every model, timing each run of models in the same render pass together."""
+        with trace("cull"):
+            self.cull(
+                ((model.meshes, None) for model in self.models if model.visible),
+                self.models_version,
+            )
+
+        for render_pass, models in groupby(
+            self.models, key=lambda model: model.render_pass
+        ):
+            with self.gpu_timer.render_pass(render_pass):
+                for model in models:
+                    model.draw()
+                self.indirect.flush(self.projection_matrix, self.camera.view_matrix)
+                self.occlusion.flush(self.projection_matrix, self.camera.view_matrix)
+
+    def prepare_frame(self):
+        """Called in pipelined mode while the world isn't being simulated, before `draw_snapshot`.
+        Do any rendering here that needs the live scene rather than a snapshot.
+        """
+
+    def draw_snapshot(self, snapshot: RenderSnapshot):
+        """Draw the models captured in a snapshot. Used instead of `draw` in pipelined mode."""
+        with trace("cull"):
+            self.cull(
+                (
+                    (model_snapshot.meshes, model_snapshot.world_poses)
+                    for model_snapshot in snapshot.models
+                ),
+                snapshot.models_version,
+            )
+
+        for render_pass, model_snapshots in groupby(
+            snapshot.models, key=lambda model_snapshot: model_snapshot.model.render_pass
+        ):
+            with self.gpu_timer.render_pass(render_pass):
+                for model_snapshot in model_snapshots:
+                    model_snapshot.model.draw(model_snapshot.world_poses)
+                self.indirect.flush(self.projection_matrix, self.camera.view_matrix)
+                self.occlusion.flush(self.projection_matrix, self.camera.view_matrix)
+
+    def pick(self, x: float, y: float) -> PickResult | None:
+        """Find the model drawn at a pixel, as of the last frame drawn.
+
+        Args:
+            x (float): Pixels from the left of the window
+            y (float): Pixels from the top of the window
+
+        Returns:
+            PickResult | None: The nearest mesh under the pixel, or None if there isn't one
+        """
+        origin, direction = ray_from_pixel(
+            x,
+            y,
+            self.window_size,
+            np.matmul(self.projection_matrix, self.camera.view_matrix),
+        )
+        return pick(self.spatial_index, origin, direction)
+
+    def select(self, x: float, y: float):
+        """Select the model drawn at a pixel, or nothing if there's only background there."""
+        self.last_pick = self.pick(x, y)
+        self.selected_model = None if self.last_pick is None else self.last_pick.model
+        self.selection_changed = True
 
     def keyboard(self, event):
         """Method to process keyboard events.
@@ -136,8 +344,12 @@ class Scene:
             pygame.mouse.set_visible(True)
             self.mouse_locked = False
 
+    @traced
     def run(self):
         """Method to handle PyGame events for user interaction."""
+        if self.headless:
+            return
+
         # check whether the window has been closed
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -154,6 +366,15 @@ class Scene:
 
             self.camera.handle_pygame_event(event)
 
+            if (
+                event.type == pygame.MOUSEBUTTONDOWN
+                and event.button == 3
+                and not self.mouse_locked
+                and not imgui.get_io().want_capture_mouse
+            ):
+                # Right clicking on the 3D scene selects the model under the mouse
+                self.select(*event.pos)
+
             if self.mouse_locked:
                 # Re-center the mouse after every frame to stop it escaping
                 pygame.mouse.set_pos((self.window_size[0] / 2, self.window_size[1] / 2))
@@ -169,31 +390,147 @@ class Scene:
     def debug_menu(self):
         """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
 
-    def start(self):
-        """Draws the scene in a loop until exit."""
+    def simulate(self, delta_time: float) -> float:
+        """Advance the simulation by `delta_time` seconds of real time, in fixed steps.
+
+        Args:
+            delta_time (float): Seconds since the last frame
+
+        Returns:
+            float: How far between the last two steps the rendered frame is, in [0, 1)
+        """
+        step = 1.0 / self.simulation_rate
+        self.simulation_accumulator += delta_time
+
+        steps = 0
+        while self.simulation_accumulator >= step:
+            if steps == self.max_simulation_steps:
+                # We can't keep up, drop the time rather than spiralling further behind
+                self.simulation_accumulator = 0.0
+                break
+
+            self.interpolation.store_previous()
+            self.scheduler.update(step)
+            self.simulation_time += step
+            self.simulation_accumulator -= step
+            steps += 1
+
+        return self.simulation_accumulator / step
+
+    def start(self, frames: int | None = None):
+        """Draws the scene in a loop until exit.
+
+        Args:
+            frames (int, optional): Stop after drawing this many frames. Defaults to running until quit.
+        """
         self.running = True
         self.clock = pygame.time.Clock()
+        last_frame = None if frames is None else self.frame_count + frames
 
-        while self.running:
+        while self.running and self.frame_count != last_frame:
             # Calculate frame time
             self.delta_time = self.clock.tick(self.fps_max) / 1000
             self.frame_times.append(self.clock.get_time())
+            if self.fixed_delta_time is not None:
+                self.delta_time = self.fixed_delta_time
 
-            self.run()
+            self.triangles_drawn = 0
+            self.timer.begin_frame()
+            self.gpu_timer.begin_frame()
+            self.spike_detector.begin_frame()
+            AllocationTracker.current_tracker.begin_frame()
 
-            # Generate GUI
-            self.imgui_impl.process_inputs()
-            imgui.new_frame()
-            self.debug_menu()
+            with self.timer.phase("events"):
+                self.run()
 
-            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            if self.pipelined:
+                self.pipelined_frame()
+            else:
+                self.serial_frame()
+
+            with self.timer.phase("present"):
+                if self.headless:
+                    self.offscreen.finish()
+                else:
+                    pygame.display.flip()
+
+            with self.timer.phase("gc"):
+                self.gc_policy.collect_in_slack(self.frame_slack())
+
+            AllocationTracker.current_tracker.end_frame()
+            self.gpu_timer.end_frame()
+            self.timer.end_frame()
+            self.spike_detector.end_frame(self.frame_count, self.timer.frame_time)
+            self.telemetry.record_frame(
+                self.timer.frame_time, self.timer.last_frame_phases
+            )
+            self.last_triangles_drawn = self.triangles_drawn
+            self.frame_count += 1
+
+        self.pipeline.stop()
+
+    def frame_slack(self) -> float:
+        """Seconds left before the next frame is due, or 0 when the frame rate is uncapped."""
+        if self.fps_max <= 0:
+            return 0.0
+        elapsed = time.perf_counter() - self.timer.frame_start
+        return max(1.0 / self.fps_max - elapsed, 0.0)
+
+    def begin_gui(self):
+        """Generate the GUI for this frame."""
+        if self.headless:
+            return
+        self.imgui_impl.process_inputs()
+        imgui.new_frame()
+        self.debug_menu()
+
+    def render_gui(self):
+        if self.headless:
+            return
+        imgui.render()
+        with trace("imgui render"), self.gpu_timer.render_pass("imgui"):
+            self.imgui_impl.render(imgui.get_draw_data())
+
+    def serial_frame(self):
+        """Simulate, then draw, one after the other on the main thread."""
+        self.pipeline.stop()
+
+        with self.timer.phase("simulation"):
+            alpha = self.simulate(self.delta_time)
+            self.interpolation.apply(alpha)
+
+        with self.timer.phase("gui"):
+            self.begin_gui()
 
+        with self.timer.phase("draw"):
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
             self.draw()
 
-            # Render GUI
-            imgui.render()
-            self.imgui_impl.render(imgui.get_draw_data())
+        with self.timer.phase("gui"):
+            self.render_gui()
+
+        self.interpolation.restore()
+
+    def pipelined_frame(self):
+        """Draw this frame from a snapshot while the next frame is simulated on a worker thread."""
+        # Wait for the worker, after this the world is ours until the next submit
+        with self.timer.phase("simulation"):
+            snapshot = self.pipeline.next_snapshot(self.delta_time)
+
+        with self.timer.phase("draw"):
+            self.camera.update()
+
+        # The debug menu is free to modify the world here
+        with self.timer.phase("gui"):
+            self.begin_gui()
+
+        with self.timer.phase("draw"):
+            self.prepare_frame()
+
+            self.pipeline.submit(self.delta_time)
+
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            self.draw_snapshot(snapshot)
 
-            for entity in Entity.all_entities:
-                entity.clear_entity_cache()
-            pygame.display.flip()
+        with self.timer.phase("gui"):
+            self.render_gui()
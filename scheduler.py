@@ -0,0 +1,145 @@
+"""Scheduling of per-tick scene logic. Updates can run every frame, at a fixed rate,
+or only when some value they depend on changes, so slowly changing logic isn't re-run every frame.
+"""
+
+import time
+from collections.abc import Callable
+from typing import Any
+
+import imgui
+
+
+class ScheduledUpdate:
+    """An update callback registered with an `UpdateScheduler`, and the time spent running it."""
+
+    def __init__(
+        self,
+        name: str,
+        callback: Callable[[float], Any],
+        rate: float | None = None,
+        key: Callable[[], Any] | None = None,
+        order: int = 0,
+    ):
+        """Create a ScheduledUpdate.
+
+        Args:
+            name (str): Name shown in the debug menu
+            callback (Callable[[float], Any]): Called with the seconds elapsed since it last ran
+            rate (float, optional): Maximum number of runs per second. Defaults to every frame.
+            key (Callable[[], Any], optional): Only run when the value returned by key changes.
+            order (int, optional): Updates with a lower order run first. Defaults to 0.
+        """
+        self.name = name
+        self.callback = callback
+        self.interval = 1.0 / rate if rate else 0.0
+        self.key = key
+        self.order = order
+        self.enabled = True
+
+        self.last_key = None
+        self.last_run: float | None = None
+        self.next_run = 0.0
+
+        # Profiling information
+        self.calls = 0
+        self.skips = 0
+        self.total_time = 0.0
+        self.last_duration = 0.0
+
+    @property
+    def average_time(self) -> float:
+        """Average seconds spent per call"""
+        return self.total_time / self.calls if self.calls > 0 else 0.0
+
+    def due(self, scene_time: float) -> bool:
+        """Check if the update needs to run at `scene_time`"""
+        if not self.enabled:
+            return False
+
+        if self.interval > 0.0 and scene_time < self.next_run:
+            return False
+
+        if self.key is not None:
+            key = self.key()
+            if self.calls > 0 and key == self.last_key:
+                return False
+            self.last_key = key
+
+        return True
+
+    def run(self, scene_time: float):
+        """Run the callback and record how long it took"""
+        delta_time = 0.0 if self.last_run is None else scene_time - self.last_run
+
+        start = time.perf_counter()
+        self.callback(delta_time)
+        self.last_duration = time.perf_counter() - start
+
+        self.calls += 1
+        self.total_time += self.last_duration
+        self.last_run = scene_time
+
+        if self.interval > 0.0:
+            self.next_run += self.interval
+            # Don't try to catch up on runs missed during a long frame
+            if self.next_run <= scene_time:
+                self.next_run = scene_time + self.interval
+
+
+class UpdateScheduler:
+    """Runs the scene's update callbacks once per tick, skipping any that aren't due."""
+
+    def __init__(self):
+        self.updates: list[ScheduledUpdate] = []
+        self.time = 0.0
+
+    def every_frame(self, name: str, callback: Callable[[float], Any], order=0):
+        """Run `callback` every tick."""
+        return self.register(ScheduledUpdate(name, callback, order=order))
+
+    def at_rate(
+        self, name: str, callback: Callable[[float], Any], rate: float, order=0
+    ):
+        """Run `callback` at most `rate` times per second."""
+        return self.register(ScheduledUpdate(name, callback, rate=rate, order=order))
+
+    def on_change(
+        self,
+        name: str,
+        callback: Callable[[float], Any],
+        key: Callable[[], Any],
+        order=0,
+    ):
+        """Run `callback` only on ticks where the value returned by `key` has changed."""
+        return self.register(ScheduledUpdate(name, callback, key=key, order=order))
+
+    def register(self, update: ScheduledUpdate) -> ScheduledUpdate:
+        """Add an update to the scheduler. Updates run by order, then in the order they are registered."""
+        update.next_run = self.time
+        self.updates.append(update)
+        self.updates.sort(key=lambda scheduled: scheduled.order)
+        return update
+
+    def remove(self, update: ScheduledUpdate):
+        self.updates.remove(update)
+
+    def update(self, delta_time: float):
+        """Advance the scheduler by `delta_time` seconds and run every due update."""
+        self.time += delta_time
+
+        for update in self.updates:
+            if update.due(self.time):
+                update.run(self.time)
+            else:
+                update.skips += 1
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        for update in self.updates:
+            _, update.enabled = imgui.checkbox(update.name, update.enabled)
+            imgui.same_line()
+            imgui.text(
+                f"{update.last_duration * 1000:.3f}ms last,"
+                f" {update.average_time * 1000:.3f}ms avg,"
+                f" {update.calls} runs, {update.skips} skipped"
+            )
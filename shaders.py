@@ -4,6 +4,7 @@ from OpenGL import GL as gl
 from OpenGL.GL import shaders
 
 from scene import Scene
+from tracing import traced
 
 
 class Singleton(type):
@@ -53,6 +54,7 @@ class Shader(metaclass=Singleton):
 
         self.compiled = False
 
+    @traced
     def compile(self):
         """Call this function to compile the GLSL codes for both shaders.
         :return:
@@ -111,6 +113,68 @@ class SkyBoxShader(Shader):
         super().__init__(program_name=name)
 
 
+class OcclusionShader(Shader):
+    def __init__(self, name="occlusion"):
+        super().__init__(program_name=name)
+
+
+class ObjectIdShader(Shader):
+    def __init__(self, name="object_id"):
+        super().__init__(program_name=name)
+
+
+class IndirectShader(Shader):
+    def __init__(self, name="indirect"):
+        super().__init__(program_name=name)
+
+
+class ComputeShader(Shader):
+    """A program with only a compute shader, for work on the GPU that isn't drawing."""
+
+    def __init__(self, program_name, compute_shader=None):
+        """
+        Args:
+            program_name (str): Name of the folder in shaders/ holding the shader
+            compute_shader (str, optional): File containing the compute shader GLSL code.
+                Defaults to shaders/{program_name}/compute_shader.glsl.
+        """
+        self.program_name = program_name
+        self.program_id = 0
+
+        if compute_shader is None:
+            compute_shader = f"shaders/{program_name}/compute_shader.glsl"
+
+        with open(compute_shader, "r", encoding="utf-8") as file:
+            self.compute_shader_source = file.read()
+
+        self.compiled = False
+
+    @traced
+    def compile(self):
+        if self.compiled:
+            return
+
+        try:
+            self.program_id = gl.glCreateProgram()
+            print(f"Compiling {self.program_name} shader")
+            gl.glAttachShader(
+                self.program_id,
+                shaders.compileShader(self.compute_shader_source, gl.GL_COMPUTE_SHADER),
+            )
+        except Exception as e:
+            raise RuntimeError(
+                f"Error compiling {self.program_name} shader: {e}"
+            ) from e
+
+        gl.glLinkProgram(self.program_id)
+        self.compiled = True
+
+
+class IndirectCullShader(ComputeShader):
+    def __init__(self, name="indirect_cull"):
+        super().__init__(program_name=name)
+
+
 class EnvironmentShader(Shader):
     def __init__(self, name="environment"):
         super().__init__(program_name=name)
@@ -10,6 +10,8 @@ out vec4 FragCol;
 uniform vec3 view_pos;
 uniform int has_texture;
 uniform sampler2D textureObject; // texture object
+uniform sampler2DArray textureArray; // texture array, used instead if texture_layer >= 0
+uniform int texture_layer;
 
 // material uniforms
 uniform vec3 Ka;    // ambient reflection properties of the material
@@ -27,7 +29,9 @@ uniform vec3 Is;    // specular properties of the light source
 ///=== main shader code
 void main() {
     vec3 texval = Kd;
-    if(has_texture == 1)
+    if(has_texture == 1 && texture_layer >= 0)
+        texval = texture(textureArray, vec3(TexCoords, texture_layer)).rgb;
+    else if(has_texture == 1)
         texval = texture(textureObject, TexCoords).rgb;
 
     vec3 ambient = Ia*texval;
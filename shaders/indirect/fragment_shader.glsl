@@ -0,0 +1,48 @@
+#version 430 core
+
+in vec3 FragPos;
+in vec3 Normal;
+in vec2 TexCoords;
+flat in vec3 Ka;
+flat in vec3 Kd;
+flat in vec3 Ks;
+flat in float Ns;
+flat in int has_texture;
+flat in int texture_layer;
+
+out vec4 FragCol;
+
+//=== uniforms
+uniform vec3 view_pos;
+uniform sampler2D textureObject; // texture object
+uniform sampler2DArray textureArray; // texture array, used instead if texture_layer >= 0
+
+// light source
+uniform vec3 light_pos; // light direction
+uniform vec3 Ia;    // ambient light properties
+uniform vec3 Id;    // diffuse properties of the light source
+uniform vec3 Is;    // specular properties of the light source
+
+
+///=== main shader code
+void main() {
+    vec3 texval = Kd;
+    if(has_texture == 1 && texture_layer >= 0)
+        texval = texture(textureArray, vec3(TexCoords, texture_layer)).rgb;
+    else if(has_texture == 1)
+        texval = texture(textureObject, TexCoords).rgb;
+
+    vec3 ambient = Ia*texval;
+
+    vec3 light_direction = normalize(-light_pos);
+    float diff = max(dot(Normal, light_direction), 0.0);
+    vec3 diffuse = Id * diff * texval;
+
+    vec3 viewDir = normalize(view_pos - FragPos);
+    vec3 reflectDir = reflect(-light_direction, Normal);
+    float spec = pow(max(dot(viewDir, reflectDir),0.0), Ns);
+
+    vec3 specular = Is * spec * Ks;
+
+    FragCol = vec4(ambient + diffuse + specular, 1.0);
+}
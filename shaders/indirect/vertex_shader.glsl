@@ -0,0 +1,57 @@
+#version 430 core
+
+// The cartoon shader for meshes drawn by glMultiDrawElementsIndirect, reading each mesh's
+// matrices and material from a buffer instead of uniforms
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec3 normal;
+layout(location = 2) in vec2 texCoord;
+// The mesh being drawn, read once per instance from the draw's base instance
+layout(location = 3) in uint draw_index;
+
+out vec3 FragPos;
+out vec3 Normal;
+out vec2 TexCoords;
+flat out vec3 Ka;
+flat out vec3 Kd;
+flat out vec3 Ks;
+flat out float Ns;
+flat out int has_texture;
+flat out int texture_layer;
+
+struct MeshData {
+	mat4 model;
+	mat4 normal_matrix;
+	vec4 lower;
+	vec4 upper;
+	vec4 sphere;
+	vec4 ambient;
+	vec4 diffuse;
+	vec4 specular;
+	vec4 lod_errors;
+	uvec4 lod_first;
+	uvec4 lod_count;
+	ivec4 info;
+};
+
+layout(std430, binding = 0) readonly buffer Meshes { MeshData meshes[]; };
+
+uniform mat4 PV;
+uniform mat3 V;
+
+void main() {
+	MeshData mesh = meshes[draw_index];
+	vec4 world_position = mesh.model * vec4(position, 1.0);
+
+	FragPos = world_position.xyz;
+	// The view matrix has no scale, so it's its own inverse transpose
+	Normal = normalize(V * mat3(mesh.normal_matrix) * normal);
+	TexCoords = texCoord;
+	Ka = mesh.ambient.xyz;
+	Kd = mesh.diffuse.xyz;
+	Ks = mesh.specular.xyz;
+	Ns = mesh.ambient.w;
+	has_texture = mesh.info.z;
+	texture_layer = mesh.info.w;
+
+	gl_Position = PV * world_position;
+}
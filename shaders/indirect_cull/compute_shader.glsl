@@ -0,0 +1,97 @@
+#version 430 core
+
+// Culls each mesh of the indirect batch against the frustum, chooses its level of detail,
+// and writes its draw command. Culled meshes get a command with no instances, so every
+// mesh keeps its slot and the batch draws in the same order as the meshes one by one.
+layout(local_size_x = 64) in;
+
+struct MeshData {
+	mat4 model;
+	mat4 normal_matrix;
+	vec4 lower;			// world space bounds
+	vec4 upper;
+	vec4 sphere;		// world space bounding sphere, radius in w
+	vec4 ambient;		// Ns in w
+	vec4 diffuse;
+	vec4 specular;
+	vec4 lod_errors;	// world space error of each level of detail
+	uvec4 lod_first;	// first index of each level
+	uvec4 lod_count;	// index count of each level
+	ivec4 info;			// base vertex, levels, has_texture, texture_layer
+};
+
+struct DrawCommand {
+	uint count;
+	uint instance_count;
+	uint first_index;
+	int base_vertex;
+	uint base_instance;
+};
+
+layout(std430, binding = 0) readonly buffer Meshes { MeshData meshes[]; };
+// Whether each mesh's model is being drawn and it's in the camera cell's visible set
+layout(std430, binding = 1) readonly buffer Enabled { uint enabled[]; };
+// Level of detail each mesh was last drawn with, for hysteresis
+layout(std430, binding = 2) buffer Lods { uint lods[]; };
+layout(std430, binding = 3) writeonly buffer Commands { DrawCommand commands[]; };
+
+uniform uint mesh_count;
+uniform vec4 planes[6];			// frustum planes pointing inwards
+uniform vec3 camera_position;
+uniform float pixels_per_unit;	// pixels across one unit, one unit from the camera
+uniform float lod_pixel_error;
+uniform float lod_hysteresis;
+uniform bool use_lods;
+
+bool in_frustum(vec3 lower, vec3 upper) {
+	for (int i = 0; i < 6; i++) {
+		// The corner furthest along the plane's normal
+		vec3 corner = mix(lower, upper, greaterThanEqual(planes[i].xyz, vec3(0.0)));
+		if (dot(planes[i].xyz, corner) + planes[i].w < 0.0)
+			return false;
+	}
+	return true;
+}
+
+uint select_lod(uint index) {
+	MeshData mesh = meshes[index];
+	int levels = mesh.info.y;
+	if (!use_lods || levels == 1)
+		return 0u;
+
+	float distance = length(mesh.sphere.xyz - camera_position) - mesh.sphere.w;
+	if (distance <= 0.0)
+		return 0u;
+
+	float scale = pixels_per_unit / distance;
+	int lod = min(int(lods[index]), levels - 1);
+	while (lod > 0 && mesh.lod_errors[lod] * scale > lod_pixel_error)
+		lod--;
+	while (lod + 1 < levels && mesh.lod_errors[lod + 1] * scale <= lod_pixel_error * (1.0 - lod_hysteresis))
+		lod++;
+	return uint(lod);
+}
+
+void main(void)
+{
+	uint index = gl_GlobalInvocationID.x;
+	if (index >= mesh_count)
+		return;
+
+	MeshData mesh = meshes[index];
+	DrawCommand command;
+	command.count = 0u;
+	command.instance_count = 0u;
+	command.first_index = 0u;
+	command.base_vertex = mesh.info.x;
+	command.base_instance = index;
+
+	if (enabled[index] != 0u && in_frustum(mesh.lower.xyz, mesh.upper.xyz)) {
+		uint lod = select_lod(index);
+		lods[index] = lod;
+		command.count = mesh.lod_count[lod];
+		command.instance_count = 1u;
+		command.first_index = mesh.lod_first[lod];
+	}
+	commands[index] = command;
+}
@@ -0,0 +1,11 @@
+#version 330 core
+
+// The index of the mesh being drawn, plus one, as a colour
+uniform vec3 object_id;
+
+out vec4 final_color;
+
+void main(void)
+{
+	final_color = vec4(object_id, 1.0);
+}
@@ -0,0 +1,11 @@
+#version 330 core
+
+// Meshes bind their positions to the first attribute
+layout(location = 0) in vec3 position;
+
+uniform mat4 PVM;
+
+void main(void)
+{
+	gl_Position = PVM * vec4(position, 1.0);
+}
@@ -0,0 +1,9 @@
+#version 330 core
+
+// Colour writes are off while boxes are drawn, only the samples passing the depth test count
+out vec4 final_color;
+
+void main(void)
+{
+	final_color = vec4(1.0);
+}
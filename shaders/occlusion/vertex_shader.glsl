@@ -0,0 +1,11 @@
+#version 330 core
+
+// Draws the bounding box of a mesh for an occlusion query, from a unit cube
+in vec3 position;
+
+uniform mat4 PVM;
+
+void main(void)
+{
+	gl_Position = PVM * vec4(position, 1.0);
+}
@@ -0,0 +1,333 @@
+"""Mesh simplification by quadric error metric edge collapse.
+
+Edges are collapsed cheapest first, where the cost of moving a vertex is the sum of its squared
+distances to the planes of the triangles around both ends (Garland and Heckbert). Collapses
+are half-edge collapses, moving one existing vertex onto another, so simplified meshes are
+just new index buffers over the original vertices and can share their vertex buffers.
+
+Vertices with the same position but different normals or UVs (seams and hard edges) are
+welded together while simplifying, and each copy is remapped to the closest copy of the
+vertex it collapses into. Open borders are never moved, so holes don't grow.
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+
+def triangulate(faces) -> np.ndarray:
+    """Split quads into triangles.
+
+    Args:
+        faces (NDArray): (faces, 3) triangles or (faces, 4) quads
+
+    Returns:
+        NDArray: (triangles, 3)
+    """
+    if faces.shape[1] == 3:
+        return faces
+    return np.concatenate([faces[:, [0, 1, 2]], faces[:, [0, 2, 3]]])
+
+
+def triangle_normals(corners) -> np.ndarray:
+    """Unnormalised normals of (triangles, 3, 3) corner positions.
+
+    Written out rather than using np.cross, which has a lot of overhead for a few triangles.
+    """
+    first = corners[:, 1] - corners[:, 0]
+    second = corners[:, 2] - corners[:, 0]
+    return (
+        first[:, [1, 2, 0]] * second[:, [2, 0, 1]]
+        - first[:, [2, 0, 1]] * second[:, [1, 2, 0]]
+    )
+
+
+def plane_quadrics(positions, triangles) -> np.ndarray:
+    """The error quadric of each triangle's plane, zero for degenerate triangles.
+
+    Returns:
+        NDArray: (triangles, 4, 4)
+    """
+    corners = positions[triangles]
+    normals = triangle_normals(corners)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+    planes = np.concatenate(
+        [normals, -np.einsum("ij,ij->i", normals, corners[:, 0])[:, np.newaxis]], axis=1
+    )
+    return np.einsum("ni,nj->nij", planes, planes)
+
+
+class Simplifier:
+    """Collapses the edges of a triangle mesh one by one, tracking the quadric error."""
+
+    def __init__(self, positions, triangles, attributes=None):
+        """
+        Args:
+            positions (NDArray): (vertices, 3) vertex positions
+            triangles (NDArray): (triangles, 3) vertex indices
+            attributes (NDArray, optional): (vertices, n) normals, UVs and so on, used to
+                choose which copy of a welded vertex to collapse into. Defaults to None.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        triangles = np.asarray(triangles, dtype=np.int64)
+        self.attributes = (
+            None if attributes is None else np.asarray(attributes, np.float64)
+        )
+
+        # Weld vertices with the same position
+        self.points, weld = np.unique(positions, axis=0, return_inverse=True)
+        weld = weld.reshape(-1)
+        self.homogeneous = np.concatenate(
+            [self.points, np.ones((len(self.points), 1))], axis=1
+        )
+        self.copies = [[] for _ in range(len(self.points))]
+        for vertex in np.unique(triangles).tolist():
+            self.copies[weld[vertex]].append(vertex)
+
+        welded = weld[triangles]
+        alive = (
+            (welded[:, 0] != welded[:, 1])
+            & (welded[:, 1] != welded[:, 2])
+            & (welded[:, 0] != welded[:, 2])
+        )
+        triangles = triangles[alive]
+        welded = welded[alive]
+        self.triangle_count = len(triangles)
+
+        # Corners of each triangle, as original and welded vertices. Plain lists, as they're
+        # read and written a few at a time.
+        self.corners = triangles.tolist()
+        self.welded = welded.tolist()
+        self.alive = [True] * len(triangles)
+
+        self.quadrics = np.zeros((len(self.points), 4, 4))
+        np.add.at(
+            self.quadrics,
+            welded.reshape(-1),
+            np.repeat(plane_quadrics(self.points, welded), 3, axis=0),
+        )
+
+        # Triangles around each welded vertex
+        self.vertex_triangles = [set() for _ in range(len(self.points))]
+        for triangle, corners in enumerate(self.welded):
+            for vertex in corners:
+                self.vertex_triangles[vertex].add(triangle)
+
+        # Vertices on open borders or non-manifold edges stay where they are
+        edges = np.sort(welded[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        unique_edges, counts = np.unique(edges, axis=0, return_counts=True)
+        locked = np.zeros(len(self.points), dtype=bool)
+        locked[unique_edges[counts != 2].reshape(-1)] = True
+        self.locked = locked.tolist()
+
+        # Bumped whenever a vertex's quadric changes or it's removed, to spot stale edges
+        self.versions = [0] * len(self.points)
+        self.heap = self.initial_edges(unique_edges[counts == 2], locked)
+        heapq.heapify(self.heap)
+
+        self.error = 0.0
+
+    def initial_edges(self, edges, locked) -> list[tuple]:
+        """Heap entries for the cheaper direction of collapsing each edge, all at once."""
+        first, second = edges[:, 0], edges[:, 1]
+        quadrics = self.quadrics[first] + self.quadrics[second]
+        # Cost of moving first onto second, and second onto first
+        forward = np.einsum(
+            "ni,nij,nj->n", self.homogeneous[second], quadrics, self.homogeneous[second]
+        )
+        backward = np.einsum(
+            "ni,nij,nj->n", self.homogeneous[first], quadrics, self.homogeneous[first]
+        )
+        forward[locked[first]] = np.inf
+        backward[locked[second]] = np.inf
+
+        use_forward = forward <= backward
+        costs = np.where(use_forward, forward, backward)
+        sources = np.where(use_forward, first, second)
+        targets = np.where(use_forward, second, first)
+        movable = np.isfinite(costs)
+        return [
+            (cost, source, target, 0, 0)
+            for cost, source, target in zip(
+                costs[movable].tolist(),
+                sources[movable].tolist(),
+                targets[movable].tolist(),
+            )
+        ]
+
+    def collapse_cost(self, source: int, target: int) -> float:
+        point = self.homogeneous[target]
+        return float(point @ (self.quadrics[source] + self.quadrics[target]) @ point)
+
+    def push_edge(self, first: int, second: int):
+        """Queue the cheaper direction of collapsing an edge, if either end can move."""
+        options = [
+            (self.collapse_cost(source, target), source, target)
+            for source, target in ((first, second), (second, first))
+            if not self.locked[source]
+        ]
+        if not options:
+            return
+        cost, source, target = min(options)
+        heapq.heappush(
+            self.heap,
+            (cost, source, target, self.versions[source], self.versions[target]),
+        )
+
+    def neighbours(self, vertex: int) -> set[int]:
+        return {
+            other
+            for triangle in self.vertex_triangles[vertex]
+            for other in self.welded[triangle]
+        } - {vertex}
+
+    def can_collapse(self, source: int, target: int, moved: set[int]) -> bool:
+        """Check a collapse keeps the mesh manifold and doesn't flip any triangles."""
+        # Link condition: the only vertices next to both ends are across the removed triangles
+        shared = self.vertex_triangles[source] & self.vertex_triangles[target]
+        opposite = {
+            vertex for triangle in shared for vertex in self.welded[triangle]
+        } - {source, target}
+        if self.neighbours(source) & self.neighbours(target) != opposite:
+            return False
+        if not moved:
+            return True
+
+        before = np.array([self.welded[triangle] for triangle in moved])
+        after = np.where(before == source, target, before)
+        return bool(
+            (
+                np.einsum(
+                    "ij,ij->i",
+                    triangle_normals(self.points[before]),
+                    triangle_normals(self.points[after]),
+                )
+                > 0
+            ).all()
+        )
+
+    def closest_copy(self, vertex: int, target: int) -> int:
+        """The copy of the welded `target` vertex whose attributes are closest to `vertex`'s."""
+        copies = self.copies[target]
+        if len(copies) == 1 or self.attributes is None:
+            return copies[0]
+        distances = np.square(self.attributes[copies] - self.attributes[vertex]).sum(
+            axis=1
+        )
+        return copies[int(distances.argmin())]
+
+    def collapse(self, source: int, target: int):
+        shared = self.vertex_triangles[source] & self.vertex_triangles[target]
+        moved = self.vertex_triangles[source] - shared
+
+        for triangle in shared:
+            self.alive[triangle] = False
+            for vertex in self.welded[triangle]:
+                self.vertex_triangles[vertex].discard(triangle)
+        self.triangle_count -= len(shared)
+
+        # Point every copy of the source vertex at the closest copy of the target
+        replacements = {
+            vertex: self.closest_copy(vertex, target) for vertex in self.copies[source]
+        }
+        for triangle in moved:
+            self.corners[triangle] = [
+                replacements.get(vertex, vertex) for vertex in self.corners[triangle]
+            ]
+            self.welded[triangle] = [
+                target if vertex == source else vertex
+                for vertex in self.welded[triangle]
+            ]
+            self.vertex_triangles[target].add(triangle)
+        self.vertex_triangles[source] = set()
+
+        # Only the target's quadric changed, so only edges to it need new costs, and edges
+        # to the removed source are dropped
+        self.quadrics[target] += self.quadrics[source]
+        self.locked[source] = True
+        self.versions[source] += 1
+        self.versions[target] += 1
+        for neighbour in self.neighbours(target):
+            self.push_edge(target, neighbour)
+
+    def simplify(self, target_triangles: int, max_error=math.inf) -> bool:
+        """Collapse edges until there are at most `target_triangles` triangles.
+
+        Args:
+            target_triangles (int): Stop at this many triangles
+            max_error (float, optional): Stop before a collapse that moves the surface further
+                than this. Defaults to no limit.
+
+        Returns:
+            bool: Whether the target was reached
+        """
+        max_cost = max_error**2
+        while self.triangle_count > target_triangles and self.heap:
+            cost, source, target, source_version, target_version = heapq.heappop(
+                self.heap
+            )
+            if (
+                self.locked[source]
+                or source_version != self.versions[source]
+                or target_version != self.versions[target]
+            ):
+                continue
+            if cost > max_cost:
+                heapq.heappush(
+                    self.heap, (cost, source, target, source_version, target_version)
+                )
+                return False
+
+            moved = self.vertex_triangles[source] - self.vertex_triangles[target]
+            if not self.can_collapse(source, target, moved):
+                continue
+
+            self.collapse(source, target)
+            self.error = max(self.error, math.sqrt(max(cost, 0.0)))
+        return self.triangle_count <= target_triangles
+
+    def current_triangles(self) -> np.ndarray:
+        """The remaining triangles, as indices of the original vertices."""
+        return np.array(
+            [
+                corners
+                for corners, alive in zip(self.corners, self.alive, strict=True)
+                if alive
+            ],
+            dtype=np.uint32,
+        ).reshape(-1, 3)
+
+
+def simplify_lods(
+    positions, faces, ratios=(0.5, 0.25, 0.125), attributes=None, max_error=math.inf
+) -> list[tuple[np.ndarray, float]]:
+    """Generate progressively simpler versions of a mesh.
+
+    Args:
+        positions (NDArray): (vertices, 3) vertex positions
+        faces (NDArray): (faces, 3) triangles or (faces, 4) quads
+        ratios (tuple[float], optional): Fraction of the triangles to keep in each level of
+            detail. Defaults to (0.5, 0.25, 0.125).
+        attributes (NDArray, optional): Per vertex attributes for choosing between vertex copies
+            on seams. Defaults to None.
+        max_error (float, optional): Most the surface may move, in the mesh's units.
+            Defaults to no limit.
+
+    Returns:
+        list[tuple[NDArray, float]]: Triangles and error of each level of detail. Levels that
+            couldn't be simplified at least 10% further than the last are left out.
+    """
+    triangles = triangulate(np.asarray(faces))
+    simplifier = Simplifier(positions, triangles, attributes)
+
+    lods = []
+    previous = simplifier.triangle_count
+    for ratio in ratios:
+        simplifier.simplify(int(len(triangles) * ratio), max_error)
+        if simplifier.triangle_count > 0.9 * previous:
+            break
+        lods.append((simplifier.current_triangles(), simplifier.error))
+        previous = simplifier.triangle_count
+    return lods
@@ -13,6 +13,10 @@ from shaders import SkyBoxShader
 class SkyBox(Model):
     """A sky box object."""
 
+    render_pass = "skybox"
+    pickable = False
+    occlusion_culling = False
+
     def __init__(self):
         material = Material(name="skybox", texture=CubeMap(name="skybox/blue-sky"))
 
@@ -23,7 +27,7 @@ class SkyBox(Model):
             name="Skybox",
         )
 
-    def draw(self):
+    def draw(self, world_poses=None):
         gl.glDepthMask(gl.GL_FALSE)
-        super().draw()
+        super().draw(world_poses)
         gl.glDepthMask(gl.GL_TRUE)
@@ -0,0 +1,113 @@
+"""Render snapshots and the pipelined frame loop. In pipelined mode the simulation for the
+next frame runs on a worker thread, while the main thread renders the current frame
+from an immutable snapshot of the world.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, NamedTuple
+
+from numpy.typing import NDArray
+
+if TYPE_CHECKING:
+    from mesh import Mesh
+    from model import Model
+    from scene import Scene
+
+
+class ModelSnapshot(NamedTuple):
+    """Everything needed to draw one model, captured at the end of a simulation step."""
+
+    model: "Model"
+    meshes: tuple["Mesh", ...]
+    world_poses: tuple[NDArray, ...]
+
+
+class RenderSnapshot(NamedTuple):
+    """The drawable state of a scene at one point in time.
+    World poses are never modified in place, the entity cache replaces them with new arrays,
+    so holding a reference is enough to keep them unchanged while the simulation carries on.
+    """
+
+    frame: int
+    simulation_time: float
+    # The scene's `models_version` when the models were captured
+    models_version: int
+    models: tuple[ModelSnapshot, ...]
+
+    @classmethod
+    def capture(cls, scene: "Scene", frame=0):
+        """Capture the meshes and world matrices of every visible model in `scene`. Materials
+        aren't captured, as nothing changes them while the simulation runs.
+        """
+        # Held so that the models and their meshes match the version
+        with scene.models_lock:
+            models_version = scene.models_version
+            models = [
+                (model, tuple(model.meshes)) for model in scene.models if model.visible
+            ]
+        return cls(
+            frame=frame,
+            simulation_time=scene.simulation_time,
+            models_version=models_version,
+            models=tuple(
+                ModelSnapshot(model, meshes, tuple(mesh.world_pose for mesh in meshes))
+                for model, meshes in models
+            ),
+        )
+
+
+class FramePipeline:
+    """Runs the simulation for frame N+1 on a worker thread while frame N is drawn.
+
+    The worker owns the world between `submit` and `next_snapshot`. The main thread must
+    only touch entities (camera updates, debug menus) after `next_snapshot` returns.
+    """
+
+    def __init__(self, scene: "Scene"):
+        self.scene = scene
+        self.executor: ThreadPoolExecutor | None = None
+        self.pending: Future | None = None
+        self.frame = 0
+
+    def simulate(self, delta_time: float) -> RenderSnapshot:
+        """Run the simulation and capture a snapshot of the interpolated world.
+        The interpolated transforms stay applied until the next call, so the main thread
+        can update the camera against them.
+        """
+        scene = self.scene
+        scene.interpolation.restore()
+        alpha = scene.simulate(delta_time)
+        scene.interpolation.apply(alpha)
+
+        self.frame += 1
+        return RenderSnapshot.capture(scene, self.frame)
+
+    def next_snapshot(self, delta_time: float) -> RenderSnapshot:
+        """Wait for the worker to finish and return its snapshot.
+        If nothing was submitted (e.g. the first frame), simulate on the calling thread.
+        """
+        if self.pending is None:
+            return self.simulate(delta_time)
+
+        snapshot = self.pending.result()
+        self.pending = None
+        return snapshot
+
+    def submit(self, delta_time: float):
+        """Start simulating the next frame on the worker thread."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="simulation"
+            )
+        self.pending = self.executor.submit(self.simulate, delta_time)
+
+    def stop(self):
+        """Wait for any running simulation, and return the world to its simulated state."""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+        self.scene.interpolation.restore()
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,194 @@
+"""Automatic capture of slow frames.
+
+Keeps the traces of the last few frames, and when a frame takes much longer than the median,
+saves them to disk along with hints about what happened in the slow frame: garbage collections,
+shader compiles, texture uploads and so on. Rare hitches can then be diagnosed after the fact
+in Perfetto or chrome://tracing.
+"""
+
+import gc
+import json
+import os
+import time
+from collections import deque
+
+import imgui
+import numpy as np
+
+from tracing import Tracer
+
+# Traced scopes that are known to cause hitches, and how to describe them
+CAUSES = {
+    "Shader.compile": "shader compiled",
+    "Texture.__init__": "texture uploaded",
+    "load_obj_file": "model loaded",
+    "load_material_library": "material library loaded",
+    "EnvironmentMappingTexture.update": "environment map updated",
+}
+
+# Scopes shorter than this aren't worth a hint
+MIN_CAUSE_TIME = 0.0005
+
+
+class SpikeDetector:
+    """Watches frame times and saves the traces around frames much slower than usual."""
+
+    def __init__(
+        self,
+        threshold=2.0,
+        window=8,
+        history=240,
+        min_spike_time=0.005,
+        directory="spikes",
+    ):
+        """
+        Args:
+            threshold (float, optional): A frame this many times slower than the median is a spike.
+                Defaults to 2.0.
+            window (int, optional): Number of frames saved, ending with the spike. Defaults to 8.
+            history (int, optional): Number of recent frames the median is taken over. Defaults to 240.
+            min_spike_time (float, optional): Ignore frames faster than this many seconds,
+                e.g. a 2ms frame after a 0.5ms one. Defaults to 0.005.
+            directory (str, optional): Where captures are saved. Defaults to "spikes".
+        """
+        self.enabled = False
+        self.threshold = threshold
+        self.min_spike_time = min_spike_time
+        self.directory = directory
+
+        self.frame_times = deque(maxlen=history)
+        # Index of the first trace event of each frame in the window
+        self.frame_events = deque(maxlen=window)
+        # (generation, seconds) of each garbage collection this frame
+        self.collections: list[tuple[int, float]] = []
+        self.collection_start = 0
+
+        # (frame, frame time, median, file name, hints) of recent spikes, newest last
+        self.spikes = deque(maxlen=20)
+
+    def set_enabled(self, enabled: bool):
+        """Start or stop capturing. Capturing needs tracing, so this turns on the tracer too."""
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+
+        if enabled:
+            Tracer.current_tracer.enabled = True
+            gc.callbacks.append(self.on_garbage_collection)
+        else:
+            gc.callbacks.remove(self.on_garbage_collection)
+            self.frame_events.clear()
+
+    def on_garbage_collection(self, phase: str, info: dict):
+        if phase == "start":
+            self.collection_start = time.perf_counter_ns()
+            return
+
+        end = time.perf_counter_ns()
+        generation = info["generation"]
+        self.collections.append((generation, (end - self.collection_start) / 1e9))
+
+        tracer = Tracer.current_tracer
+        if tracer.enabled:
+            tracer.record(
+                tracer.name_id(f"GC generation {generation}"),
+                self.collection_start,
+                end,
+            )
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.frame_events.append(Tracer.current_tracer.event_count)
+        self.collections = []
+
+    def end_frame(self, frame: int, frame_time: float):
+        """Check whether the frame that just finished was a spike, and capture it if so.
+
+        Args:
+            frame (int): Number of the frame
+            frame_time (float): Seconds the frame took
+        """
+        if not self.enabled:
+            return
+
+        # Wait until there are enough frames for a meaningful median
+        if len(self.frame_times) >= self.frame_events.maxlen:
+            median = float(np.median(self.frame_times))
+            if (
+                frame_time > self.threshold * median
+                and frame_time > self.min_spike_time
+            ):
+                self.capture(frame, frame_time, median)
+
+        self.frame_times.append(frame_time)
+
+    def hints(self, frame_time: float) -> list[str]:
+        """Describe the likely causes of the slow frame."""
+        # Total time and count of each known cause within the spike frame
+        cause_times: dict[str, float] = {}
+        cause_counts: dict[str, int] = {}
+
+        for generation, seconds in self.collections:
+            cause = f"GC generation {generation} collected"
+            cause_times[cause] = cause_times.get(cause, 0.0) + seconds
+            cause_counts[cause] = cause_counts.get(cause, 0) + 1
+
+        for name, start, end, _ in Tracer.current_tracer.events(self.frame_events[-1]):
+            if name in CAUSES:
+                cause = CAUSES[name]
+                cause_times[cause] = cause_times.get(cause, 0.0) + (end - start) / 1e9
+                cause_counts[cause] = cause_counts.get(cause, 0) + 1
+
+        hints = [
+            f"{cause} x{cause_counts[cause]} ({seconds * 1000:.2f}ms)"
+            for cause, seconds in sorted(cause_times.items(), key=lambda item: -item[1])
+            if seconds >= MIN_CAUSE_TIME
+        ]
+
+        if not hints:
+            hints.append(f"no known cause, see the trace ({frame_time * 1000:.2f}ms)")
+        return hints
+
+    def capture(self, frame: int, frame_time: float, median: float):
+        """Save the traces of the frames in the window, ending with the spike."""
+        hints = self.hints(frame_time)
+
+        tracer = Tracer.current_tracer
+        chrome_trace = tracer.chrome_trace(first_event=self.frame_events[0])
+        chrome_trace["metadata"] = {
+            "frame": frame,
+            "frame_time_ms": frame_time * 1000,
+            "median_frame_time_ms": median * 1000,
+            "frames_captured": len(self.frame_events),
+            "hints": hints,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = os.path.join(self.directory, f"spike_frame{frame}.json")
+        with open(file_name, "w", encoding="utf-8") as file:
+            json.dump(chrome_trace, file)
+
+        print(
+            f"(W) Frame {frame} took {frame_time * 1000:.2f}ms"
+            f" ({frame_time / median:.1f}x the median): {', '.join(hints)}."
+            f" Saved to {file_name}"
+        )
+        self.spikes.append((frame, frame_time, median, file_name, hints))
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        enabled_changed, enabled = imgui.checkbox("Capture slow frames", self.enabled)
+        if enabled_changed:
+            self.set_enabled(enabled)
+
+        _, self.threshold = imgui.slider_float(
+            "Spike threshold (x median)", self.threshold, 1.2, 10.0
+        )
+
+        for frame, frame_time, median, _, hints in reversed(self.spikes):
+            imgui.text(
+                f"Frame {frame}: {frame_time * 1000:.2f}ms ({frame_time / median:.1f}x)"
+            )
+            for hint in hints:
+                imgui.bullet_text(hint)
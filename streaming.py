@@ -0,0 +1,362 @@
+"""Streaming large static models in spatial cells.
+
+Loading the city as one `Model` parses the whole .obj file and keeps every mesh in memory and on
+the GPU, wherever the camera is. A `StreamedModel` instead splits the model into a grid of cells
+over the ground (X and Z) the first time it's loaded, saving each cell to the asset cache with
+one mesh per material. Later runs only read the list of cells.
+
+While drawing, the cells nearest the camera are kept loaded, up to a memory budget. Cells are
+read, optimised and simplified on a worker thread, then uploaded on the main thread a few per
+frame, and cells that fall out of the budget are deleted from both the CPU and the GPU.
+"""
+
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import ClassVar
+
+import imgui
+import numpy as np
+
+import asset_cache
+from blender import find_file, load_material_library, parse_obj_file
+from entity import Entity
+from mesh import Mesh, vertex_normals
+from mesh_optimise import optimise_mesh
+from model import Model
+from scene import Scene
+from texture_array import TextureArray, pack_library_textures
+from texture_cache import file_hash
+
+
+def read_material_library_name(file_name: str) -> str:
+    """Find the name of the material library of an .obj file, without reading the whole file."""
+    with open(file_name, encoding="utf-8") as obj_file:
+        for line in obj_file:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == "mtllib":
+                return fields[1]
+    raise ValueError(f"(E) {file_name} has no material library")
+
+
+def partition_obj_file(obj_name: str, cell_size: float, key: str) -> dict:
+    """Split an .obj file into a grid of cells, and save each cell to the asset cache.
+
+    Faces go in the cell under their centre. Each cell has one mesh for each material used in
+    it, with only the vertices that mesh uses.
+
+    Returns:
+        dict: The manifest of the cells, as saved in the asset cache
+    """
+    vertices, faces, material_names, vertex_textures, _, _ = parse_obj_file(obj_name)
+    positions = np.array(vertices, dtype="f")
+    texture_coords = np.array(vertex_textures, dtype="f")
+    # (faces, 3, 1) position indices, or (faces, 3, 2) with texture indices, starting at 1
+    faces = np.array(faces, dtype=np.int64) - 1
+    materials = np.array(material_names, dtype=np.int64)
+    textured = faces.shape[2] > 1 and len(texture_coords) > 0
+
+    centres = positions[faces[:, :, 0]].mean(axis=1)
+    grid = np.floor(centres[:, [0, 2]] / cell_size).astype(np.int64)
+    cells, cell_of_face = np.unique(grid, axis=0, return_inverse=True)
+    cell_of_face = cell_of_face.reshape(-1)
+
+    bounds = []
+    vertex_bytes = []
+    index_bytes = []
+    for cell in range(len(cells)):
+        in_cell = np.flatnonzero(cell_of_face == cell)
+        arrays = {"materials": np.unique(materials[in_cell])}
+        cell_vertex_bytes = cell_index_bytes = 0
+        for mesh, material in enumerate(arrays["materials"].tolist()):
+            mesh_faces = faces[in_cell[materials[in_cell] == material]]
+            used, local = np.unique(mesh_faces[:, :, 0], return_inverse=True)
+            arrays[f"vertices{mesh}"] = positions[used]
+            arrays[f"faces{mesh}"] = local.reshape(-1, 3).astype(np.uint32)
+            if textured:
+                # Like `fix_blender_textures`, each vertex takes the UV of its last use
+                mesh_coords = np.zeros((len(used), 2), dtype="f")
+                mesh_coords[local.reshape(-1)] = texture_coords[
+                    mesh_faces[:, :, 1].reshape(-1)
+                ]
+                arrays[f"texture_coords{mesh}"] = mesh_coords
+
+            # Positions and normals, and UVs
+            cell_vertex_bytes += len(used) * (24 + 8 * textured)
+            cell_index_bytes += mesh_faces.shape[0] * 12
+
+        cell_positions = positions[np.unique(faces[in_cell, :, 0])]
+        bounds.append([cell_positions.min(axis=0), cell_positions.max(axis=0)])
+        vertex_bytes.append(cell_vertex_bytes)
+        index_bytes.append(cell_index_bytes)
+        asset_cache.save_arrays("cells", f"{key}-{cell}", arrays)
+
+    manifest = {
+        "library": np.array(
+            read_material_library_name(find_file(obj_name, ["models/"]))
+        ),
+        "bounds": np.array(bounds, dtype=np.float64).reshape(-1, 2, 3),
+        "vertex_bytes": np.array(vertex_bytes, dtype=np.int64),
+        "index_bytes": np.array(index_bytes, dtype=np.int64),
+    }
+    asset_cache.save_arrays("cells", key, manifest)
+    return manifest
+
+
+def prepare_cell(key: str) -> list[dict]:
+    """Read a cell from the asset cache and get its meshes ready to upload, on a worker thread.
+
+    Returns:
+        list[dict]: Keyword arguments for each mesh of the cell, plus its "material" index
+            and "lods" arrays
+    """
+    arrays = asset_cache.load_arrays("cells", key)
+    if arrays is None:
+        raise RuntimeError(f"(E) Streamed cell {key} is missing from the asset cache")
+
+    meshes = []
+    for mesh, material in enumerate(arrays["materials"].tolist()):
+        vertices = arrays[f"vertices{mesh}"]
+        faces = arrays[f"faces{mesh}"]
+        texture_coords = arrays.get(f"texture_coords{mesh}")
+        if Mesh.optimise_on_import:
+            faces, order = optimise_mesh(vertices, faces)
+            vertices = vertices[order]
+            if texture_coords is not None:
+                texture_coords = texture_coords[order]
+        normals = vertex_normals(vertices, faces)
+
+        lods = None
+        if Mesh.generate_lods_on_import:
+            lods = Mesh.lod_arrays(vertices, faces, normals, texture_coords)
+        meshes.append({
+            "vertices": vertices,
+            "faces": faces,
+            "normals": normals,
+            "texture_coords": texture_coords,
+            "material": material,
+            "lods": lods,
+        })
+    return meshes
+
+
+class StreamedModel(Model):
+    """A large static model, split into cells that are loaded and unloaded as the camera
+    moves. Cells never move relative to the model, so snapshots aren't needed to draw it.
+    """
+
+    # Load the city as a streamed model, rather than all at once
+    enabled = False
+    streamed_models: ClassVar[list["StreamedModel"]] = []
+
+    def __init__(self, obj_name: str, cell_size=50.0, **kwargs):
+        """Load the cell layout of a model, splitting it into cells first if it hasn't been.
+
+        Args:
+            obj_name (str): The name of the obj file
+            cell_size (float, optional): Width of the grid cells, in the model's units.
+                Defaults to 50.0.
+        """
+        file_path = find_file(obj_name, ["models/"])
+        if "name" not in kwargs:
+            kwargs["name"] = os.path.basename(file_path)
+
+        key = asset_cache.content_key(
+            file_hash=file_hash(file_path), cell_size=cell_size
+        )
+        manifest = asset_cache.load_arrays("cells", key)
+        if manifest is None:
+            start = time.perf_counter()
+            manifest = partition_obj_file(obj_name, cell_size, key)
+            print(
+                f"Split {obj_name} into {len(manifest['bounds'])} cells"
+                f" in {time.perf_counter() - start:.1f}s"
+            )
+
+        self.key = key
+        self.bounds = manifest["bounds"]
+        self.vertex_bytes = manifest["vertex_bytes"]
+        self.index_bytes = manifest["index_bytes"]
+        self.library = load_material_library(
+            find_file(str(manifest["library"]), ["models/"])
+        )
+        if TextureArray.pack_materials:
+            pack_library_textures(self.library)
+
+        # Bytes of vertex and index data to keep loaded. Loaded data is held on both the CPU
+        # and the GPU.
+        self.memory_budget = 256 * 2**20
+        # Cells further away than this are never loaded. Defaults to the far clipping plane.
+        self.load_distance: float | None = None
+        # Loaded cells count as this much closer, so cells at the edge of the budget or the
+        # load distance aren't loaded and unloaded over and over
+        self.hysteresis = 0.2
+        # Seconds between choosing which cells to load
+        self.update_interval = 0.25
+        self.uploads_per_frame = 2
+
+        # Meshes of the loaded cells, and cells being prepared on the worker thread
+        self.resident: dict[int, list[Mesh]] = {}
+        self.pending: dict[int, Future] = {}
+        self.wanted: set[int] = set()
+        self.next_update = 0.0
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="streaming"
+        )
+
+        # Statistics
+        self.loads = 0
+        self.evictions = 0
+        self.upload_time = 0.0
+
+        super().__init__([], **kwargs)
+        StreamedModel.streamed_models.append(self)
+
+    def cell_bytes(self, cells) -> np.ndarray:
+        """Estimated bytes of each cell once loaded, including its levels of detail."""
+        index_scale = 1.0
+        if Mesh.generate_lods_on_import:
+            index_scale += sum(Mesh.lod_ratios)
+        return self.vertex_bytes[cells] + (
+            self.index_bytes[cells] * index_scale
+        ).astype(np.int64)
+
+    @property
+    def resident_bytes(self) -> int:
+        return int(self.cell_bytes(list(self.resident)).sum()) if self.resident else 0
+
+    def choose_cells(self) -> list[int]:
+        """The cells that should be loaded, nearest to the camera first."""
+        scene = Scene.current_scene
+        # Camera position in the model's space
+        camera = np.linalg.inv(scene.camera.view_matrix)[:, 3]
+        camera = np.matmul(np.linalg.inv(self.world_pose), camera)[:3]
+        scale = float(np.linalg.norm(self.world_pose[:3, :3], axis=0).max())
+
+        # Distance from the camera to each cell's bounding box
+        lows, highs = self.bounds[:, 0], self.bounds[:, 1]
+        outside = np.maximum(np.maximum(lows - camera, camera - highs), 0.0)
+        distances = np.linalg.norm(outside, axis=1) * scale
+        for cell in self.resident:
+            distances[cell] *= 1.0 - self.hysteresis
+
+        load_distance = (
+            scene.far_clipping if self.load_distance is None else self.load_distance
+        )
+        sizes = self.cell_bytes(np.arange(len(self.bounds)))
+        chosen = []
+        total = 0
+        for cell in np.argsort(distances, kind="stable").tolist():
+            if distances[cell] > load_distance:
+                break
+            if total + sizes[cell] > self.memory_budget:
+                continue
+            chosen.append(cell)
+            total += sizes[cell]
+        return chosen
+
+    def evict(self, cell: int):
+        """Delete a loaded cell's meshes from the GPU and forget them."""
+        for mesh in self.resident.pop(cell):
+            mesh.vbo__del__()
+            self.children.remove(mesh)
+            Entity.all_entities.remove(mesh)
+        self.evictions += 1
+
+    def upload(self, cell: int, meshes: list[dict]):
+        """Create the meshes of a prepared cell."""
+        start = time.perf_counter()
+        resident = []
+        for data in meshes:
+            mesh = Mesh(
+                vertices=data["vertices"],
+                faces=data["faces"],
+                normals=data["normals"],
+                texture_coords=data["texture_coords"],
+                material=self.library.materials[data["material"]],
+                shader=self.shader,
+            )
+            if data["lods"] is not None:
+                mesh.generate_lods(data["lods"])
+            mesh.parent = self
+            resident.append(mesh)
+        self.resident[cell] = resident
+        self.loads += 1
+        self.upload_time += time.perf_counter() - start
+
+    def stream(self):
+        """Load and unload cells for the current camera. Has to run on the main thread, as
+        it creates and deletes OpenGL objects.
+        """
+        changed = False
+        now = time.perf_counter()
+        if now >= self.next_update:
+            self.next_update = now + self.update_interval
+            chosen = self.choose_cells()
+            self.wanted = set(chosen)
+
+            for cell in [cell for cell in self.resident if cell not in self.wanted]:
+                self.evict(cell)
+                changed = True
+            for cell in [cell for cell in self.pending if cell not in self.wanted]:
+                if self.pending[cell].cancel():
+                    del self.pending[cell]
+            for cell in chosen:
+                if cell not in self.resident and cell not in self.pending:
+                    self.pending[cell] = self.executor.submit(
+                        prepare_cell, f"{self.key}-{cell}"
+                    )
+
+        uploads = 0
+        for cell, future in list(self.pending.items()):
+            if uploads == self.uploads_per_frame:
+                break
+            if not future.done():
+                continue
+            del self.pending[cell]
+            if cell in self.wanted:
+                self.upload(cell, future.result())
+                uploads += 1
+                changed = True
+
+        if changed:
+            scene = Scene.current_scene
+            with scene.models_lock:
+                # Replaced rather than changed, as snapshots may be reading the old list
+                self.meshes = [
+                    mesh
+                    for cell in sorted(self.resident)
+                    for mesh in self.resident[cell]
+                ]
+                scene.models_changed()
+
+    def draw(self, world_poses=None):
+        """Draw the loaded cells, after loading and unloading cells for the current camera.
+
+        Args:
+            world_poses (list[NDArray], optional): Ignored, the model is static.
+        """
+        if world_poses is None and not self.visible:
+            return
+        self.stream()
+        super().draw()
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        super().debug_menu()
+        imgui.text(
+            f"{len(self.resident)}/{len(self.bounds)} cells loaded,"
+            f" {len(self.pending)} loading"
+        )
+        imgui.text(
+            f"{self.resident_bytes / 2**20:.1f}MiB of"
+            f" {self.memory_budget / 2**20:.0f}MiB budget"
+        )
+        _, budget = imgui.slider_float(
+            "Budget (MiB)", self.memory_budget / 2**20, 1, 2048
+        )
+        self.memory_budget = int(budget * 2**20)
+        imgui.text(
+            f"{self.loads} loads, {self.evictions} evictions,"
+            f" {self.upload_time * 1000 / max(self.loads, 1):.1f}ms per upload"
+        )
@@ -0,0 +1,316 @@
+"""Long running frame time telemetry.
+
+Frame and phase times are recorded into HDR style histograms: fixed size, log-linear buckets
+that keep a set number of significant figures over a range from microseconds to a minute.
+Memory use doesn't grow however long the scene runs, so soak tests and kiosks can be monitored
+over hours. Summaries are exported periodically as CSV, JSON or a Prometheus textfile.
+"""
+
+import csv
+import json
+import math
+import os
+import time
+
+import imgui
+import numpy as np
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+EXPORT_FORMATS = ("csv", "json", "prom")
+
+
+class HdrHistogram:
+    """A histogram of durations with a fixed relative precision, in the style of HdrHistogram.
+
+    Values are stored in integer microseconds. Each power of two range of values is split
+    into the same number of linear sub-buckets, so every value is stored to within
+    `significant_figures` decimal digits.
+    """
+
+    def __init__(self, highest_seconds=60.0, significant_figures=2):
+        """
+        Args:
+            highest_seconds (float, optional): Longer durations are clamped to this. Defaults to 60.
+            significant_figures (int, optional): Precision of recorded values, 1 to 5. Defaults to 2.
+        """
+        if not 1 <= significant_figures <= 5:
+            raise ValueError(
+                f"(E) Significant figures must be between 1 and 5, not {significant_figures}"
+            )
+
+        self.highest = int(highest_seconds * 1e6)
+        self.sub_bucket_bits = math.ceil(math.log2(2 * 10**significant_figures))
+        self.sub_bucket_half = 1 << (self.sub_bucket_bits - 1)
+        bucket_count = max(self.highest.bit_length() - self.sub_bucket_bits, 0) + 1
+        self.counts = np.zeros(
+            (bucket_count + 1) * self.sub_bucket_half, dtype=np.int64
+        )
+
+        self.total_count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def index(self, microseconds: int) -> int:
+        bucket = max(microseconds.bit_length() - self.sub_bucket_bits, 0)
+        return bucket * self.sub_bucket_half + (microseconds >> bucket)
+
+    def highest_equivalent(self, index: int) -> int:
+        """The largest value in microseconds that is stored in a bucket."""
+        bucket = max(index // self.sub_bucket_half - 1, 0)
+        sub_bucket = index - bucket * self.sub_bucket_half
+        return ((sub_bucket + 1) << bucket) - 1
+
+    def record(self, seconds: float):
+        microseconds = min(max(int(seconds * 1e6), 0), self.highest)
+        self.counts[self.index(microseconds)] += 1
+        self.total_count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total_count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def merge(self, other: "HdrHistogram"):
+        self.counts += other.counts
+        self.total_count += other.total_count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.total_count if self.total_count else 0.0
+
+    def percentile(self, percentile: float) -> float:
+        """The value in seconds that `percentile` percent of recorded values are at or below."""
+        if self.total_count == 0:
+            return 0.0
+        target = max(math.ceil(percentile / 100.0 * self.total_count), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), target))
+        # The top bucket reaches past the largest value that can be recorded
+        return min(self.highest_equivalent(index) / 1e6, self.highest / 1e6, self.max)
+
+    def count_above(self, seconds: float) -> int:
+        """Number of recorded values longer than `seconds`, to the histogram's precision.
+        Values in the same bucket as `seconds` are assumed to be spread evenly across it.
+        """
+        microseconds = min(max(int(seconds * 1e6), 0), self.highest)
+        index = self.index(microseconds)
+        highest = self.highest_equivalent(index)
+        width = highest - self.highest_equivalent(index - 1) if index else 1
+        above = (highest - microseconds) / width * self.counts[index]
+        return round(float(self.counts[index + 1 :].sum() + above))
+
+    def summary(self, budget: float | None = None) -> dict[str, float]:
+        summary = {
+            "count": self.total_count,
+            "mean": self.mean,
+            **{
+                f"p{percentile:g}": self.percentile(percentile)
+                for percentile in PERCENTILES
+            },
+            "max": self.max,
+        }
+        if budget is not None:
+            summary["over_budget"] = self.count_above(budget)
+        return summary
+
+
+class FrameTelemetry:
+    """Histograms of the frame time and each frame phase, since startup and since the last export."""
+
+    def __init__(self, budget=1 / 60, export_path=None, export_interval=60.0):
+        """
+        Args:
+            budget (float, optional): Target frame time in seconds, longer frames are counted as over
+                budget. Defaults to 1/60.
+            export_path (str, optional): Periodically export to this file. The format comes from the
+                extension, .csv, .json or .prom (Prometheus textfile). Defaults to no export.
+            export_interval (float, optional): Seconds between exports. Defaults to 60.
+        """
+        self.budget = budget
+        self.export_interval = export_interval
+        self.export_path = None
+        self.export_format = None
+        if export_path is not None:
+            self.set_export_path(export_path)
+
+        # Histograms since startup, and since the last export
+        self.histograms: dict[str, HdrHistogram] = {}
+        self.interval_histograms: dict[str, HdrHistogram] = {}
+
+        self.start_time = time.time()
+        self.last_export_time = self.start_time
+
+    def set_export_path(self, export_path: str):
+        export_format = os.path.splitext(export_path)[1].lstrip(".")
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(
+                f"(E) Unknown telemetry format {export_format}, use one of"
+                f" {', '.join('.' + extension for extension in EXPORT_FORMATS)}"
+            )
+        self.export_path = export_path
+        self.export_format = export_format
+
+    def record(self, name: str, seconds: float):
+        histogram = self.interval_histograms.get(name)
+        if histogram is None:
+            histogram = self.interval_histograms[name] = HdrHistogram()
+            self.histograms[name] = HdrHistogram()
+        histogram.record(seconds)
+
+    def record_frame(self, frame_time: float, phases: dict[str, float]):
+        """Record a finished frame, and export if it's time to.
+
+        Args:
+            frame_time (float): Seconds the frame took
+            phases (dict[str, float]): Seconds spent in each phase of the frame
+        """
+        self.record("frame", frame_time)
+        for name, seconds in phases.items():
+            self.record(name, seconds)
+
+        now = time.time()
+        if now - self.last_export_time >= self.export_interval:
+            self.end_interval(now)
+
+    def end_interval(self, now: float | None = None):
+        """Export the interval since the last export, then start a new one."""
+        now = time.time() if now is None else now
+        if self.export_path is not None:
+            self.export(now)
+
+        for name, histogram in self.interval_histograms.items():
+            self.histograms[name].merge(histogram)
+            histogram.reset()
+        self.last_export_time = now
+
+    def summaries(self, interval=False) -> dict[str, dict[str, float]]:
+        """Summary statistics in seconds of each histogram.
+
+        Args:
+            interval (bool, optional): Only the values since the last export. Defaults to False,
+                everything since startup.
+        """
+        summaries = {}
+        for name, interval_histogram in self.interval_histograms.items():
+            if interval:
+                histogram = interval_histogram
+            else:
+                histogram = HdrHistogram()
+                histogram.merge(self.histograms[name])
+                histogram.merge(interval_histogram)
+            summaries[name] = histogram.summary(
+                self.budget if name == "frame" else None
+            )
+        return summaries
+
+    def export(self, now: float):
+        if self.export_format == "csv":
+            self.export_csv(now)
+        elif self.export_format == "json":
+            self.export_json(now)
+        else:
+            self.export_prometheus()
+
+    def export_csv(self, now: float):
+        """Append a row for each histogram's interval to the CSV file."""
+        summaries = self.summaries(interval=True)
+        new_file = not os.path.exists(self.export_path)
+        with open(self.export_path, "a", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow([
+                    "time",
+                    "interval",
+                    "metric",
+                    "count",
+                    "mean",
+                    *[f"p{percentile:g}" for percentile in PERCENTILES],
+                    "max",
+                    "over_budget",
+                ])
+            for name, summary in summaries.items():
+                writer.writerow([
+                    f"{now:.3f}",
+                    f"{now - self.last_export_time:.3f}",
+                    name,
+                    summary["count"],
+                    f"{summary['mean']:.6f}",
+                    *[
+                        f"{summary[f'p{percentile:g}']:.6f}"
+                        for percentile in PERCENTILES
+                    ],
+                    f"{summary['max']:.6f}",
+                    summary.get("over_budget", ""),
+                ])
+
+    def export_json(self, now: float):
+        """Replace the JSON file with summaries of the last interval and everything since startup."""
+        write_atomically(
+            self.export_path,
+            json.dumps(
+                {
+                    "time": now,
+                    "uptime": now - self.start_time,
+                    "budget": self.budget,
+                    "interval": self.summaries(interval=True),
+                    "total": self.summaries(),
+                },
+                indent=2,
+            ),
+        )
+
+    def export_prometheus(self):
+        """Replace the file with summaries since startup in the Prometheus text format,
+        for the node exporter's textfile collector.
+        """
+        lines = []
+        for name, summary in self.summaries().items():
+            metric = f"guraffic_{name.replace(' ', '_')}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for percentile in PERCENTILES:
+                lines.append(
+                    f'{metric}{{quantile="{percentile / 100:g}"}}'
+                    f" {summary[f'p{percentile:g}']:.6f}"
+                )
+            lines.append(f"{metric}_sum {summary['mean'] * summary['count']:.6f}")
+            lines.append(f"{metric}_count {summary['count']}")
+            if "over_budget" in summary:
+                lines.append(f"# TYPE guraffic_{name}s_over_budget_total counter")
+                lines.append(
+                    f"guraffic_{name}s_over_budget_total {summary['over_budget']}"
+                )
+        write_atomically(self.export_path, "\n".join(lines) + "\n")
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        budget_changed, budget = imgui.slider_float(
+            "Frame budget (ms)", self.budget * 1000, 1.0, 100.0
+        )
+        if budget_changed:
+            self.budget = budget / 1000
+
+        for name, summary in self.summaries().items():
+            text = (
+                f"{name}: p50 {summary['p50'] * 1000:.2f}ms,"
+                f" p99 {summary['p99'] * 1000:.2f}ms,"
+                f" max {summary['max'] * 1000:.2f}ms"
+            )
+            if "over_budget" in summary:
+                text += f", {summary['over_budget']}/{summary['count']} over budget"
+            imgui.text(text)
+
+        if self.export_path is not None:
+            imgui.text(f"Exporting to {self.export_path}")
+
+
+def write_atomically(file_name: str, contents: str):
+    """Write a file so that readers never see it half written."""
+    temporary_name = f"{file_name}.tmp"
+    with open(temporary_name, "w", encoding="utf-8") as file:
+        file.write(contents)
+    os.replace(temporary_name, file_name)
@@ -1,30 +1,54 @@
 """Classes for loading and managing textures."""
 
+import os
+from typing import ClassVar, Self
+
+import imgui
 import numpy as np
-import pygame
 from OpenGL import GL as gl
 
+import texture_pipeline
+from texture_cache import load_image, prefetch_images
+from tracing import traced
+
+# Bytes per pixel of uncompressed pixel formats
+BYTES_PER_PIXEL = {gl.GL_RGBA: 4, gl.GL_RGB: 3}
+
 
 class ImageWrapper:
-    """A wrapper for a pygame image."""
+    """A wrapper for an image's decoded pixels."""
 
     def __init__(self, name):
-        # load the image from file using pyGame
-        self.image_data = pygame.image.load(f"./textures/{name}")
+        # RGBA pixels, bottom row first, from the decoded image cache
+        self.pixels = load_image(name)
+        self.height, self.width = self.pixels.shape[:2]
 
     def data(self, image_format=gl.GL_RGB):
-        """convert the python image object to a plain byte array for passing to OpenGL"""
+        """The pixels as an array that can be passed straight to OpenGL"""
         if image_format == gl.GL_RGBA:
-            return pygame.image.tostring(self.image_data, "RGBA", 1)
+            return self.pixels
         if image_format == gl.GL_RGB:
-            return pygame.image.tostring(self.image_data, "RGB", 1)
+            return np.ascontiguousarray(self.pixels[:, :, :3])
 
 
 class Texture:
     """
     Class to handle texture loading.
+
+    Images loaded from the textures folder are processed with `texture_pipeline` into a
+    mipmapped, optionally block compressed, KTX2 file in the `processing_format`, which is
+    reused on later runs. Set `processing_format` to None to upload the image as it is,
+    without mipmaps.
     """
 
+    processing_format: str | None = "rgba8"
+    mip_filter = "kaiser"
+    # Texture unit meshes bind this kind of texture to
+    texture_unit = 0
+    # Formats the current context can't sample, which fall back to rgba8
+    unsupported_formats: ClassVar[set[str]] = set()
+
+    @traced
     def __init__(
         self,
         name,
@@ -46,16 +70,21 @@ class Texture:
 
         self.bind()
 
-        if img is None:
+        mipmapped = False
+        if img is None and target == gl.GL_TEXTURE_2D and self.processing_format:
+            self.gpu_bytes = self.load_processed(name)
+            mipmapped = True
+        elif img is None:
             img = ImageWrapper(name)
+            self.gpu_bytes = img.width * img.height * BYTES_PER_PIXEL[image_format]
 
             # load the texture in the buffer
             gl.glTexImage2D(
                 self.target,
                 0,
                 image_format,
-                img.image_data.get_width(),
-                img.image_data.get_height(),
+                img.width,
+                img.height,
                 0,
                 image_format,
                 image_type,
@@ -63,6 +92,7 @@ class Texture:
             )
         else:
             # if a data array is provided use this
+            self.gpu_bytes = img.nbytes
             gl.glTexImage2D(
                 self.target,
                 0,
@@ -81,12 +111,144 @@ class Texture:
 
         # set how sampling from the texture is done.
         gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAG_FILTER, sample)
-        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MIN_FILTER, sample)
+        gl.glTexParameteri(
+            self.target,
+            gl.GL_TEXTURE_MIN_FILTER,
+            gl.GL_LINEAR_MIPMAP_LINEAR if mipmapped else sample,
+        )
 
         self.unbind()
 
+    @classmethod
+    def prefetch(cls, names):
+        """Start decoding the images of textures that are about to be created in the background,
+        skipping any already processed.
+        """
+        prefetch_images(
+            name
+            for name in names
+            if cls.processing_format is None
+            or not texture_pipeline.is_processed(
+                name, cls.processing_format, cls.mip_filter
+            )
+        )
+
+    @classmethod
+    def supported_processing_format(cls) -> str:
+        """The `processing_format`, or rgba8 if it's off or the OpenGL context can't sample it."""
+        format_name = cls.processing_format or "rgba8"
+        if format_name in Texture.unsupported_formats:
+            return "rgba8"
+        if not texture_pipeline.format_supported(texture_pipeline.FORMATS[format_name]):
+            print(
+                f"(W) Texture format {format_name} isn't supported by this OpenGL context,"
+                " falling back to rgba8"
+            )
+            Texture.unsupported_formats.add(format_name)
+            return "rgba8"
+        return format_name
+
+    def load_processed(self, name) -> int:
+        """Upload the mip chain of the image processed into the `processing_format`.
+
+        Returns:
+            int: Bytes uploaded
+        """
+        format_name = self.supported_processing_format()
+        file_name = texture_pipeline.process_texture(name, format_name, self.mip_filter)
+        ktx2 = texture_pipeline.read_ktx2(file_name)
+        texture_pipeline.upload_ktx2(ktx2, self.target)
+        return sum(len(level) for level in ktx2.levels)
+
     def bind(self):
         gl.glBindTexture(self.target, self.texture_id)
 
     def unbind(self):
         gl.glBindTexture(self.target, 0)
+
+    def delete(self):
+        """Free the texture's GPU memory."""
+        gl.glDeleteTextures(1, [self.texture_id])
+        self.gpu_bytes = 0
+
+
+class TextureRegistry:
+    """Shares one `Texture` between everything that uses the same image with the same sampler
+    settings, e.g. the hundreds of London materials that use a handful of images.
+
+    Textures are reference counted, and deleted once the last user releases them.
+    """
+
+    current_registry: Self = None  # type: ignore
+
+    def __init__(self):
+        # [texture, reference count] by key
+        self.textures: dict[tuple, list] = {}
+        # Key of each registered texture by texture id
+        self.keys: dict[int, tuple] = {}
+        self.hits = 0
+
+    @staticmethod
+    def key(name: str, wrap, sample) -> tuple:
+        return (
+            os.path.realpath(f"./textures/{name}"),
+            int(wrap),
+            int(sample),
+            Texture.processing_format,
+            Texture.mip_filter,
+        )
+
+    def acquire(self, name: str, wrap=gl.GL_REPEAT, sample=gl.GL_NEAREST) -> Texture:
+        """Get the shared texture of an image, loading it if nothing else is using it.
+
+        Args:
+            name (str): Image in the textures folder
+            wrap (optional): Texture wrap mode. Defaults to gl.GL_REPEAT.
+            sample (optional): Texture sampling filter. Defaults to gl.GL_NEAREST.
+
+        Returns:
+            Texture: The texture, to be given back with `release` when finished with
+        """
+        key = self.key(name, wrap, sample)
+        entry = self.textures.get(key)
+        if entry is not None:
+            entry[1] += 1
+            self.hits += 1
+            return entry[0]
+
+        texture = Texture(name, wrap=wrap, sample=sample)
+        self.textures[key] = [texture, 1]
+        self.keys[texture.texture_id] = key
+        return texture
+
+    def release(self, texture: Texture):
+        """Stop using a texture from `acquire`. Textures that weren't acquired are ignored."""
+        key = self.keys.get(texture.texture_id)
+        if key is None:
+            return
+
+        entry = self.textures[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.textures[key]
+            del self.keys[texture.texture_id]
+            texture.delete()
+
+    @property
+    def gpu_bytes(self) -> int:
+        return sum(texture.gpu_bytes for texture, _ in self.textures.values())
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        imgui.text(
+            f"{len(self.textures)} shared textures, {self.gpu_bytes / 2**20:.1f}MiB,"
+            f" {self.hits} loads saved"
+        )
+        for texture, references in self.textures.values():
+            imgui.bullet_text(
+                f"{texture.name}: {texture.gpu_bytes / 2**20:.2f}MiB,"
+                f" {references} users"
+            )
+
+
+TextureRegistry.current_registry = TextureRegistry()
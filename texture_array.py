@@ -0,0 +1,197 @@
+"""Packing material textures into texture arrays.
+
+Every mesh of a model like London binds one of a few textures, so consecutive meshes keep
+switching textures and can't be merged into fewer draws. When packing is on, the textures
+of a material library that share sampler settings are resized to one layer size and uploaded
+as the layers of a single `GL_TEXTURE_2D_ARRAY`. Each material keeps its own UVs, and selects
+its image with `Material.texture_layer`, so every mesh of the model shares one binding.
+
+Unlike an atlas, each layer still wraps on its own, so tiled UVs outside [0, 1] keep working.
+"""
+
+import math
+from typing import ClassVar
+
+import imgui
+import numpy as np
+from OpenGL import GL as gl
+
+import texture_pipeline
+from material import MaterialLibrary
+from texture import Texture
+from texture_cache import load_image, prefetch_images
+
+
+def resize_axis(image, axis: int, size: int):
+    """Resize an image along one axis, halving it with the mip filter while it's more than
+    twice too big, then interpolating linearly.
+    """
+    kernel = (
+        texture_pipeline.KAISER_KERNEL
+        if Texture.mip_filter == "kaiser"
+        else texture_pipeline.BOX_KERNEL
+    )
+    while image.shape[axis] >= 2 * size:
+        image = texture_pipeline.downsample_axis(image, axis, kernel)
+
+    length = image.shape[axis]
+    if length == size:
+        return image
+
+    # Sample at the centre of each output pixel
+    positions = np.clip((np.arange(size) + 0.5) * length / size - 0.5, 0, length - 1)
+    low = np.floor(positions).astype(int)
+    high = np.minimum(low + 1, length - 1)
+    shape = [1] * image.ndim
+    shape[axis] = size
+    weight = (positions - low).reshape(shape)
+    return (
+        np.take(image, low, axis=axis) * (1 - weight)
+        + np.take(image, high, axis=axis) * weight
+    )
+
+
+def resize_image(image, width: int, height: int):
+    """Resize a (height, width, channels) uint8 image."""
+    resized = image.astype(np.float32)
+    resized = resize_axis(resize_axis(resized, 0, height), 1, width)
+    return np.clip(np.rint(resized), 0, 255).astype(np.uint8)
+
+
+class TextureArray(Texture):
+    """A `GL_TEXTURE_2D_ARRAY` holding several images, resized to the same size."""
+
+    # Texture arrays are bound to a different unit to 2D textures, since samplers of different
+    # types can't share a unit
+    texture_unit = 1
+
+    # Pack the textures of material libraries as models are loaded
+    pack_materials = False
+    max_layer_size = 2048
+    # Texture arrays created by packing, by their images and settings, so material libraries
+    # shared between models (e.g. London's clock hands) share one array
+    packed: ClassVar[dict[tuple, "TextureArray"]] = {}
+
+    def __init__(self, names: list[str], wrap=gl.GL_REPEAT, sample=gl.GL_NEAREST):
+        """Load images into the layers of a texture array.
+
+        The layer size is the square power of two with at least as many pixels as the
+        largest image, so packing doesn't lose much detail on average, up to `max_layer_size`.
+
+        Args:
+            names (list[str]): Images in the textures folder, one per layer
+            wrap (optional): Texture wrap mode. Defaults to gl.GL_REPEAT.
+            sample (optional): Texture sampling filter. Defaults to gl.GL_NEAREST.
+        """
+        self.name = ", ".join(names)
+        self.wrap = wrap
+        self.sample = sample
+        self.target = gl.GL_TEXTURE_2D_ARRAY
+        self.layers = {name: layer for layer, name in enumerate(names)}
+
+        prefetch_images(names)
+        images = [load_image(name) for name in names]
+        largest = max(image.shape[0] * image.shape[1] for image in images)
+        self.size = min(2 ** math.ceil(math.log2(largest) / 2), self.max_layer_size)
+
+        format_name = Texture.supported_processing_format()
+        texture_format = texture_pipeline.FORMATS[format_name]
+        # Mip levels of each layer, largest first
+        layer_levels = [
+            texture_pipeline.generate_mipmaps(
+                resize_image(image, self.size, self.size), Texture.mip_filter
+            )
+            for image in images
+        ]
+
+        self.texture_id = gl.glGenTextures(1)
+        self.bind()
+
+        self.gpu_bytes = 0
+        for level, levels in enumerate(zip(*layer_levels)):
+            size = levels[0].shape[0]
+            # Layers are stored one after another
+            data = np.frombuffer(
+                b"".join(
+                    texture_pipeline.encode_level(image, texture_format)
+                    for image in levels
+                ),
+                dtype=np.uint8,
+            )
+            self.gpu_bytes += data.nbytes
+            if texture_format.compressed:
+                gl.glCompressedTexImage3D(
+                    self.target,
+                    level,
+                    texture_format.gl_internal_format,
+                    size,
+                    size,
+                    len(names),
+                    0,
+                    data,
+                )
+            else:
+                gl.glTexImage3D(
+                    self.target,
+                    level,
+                    texture_format.gl_internal_format,
+                    size,
+                    size,
+                    len(names),
+                    0,
+                    gl.GL_RGBA,
+                    gl.GL_UNSIGNED_BYTE,
+                    data,
+                )
+
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_S, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_T, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAG_FILTER, sample)
+        gl.glTexParameteri(
+            self.target, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR
+        )
+        gl.glTexParameteri(
+            self.target, gl.GL_TEXTURE_MAX_LEVEL, len(layer_levels[0]) - 1
+        )
+
+        self.unbind()
+
+    @staticmethod
+    def debug_menu():
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        for array in TextureArray.packed.values():
+            imgui.bullet_text(
+                f"{len(array.layers)} layers of {array.size}x{array.size},"
+                f" {array.gpu_bytes / 2**20:.1f}MiB: {array.name}"
+            )
+
+
+def pack_library_textures(library: MaterialLibrary) -> TextureArray | None:
+    """Pack the image textures of a material library's materials into a texture array, and
+    point each material at the array and its layer.
+
+    Returns:
+        TextureArray | None: The array, if there were at least two textures to pack
+    """
+    names = sorted({
+        material.texture
+        for material in library.materials
+        if isinstance(material.texture, str)
+    })
+    # Materials only have a texture path, so they all use the default sampler settings
+    if len(names) < 2:
+        return None
+
+    key = (tuple(names), Texture.processing_format, Texture.mip_filter)
+    array = TextureArray.packed.get(key)
+    if array is None:
+        array = TextureArray.packed[key] = TextureArray(names)
+        print(
+            f"Packed {len(names)} textures into a {array.size}x{array.size} texture array"
+        )
+
+    for material in library.materials:
+        if isinstance(material.texture, str):
+            material.texture_layer = array.layers[material.texture]
+            material.texture = array
+    return array
@@ -0,0 +1,172 @@
+"""A disk cache of decoded images, and parallel image decoding.
+
+Decoding a PNG is much slower than reading the same pixels back uncompressed, so the first time
+an image is decoded its RGBA pixels are saved to `cache/decoded` as a .npy file named after the
+hash of the image file. Later loads memory map that file and hand the pixels straight to OpenGL,
+without decoding or copying them. Images that aren't cached yet can be decoded ahead of time on
+a thread pool with `prefetch`, e.g. the six faces of a cube map or every texture of a material
+library. Prefetched images are only held until they're loaded or finish decoding, after which
+`load` reads them back from the cache.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Self
+
+import imgui
+import numpy as np
+import pygame
+
+CACHE_DIRECTORY = "./cache/decoded"
+
+
+def file_hash(file_name: str) -> str:
+    """Hash of a file's contents, so renamed or copied images share a cache entry."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def decode_image(file_name: str) -> np.ndarray:
+    """Decode an image with pygame.
+
+    Returns:
+        NDArray: (height, width, 4) uint8 RGBA, bottom row first like OpenGL expects
+    """
+    surface = pygame.image.load(file_name)
+    width, height = surface.get_size()
+    # pygame copies the pixels once, flipped into RGBA, and the bytes are wrapped rather than
+    # copied again. Only cache misses pay for this, hits are memory mapped
+    pixels = np.frombuffer(pygame.image.tostring(surface, "RGBA", True), dtype=np.uint8)
+    return pixels.reshape(height, width, 4)
+
+
+class DecodedImageCache:
+    """Loads images from the textures folder, decoding each image file only once."""
+
+    current_cache: Self = None  # type: ignore
+
+    def __init__(self, directory=CACHE_DIRECTORY, workers=None):
+        """
+        Args:
+            directory (str, optional): Where decoded images are saved. Defaults to "./cache/decoded".
+            workers (int, optional): Threads decoding images. Defaults to the
+                `ThreadPoolExecutor` default, based on the number of CPUs.
+        """
+        self.directory = directory
+        self.enabled = True
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="decode"
+        )
+
+        # Images being loaded on the thread pool, by name
+        self.pending: dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.decode_time = 0.0
+
+    def cache_file(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def load_now(self, name: str) -> np.ndarray:
+        """Load an image on this thread, from the cache if it's there, otherwise by decoding it
+        and adding it to the cache.
+        """
+        file_name = f"./textures/{name}"
+        if not self.enabled:
+            return decode_image(file_name)
+
+        cache_file = self.cache_file(file_hash(file_name))
+        if os.path.exists(cache_file):
+            try:
+                pixels = np.load(cache_file, mmap_mode="r")
+            except (OSError, ValueError) as error:
+                print(f"(W) Ignoring unreadable cached image {cache_file}: {error}")
+            else:
+                with self.lock:
+                    self.hits += 1
+                return pixels
+
+        start = time.perf_counter()
+        pixels = decode_image(file_name)
+        elapsed = time.perf_counter() - start
+
+        # Written under a temporary name, so other processes never read half a file
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_file = f"{cache_file}.{threading.get_ident()}.tmp"
+        with open(temporary_file, "wb") as file:
+            np.save(file, pixels)
+        os.replace(temporary_file, cache_file)
+
+        with self.lock:
+            self.misses += 1
+            self.decode_time += elapsed
+        return pixels
+
+    def prefetch(self, names):
+        """Start loading images on the thread pool, to be collected later with `load`."""
+        started = []
+        with self.lock:
+            for name in names:
+                if name not in self.pending:
+                    future = self.executor.submit(self.load_now, name)
+                    self.pending[name] = future
+                    started.append((name, future))
+
+        # Outside the lock, as callbacks of futures that have already finished run straight away
+        for name, future in started:
+            future.add_done_callback(
+                lambda future, name=name: self.finished(name, future)
+            )
+
+    def finished(self, name: str, future: Future):
+        """Forget a prefetched image once it's decoded and cached, so images that are never
+        loaded aren't kept for the life of the process.
+        """
+        with self.lock:
+            if self.pending.get(name) is future:
+                del self.pending[name]
+
+    def load(self, name: str) -> np.ndarray:
+        """Load an image, waiting for it if it's being prefetched.
+
+        Args:
+            name (str): Image in the textures folder
+
+        Returns:
+            NDArray: (height, width, 4) uint8 RGBA, bottom row first. Cached images are
+                read only memory maps.
+        """
+        with self.lock:
+            future = self.pending.pop(name, None)
+        if future is not None:
+            return future.result()
+        return self.load_now(name)
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        _, self.enabled = imgui.checkbox("Cache decoded images", self.enabled)
+        imgui.text(
+            f"{self.hits} cache hits, {self.misses} images decoded"
+            f" in {self.decode_time * 1000:.1f}ms"
+        )
+
+
+DecodedImageCache.current_cache = DecodedImageCache()
+
+
+def load_image(name: str) -> np.ndarray:
+    """Load an image from the textures folder through the decoded image cache."""
+    return DecodedImageCache.current_cache.load(name)
+
+
+def prefetch_images(names):
+    """Start decoding images from the textures folder in the background."""
+    DecodedImageCache.current_cache.prefetch(names)
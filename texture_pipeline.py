@@ -0,0 +1,868 @@
+"""Texture processing: mipmap generation, GPU block compression and KTX2 containers.
+
+Images are processed the first time they are loaded (or ahead of time with
+`python texture_pipeline.py`) into a KTX2 file holding the whole mip chain, optionally
+block compressed, which `Texture` then uploads level by level. Compressed textures take
+4 to 8 times less memory and bandwidth than RGBA8, and mipmaps stop minified textures from
+aliasing and thrashing the texture cache.
+
+Formats:
+    rgba8: Uncompressed, 4 bytes per pixel
+    bc1: BC1 (DXT1) with 1 bit alpha, 0.5 bytes per pixel
+    bc3: BC3 (DXT5), BC1 colour with interpolated alpha, 1 byte per pixel
+    bc7: BC7 modes 5 and 6, RGBA with separate or shared alpha, 1 byte per pixel
+    etc2: ETC2 RGB (individual mode blocks), no alpha, 0.5 bytes per pixel
+
+The encoders are written in NumPy for portability rather than quality, a dedicated encoder
+would do better.
+"""
+
+import argparse
+import math
+import os
+import struct
+import sys
+from typing import NamedTuple
+
+import numpy as np
+from OpenGL import GL as gl
+
+from texture_cache import load_image, prefetch_images
+
+CACHE_DIRECTORY = "./cache/textures"
+
+KTX2_IDENTIFIER = b"\xabKTX 20\xbb\r\n\x1a\n"
+
+# Blocks encoded at once, bounds the memory used for intermediate arrays
+CHUNK_BLOCKS = 4096
+
+
+class TextureFormat(NamedTuple):
+    name: str
+    vk_format: int
+    gl_internal_format: int
+    # Bytes per 4x4 block, or per pixel for uncompressed formats
+    block_bytes: int
+    compressed: bool
+    # Data format descriptor colour model and (bit offset, bit length, channel) of each sample
+    colour_model: int
+    samples: tuple[tuple[int, int, int], ...]
+
+
+FORMATS = {
+    texture_format.name: texture_format
+    for texture_format in [
+        TextureFormat(
+            "rgba8",
+            37,  # VK_FORMAT_R8G8B8A8_UNORM
+            gl.GL_RGBA8,
+            4,
+            False,
+            1,  # KHR_DF_MODEL_RGBSDA
+            ((0, 8, 0), (8, 8, 1), (16, 8, 2), (24, 8, 15)),
+        ),
+        TextureFormat(
+            "bc1",
+            133,  # VK_FORMAT_BC1_RGBA_UNORM_BLOCK
+            0x83F1,  # GL_COMPRESSED_RGBA_S3TC_DXT1_EXT
+            8,
+            True,
+            128,  # KHR_DF_MODEL_BC1A
+            ((0, 64, 1),),
+        ),
+        TextureFormat(
+            "bc3",
+            137,  # VK_FORMAT_BC3_UNORM_BLOCK
+            0x83F3,  # GL_COMPRESSED_RGBA_S3TC_DXT5_EXT
+            16,
+            True,
+            130,  # KHR_DF_MODEL_BC3
+            ((0, 64, 15), (64, 64, 0)),
+        ),
+        TextureFormat(
+            "bc7",
+            145,  # VK_FORMAT_BC7_UNORM_BLOCK
+            0x8E8C,  # GL_COMPRESSED_RGBA_BPTC_UNORM
+            16,
+            True,
+            134,  # KHR_DF_MODEL_BC7
+            ((0, 128, 0),),
+        ),
+        TextureFormat(
+            "etc2",
+            147,  # VK_FORMAT_ETC2_R8G8B8_UNORM_BLOCK
+            0x9274,  # GL_COMPRESSED_RGB8_ETC2
+            8,
+            True,
+            161,  # KHR_DF_MODEL_ETC2
+            ((0, 64, 2),),
+        ),
+    ]
+}
+
+MIP_FILTERS = ("box", "kaiser")
+
+
+#
+# Mipmaps
+#
+
+
+def kaiser_kernel(taps=6, alpha=4.0):
+    """Weights of a Kaiser windowed sinc filter that halves the resolution."""
+    distances = np.arange(taps) - (taps - 1) / 2
+    window = np.i0(alpha * np.sqrt(1 - (distances / (taps / 2)) ** 2)) / np.i0(alpha)
+    weights = np.sinc(distances / 2) * window
+    return weights / weights.sum()
+
+
+BOX_KERNEL = np.array([0.5, 0.5])
+KAISER_KERNEL = kaiser_kernel()
+
+
+def downsample_axis(image, axis: int, kernel):
+    """Halve the size of an image along one axis, filtering with a symmetric kernel."""
+    size = image.shape[axis]
+    if size == 1:
+        return image
+
+    taps = len(kernel)
+    padding = [(0, 0)] * image.ndim
+    padding[axis] = (taps // 2 - 1, taps // 2)
+    padded = np.pad(image, padding, mode="edge")
+
+    # Output pixel i is centred between input pixels 2i and 2i + 1
+    first_taps = 2 * np.arange(size // 2)
+    return sum(
+        weight * np.take(padded, first_taps + tap, axis=axis)
+        for tap, weight in enumerate(kernel)
+    )
+
+
+def generate_mipmaps(image, mip_filter="kaiser") -> list:
+    """Generate a full mip chain, down to 1x1.
+
+    Args:
+        image (NDArray): (height, width, channels) uint8 image
+        mip_filter (str, optional): "box" or "kaiser". Defaults to "kaiser", which is sharper.
+
+    Returns:
+        list[NDArray]: uint8 images, starting with the original
+    """
+    if mip_filter not in MIP_FILTERS:
+        raise ValueError(f"(E) Unknown mip filter {mip_filter}")
+    kernel = KAISER_KERNEL if mip_filter == "kaiser" else BOX_KERNEL
+
+    levels = [image]
+    level = image.astype(np.float32)
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        # Filter from the previous unrounded level, so rounding errors don't accumulate
+        level = downsample_axis(downsample_axis(level, 0, kernel), 1, kernel)
+        levels.append(np.clip(np.rint(level), 0, 255).astype(np.uint8))
+    return levels
+
+
+#
+# Block compression
+#
+
+
+def image_blocks(image) -> np.ndarray:
+    """Split an image into 4x4 blocks, padding the edges to a multiple of 4.
+
+    Returns:
+        NDArray: (blocks, 16, channels) float32 pixels, blocks and pixels in row order
+    """
+    height, width, channels = image.shape
+    image = np.pad(image, ((0, -height % 4), (0, -width % 4), (0, 0)), mode="edge")
+    rows, columns = image.shape[0] // 4, image.shape[1] // 4
+    return (
+        image
+        .reshape(rows, 4, columns, 4, channels)
+        .transpose(0, 2, 1, 3, 4)
+        .reshape(-1, 16, channels)
+        .astype(np.float32)
+    )
+
+
+def principal_endpoints(pixels):
+    """Fit a line through each block's pixels, returning the ends of the pixels along it.
+
+    Args:
+        pixels (NDArray): (blocks, 16, channels)
+
+    Returns:
+        tuple[NDArray, NDArray]: (blocks, channels) low and high endpoints
+    """
+    mean = pixels.mean(axis=1, keepdims=True)
+    centred = pixels - mean
+    covariance = np.einsum("npi,npj->nij", centred, centred)
+
+    # Power iteration for the principal axis
+    axis = np.ones(pixels.shape[::2], dtype=np.float32)
+    for _ in range(8):
+        axis = np.einsum("nij,nj->ni", covariance, axis)
+        norm = np.linalg.norm(axis, axis=1, keepdims=True)
+        axis /= np.where(norm > 0, norm, 1)
+
+    projections = np.einsum("npc,nc->np", centred, axis)
+    low = mean[:, 0] + projections.min(axis=1, keepdims=True) * axis
+    high = mean[:, 0] + projections.max(axis=1, keepdims=True) * axis
+    return np.clip(low, 0, 255), np.clip(high, 0, 255)
+
+
+def nearest_indices(pixels, palette):
+    """Index of the closest palette entry to each pixel.
+
+    Args:
+        pixels (NDArray): (blocks, 16, channels)
+        palette (NDArray): (blocks, entries, channels)
+    """
+    distances = np.square(pixels[:, :, np.newaxis] - palette[:, np.newaxis]).sum(
+        axis=-1
+    )
+    return distances.argmin(axis=-1)
+
+
+def pack_bits(fields, total_bits: int) -> np.ndarray:
+    """Pack fields into little endian blocks, least significant bits first.
+
+    Args:
+        fields (list[tuple[NDArray, int]]): (values per block, width in bits) of each field
+        total_bits (int): Size of a block in bits, a multiple of 64
+
+    Returns:
+        NDArray: (blocks, total_bits / 8) uint8
+    """
+    count = len(fields[0][0])
+    words = np.zeros((count, total_bits // 64), dtype=np.uint64)
+    offset = 0
+    for values, width in fields:
+        values = np.asarray(values).astype(np.uint64)
+        word, shift = divmod(offset, 64)
+        words[:, word] |= values << np.uint64(shift)
+        if shift + width > 64:
+            words[:, word + 1] |= values >> np.uint64(64 - shift)
+        offset += width
+    return words.astype("<u8").view(np.uint8).reshape(count, total_bits // 8)
+
+
+def to_rgb565(colours):
+    colours = np.rint(colours).astype(np.uint32)
+    return (
+        ((colours[:, 0] * 31 + 127) // 255) << 11
+        | ((colours[:, 1] * 63 + 127) // 255) << 5
+        | ((colours[:, 2] * 31 + 127) // 255)
+    )
+
+
+def from_rgb565(packed):
+    red = (packed >> 11) & 31
+    green = (packed >> 5) & 63
+    blue = packed & 31
+    return np.stack(
+        [
+            (red << 3) | (red >> 2),
+            (green << 2) | (green >> 4),
+            (blue << 3) | (blue >> 2),
+        ],
+        axis=-1,
+    ).astype(np.float32)
+
+
+def encode_bc1_colour(pixels, punch_through=False):
+    """Encode the colour of blocks as BC1.
+
+    Args:
+        pixels (NDArray): (blocks, 16, 4) RGBA
+        punch_through (bool, optional): Make pixels with alpha under 128 transparent, in blocks
+            that have any. Defaults to False, every block is opaque as in BC3.
+
+    Returns:
+        NDArray: (blocks, 8) uint8
+    """
+    colours = pixels[:, :, :3]
+    transparent = (
+        pixels[:, :, 3] < 128 if punch_through else np.zeros(colours.shape[:2], bool)
+    )
+    has_transparency = transparent.any(axis=1)
+
+    # Fit the endpoints to the opaque pixels only
+    opaque_count = np.maximum((~transparent).sum(axis=1, keepdims=True), 1)
+    opaque_mean = (
+        np.where(transparent[..., np.newaxis], 0, colours).sum(axis=1) / opaque_count
+    )
+    fitted = np.where(transparent[..., np.newaxis], opaque_mean[:, np.newaxis], colours)
+    low, high = principal_endpoints(fitted)
+
+    colour0 = to_rgb565(high)
+    colour1 = to_rgb565(low)
+    # Four colour blocks need colour0 > colour1, three colour blocks colour0 <= colour1
+    swap = np.where(has_transparency, colour0 > colour1, colour0 < colour1)
+    colour0, colour1 = (
+        np.where(swap, colour1, colour0),
+        np.where(swap, colour0, colour1),
+    )
+
+    endpoint0 = from_rgb565(colour0)
+    endpoint1 = from_rgb565(colour1)
+    four_colour_palette = np.stack(
+        [
+            endpoint0,
+            endpoint1,
+            (2 * endpoint0 + endpoint1) / 3,
+            (endpoint0 + 2 * endpoint1) / 3,
+        ],
+        axis=1,
+    )
+    three_colour_palette = np.stack(
+        [
+            endpoint0,
+            endpoint1,
+            (endpoint0 + endpoint1) / 2,
+            np.full_like(endpoint0, 1e6),
+        ],
+        axis=1,
+    )
+    palette = np.where(
+        has_transparency[:, np.newaxis, np.newaxis],
+        three_colour_palette,
+        four_colour_palette,
+    )
+
+    indices = np.where(transparent, 3, nearest_indices(colours, palette))
+    # Blocks of a single colour are all index 0
+    indices = np.where((colour0 == colour1)[:, np.newaxis] & ~transparent, 0, indices)
+
+    return pack_bits(
+        [(colour0, 16), (colour1, 16)] + [(indices[:, i], 2) for i in range(16)], 64
+    )
+
+
+def encode_bc1(pixels):
+    return encode_bc1_colour(pixels, punch_through=True)
+
+
+def encode_bc3(pixels):
+    """Encode blocks as BC3: an 8 alpha interpolated alpha block then a BC1 colour block."""
+    alpha = pixels[:, :, 3]
+    alpha0 = alpha.max(axis=1)
+    alpha1 = alpha.min(axis=1)
+
+    weights = np.array([0, 7, 1, 2, 3, 4, 5, 6], dtype=np.float32) / 7
+    palette = np.rint(
+        alpha0[:, np.newaxis] * (1 - weights) + alpha1[:, np.newaxis] * weights
+    )
+    indices = nearest_indices(alpha[..., np.newaxis], palette[..., np.newaxis])
+    indices = np.where((alpha0 == alpha1)[:, np.newaxis], 0, indices)
+
+    alpha_block = pack_bits(
+        [(alpha0, 8), (alpha1, 8)] + [(indices[:, i], 3) for i in range(16)], 64
+    )
+    return np.concatenate([alpha_block, encode_bc1_colour(pixels)], axis=1)
+
+
+BC7_WEIGHTS = {
+    2: np.array([0, 21, 43, 64]),
+    4: np.array([0, 4, 9, 13, 17, 21, 26, 30, 34, 38, 43, 47, 51, 55, 60, 64]),
+}
+
+
+def interpolate_bc7(endpoint0, endpoint1, index_bits: int):
+    """The palette BC7 interpolates between decoded 8 bit endpoints.
+
+    Returns:
+        NDArray: (blocks, entries, channels)
+    """
+    weights = BC7_WEIGHTS[index_bits][np.newaxis, :, np.newaxis]
+    return np.floor(
+        (
+            (64 - weights) * endpoint0[:, np.newaxis]
+            + weights * endpoint1[:, np.newaxis]
+            + 32
+        )
+        / 64
+    )
+
+
+def fit_bc7_indices(pixels, endpoint0, endpoint1, index_bits: int):
+    """Choose the closest palette entry for each pixel.
+
+    Returns:
+        tuple[NDArray, NDArray]: (blocks, 16) indices and the squared error of each block
+    """
+    palette = interpolate_bc7(endpoint0, endpoint1, index_bits)
+    indices = nearest_indices(pixels, palette)
+    decoded = np.take_along_axis(palette, indices[..., np.newaxis], axis=1)
+    return indices, np.square(decoded - pixels).sum(axis=(1, 2))
+
+
+def swap_bc7_anchor(indices, index_bits: int, *endpoints):
+    """The first pixel's index is stored without its top bit, so when it's set swap the
+    endpoints and invert the indices.
+
+    Returns:
+        tuple: The indices, then each pair of endpoints
+    """
+    highest = (1 << index_bits) - 1
+    swap = indices[:, 0] > highest // 2
+    swapped = [np.where(swap[:, np.newaxis], highest - indices, indices)]
+    for first, second in zip(endpoints[::2], endpoints[1::2]):
+        mask = swap.reshape((-1,) + (1,) * (first.ndim - 1))
+        swapped += [np.where(mask, second, first), np.where(mask, first, second)]
+    return tuple(swapped)
+
+
+def index_fields(indices, index_bits: int) -> list:
+    return [(indices[:, 0], index_bits - 1)] + [
+        (indices[:, i], index_bits) for i in range(1, 16)
+    ]
+
+
+def quantise_bc7_mode6_endpoint(endpoint):
+    """Quantise 8 bit RGBA endpoints to 7 bits plus a shared p-bit, choosing the closer p-bit.
+
+    Returns:
+        tuple[NDArray, NDArray, NDArray]: 7 bit values, p-bits, and the decoded 8 bit endpoints
+    """
+    candidates = []
+    for p_bit in (0, 1):
+        values = np.clip(np.rint((endpoint - p_bit) / 2), 0, 127)
+        decoded = values * 2 + p_bit
+        error = np.square(decoded - endpoint).sum(axis=1)
+        candidates.append((values, np.full(len(endpoint), p_bit), decoded, error))
+
+    use_one = candidates[1][3] < candidates[0][3]
+    return tuple(
+        np.where(use_one[:, np.newaxis] if zero.ndim == 2 else use_one, one, zero)
+        for zero, one in zip(candidates[0][:3], candidates[1][:3])
+    )
+
+
+def encode_bc7_mode6(pixels):
+    """Encode blocks as BC7 mode 6: RGBA endpoints with p-bits and 4 bit indices.
+
+    Returns:
+        tuple[NDArray, NDArray]: (blocks, 16) uint8 blocks and the squared error of each
+    """
+    low, high = principal_endpoints(pixels)
+    values0, p_bits0, endpoint0 = quantise_bc7_mode6_endpoint(low)
+    values1, p_bits1, endpoint1 = quantise_bc7_mode6_endpoint(high)
+    indices, error = fit_bc7_indices(pixels, endpoint0, endpoint1, 4)
+    indices, values0, values1, p_bits0, p_bits1 = swap_bc7_anchor(
+        indices, 4, values0, values1, p_bits0, p_bits1
+    )
+
+    fields = [(np.full(len(pixels), 1 << 6), 7)]
+    for channel in range(4):
+        fields += [(values0[:, channel], 7), (values1[:, channel], 7)]
+    fields += [(p_bits0, 1), (p_bits1, 1)] + index_fields(indices, 4)
+    return pack_bits(fields, 128), error
+
+
+def encode_bc7_mode5(pixels):
+    """Encode blocks as BC7 mode 5: separate RGB and alpha endpoints, each with 2 bit indices,
+    for blocks whose alpha doesn't follow their colour.
+
+    Returns:
+        tuple[NDArray, NDArray]: (blocks, 16) uint8 blocks and the squared error of each
+    """
+    colours = pixels[:, :, :3]
+    alpha = pixels[:, :, 3:]
+
+    low, high = principal_endpoints(colours)
+    colour_values0 = np.rint(low * 127 / 255)
+    colour_values1 = np.rint(high * 127 / 255)
+    colour_endpoint0 = colour_values0 * 2 + colour_values0 // 64
+    colour_endpoint1 = colour_values1 * 2 + colour_values1 // 64
+    colour_indices, colour_error = fit_bc7_indices(
+        colours, colour_endpoint0, colour_endpoint1, 2
+    )
+
+    alpha0 = alpha.min(axis=1)
+    alpha1 = alpha.max(axis=1)
+    alpha_indices, alpha_error = fit_bc7_indices(alpha, alpha0, alpha1, 2)
+
+    colour_indices, colour_values0, colour_values1 = swap_bc7_anchor(
+        colour_indices, 2, colour_values0, colour_values1
+    )
+    alpha_indices, alpha0, alpha1 = swap_bc7_anchor(alpha_indices, 2, alpha0, alpha1)
+
+    fields = [(np.full(len(pixels), 1 << 5), 6), (np.zeros(len(pixels)), 2)]
+    for channel in range(3):
+        fields += [(colour_values0[:, channel], 7), (colour_values1[:, channel], 7)]
+    fields += [(alpha0[:, 0], 8), (alpha1[:, 0], 8)]
+    fields += index_fields(colour_indices, 2) + index_fields(alpha_indices, 2)
+    return pack_bits(fields, 128), colour_error + alpha_error
+
+
+def encode_bc7(pixels):
+    """Encode blocks as BC7, using whichever of modes 5 and 6 is closer for each block."""
+    mode6, mode6_error = encode_bc7_mode6(pixels)
+    mode5, mode5_error = encode_bc7_mode5(pixels)
+    return np.where((mode5_error < mode6_error)[:, np.newaxis], mode5, mode6)
+
+
+# Intensity modifiers of each ETC table, in pixel index order
+ETC_MODIFIERS = np.array(
+    [
+        [small, large, -small, -large]
+        for small, large in [
+            (2, 8),
+            (5, 17),
+            (9, 29),
+            (13, 42),
+            (18, 60),
+            (24, 80),
+            (33, 106),
+            (47, 183),
+        ]
+    ],
+    dtype=np.float32,
+)
+
+# Pixels (in row order) of each sub-block, without and with the flip bit
+ETC_SUBBLOCKS = [
+    [
+        [y * 4 + x for y in range(4) for x in range(2)],
+        [y * 4 + x for y in range(4) for x in range(2, 4)],
+    ],
+    [
+        [y * 4 + x for y in range(2) for x in range(4)],
+        [y * 4 + x for y in range(2, 4) for x in range(4)],
+    ],
+]
+
+# Bit position of each pixel's index, ETC stores them in column order
+ETC_INDEX_BITS = np.array(
+    [x * 4 + y for y in range(4) for x in range(4)], dtype=np.uint64
+)
+
+
+def fit_etc_subblock(pixels):
+    """Choose the 4 bit base colour, table and pixel modifiers of ETC sub-blocks.
+
+    Args:
+        pixels (NDArray): (blocks, 8, 3)
+
+    Returns:
+        tuple: base colours (blocks, 3), tables (blocks,), modifier indices (blocks, 8) and errors
+    """
+    base = np.clip(np.rint(pixels.mean(axis=1) / 17), 0, 15)
+    # (blocks, tables, modifiers, channels)
+    candidates = np.clip(
+        base[:, np.newaxis, np.newaxis] * 17
+        + ETC_MODIFIERS[np.newaxis, :, :, np.newaxis],
+        0,
+        255,
+    )
+    # (blocks, tables, pixels, modifiers)
+    errors = np.square(
+        pixels[:, np.newaxis, :, np.newaxis] - candidates[:, :, np.newaxis]
+    ).sum(axis=-1)
+    modifiers = errors.argmin(axis=-1)
+    table_errors = errors.min(axis=-1).sum(axis=-1)
+    tables = table_errors.argmin(axis=1)
+
+    blocks = np.arange(len(pixels))
+    return base, tables, modifiers[blocks, tables], table_errors[blocks, tables]
+
+
+def encode_etc2(pixels):
+    """Encode blocks as ETC2 RGB, using only ETC1 compatible individual mode blocks."""
+    colours = pixels[:, :, :3]
+    fits = []
+    for flip, subblocks in enumerate(ETC_SUBBLOCKS):
+        subblock_fits = [
+            fit_etc_subblock(colours[:, subblock]) for subblock in subblocks
+        ]
+        fits.append((flip, subblocks, subblock_fits))
+
+    flip_errors = np.stack([fit[2][0][3] + fit[2][1][3] for fit in fits], axis=1)
+    flipped = flip_errors.argmin(axis=1) == 1
+
+    count = len(pixels)
+    bases = [np.zeros((count, 3), dtype=np.uint64) for _ in range(2)]
+    tables = [np.zeros(count, dtype=np.uint64) for _ in range(2)]
+    indices = np.zeros((count, 16), dtype=np.uint64)
+    for flip, subblocks, subblock_fits in fits:
+        chosen = flipped == bool(flip)
+        for subblock, (base, table, modifiers, _) in enumerate(subblock_fits):
+            bases[subblock][chosen] = base[chosen]
+            tables[subblock][chosen] = table[chosen]
+            indices[np.ix_(chosen, subblocks[subblock])] = modifiers[chosen]
+
+    block = np.zeros(count, dtype=np.uint64)
+    for channel, shift in enumerate((60, 52, 44)):
+        block |= bases[0][:, channel] << np.uint64(shift)
+        block |= bases[1][:, channel] << np.uint64(shift - 4)
+    block |= tables[0] << np.uint64(37)
+    block |= tables[1] << np.uint64(34)
+    block |= flipped.astype(np.uint64) << np.uint64(32)
+    block |= ((indices >> np.uint64(1)) << (ETC_INDEX_BITS + np.uint64(16))).sum(
+        axis=1, dtype=np.uint64
+    )
+    block |= ((indices & np.uint64(1)) << ETC_INDEX_BITS).sum(axis=1, dtype=np.uint64)
+
+    # ETC blocks are big endian
+    return block.astype(">u8").view(np.uint8).reshape(count, 8)
+
+
+ENCODERS = {
+    "bc1": encode_bc1,
+    "bc3": encode_bc3,
+    "bc7": encode_bc7,
+    "etc2": encode_etc2,
+}
+
+
+def encode_level(image, texture_format: TextureFormat) -> bytes:
+    """Encode one mip level in a texture format."""
+    if not texture_format.compressed:
+        return np.ascontiguousarray(image).tobytes()
+
+    blocks = image_blocks(image)
+    encoder = ENCODERS[texture_format.name]
+    return b"".join(
+        encoder(blocks[start : start + CHUNK_BLOCKS]).tobytes()
+        for start in range(0, len(blocks), CHUNK_BLOCKS)
+    )
+
+
+#
+# KTX2 containers
+#
+
+
+class KTX2Texture(NamedTuple):
+    texture_format: TextureFormat
+    width: int
+    height: int
+    # Data of each mip level, largest first
+    levels: list[memoryview]
+
+
+def data_format_descriptor(texture_format: TextureFormat) -> bytes:
+    """The KTX2 data format descriptor of a texture format, a Khronos basic descriptor block."""
+    block_size = 24 + 16 * len(texture_format.samples)
+    block_dimension = 3 if texture_format.compressed else 0
+    words = [
+        0,  # Khronos vendor, basic descriptor type
+        2 | block_size << 16,  # Version 1.3
+        texture_format.colour_model | 1 << 8 | 1 << 16,  # BT.709 primaries, linear
+        block_dimension | block_dimension << 8,
+        texture_format.block_bytes,
+        0,
+    ]
+    for bit_offset, bit_length, channel in texture_format.samples:
+        upper = 255 if not texture_format.compressed else 0xFFFFFFFF
+        words += [bit_offset | (bit_length - 1) << 16 | channel << 24, 0, 0, upper]
+    return struct.pack(f"<I{len(words)}I", 4 + block_size, *words)
+
+
+def write_ktx2(
+    file_name: str, texture_format: TextureFormat, levels: list[bytes], width, height
+):
+    """Write a KTX2 file with a mip chain.
+
+    Args:
+        file_name (str): Where to write the file
+        texture_format (TextureFormat): Format of the level data
+        levels (list[bytes]): Data of each mip level, largest first
+        width (int): Width of the largest level
+        height (int): Height of the largest level
+    """
+    descriptor = data_format_descriptor(texture_format)
+    level_index_offset = 80
+    descriptor_offset = level_index_offset + 24 * len(levels)
+    alignment = math.lcm(texture_format.block_bytes, 4)
+
+    # Levels are stored smallest first, so a loader can stream in the small ones first
+    offset = descriptor_offset + len(descriptor)
+    level_offsets = [0] * len(levels)
+    for level in reversed(range(len(levels))):
+        offset += -offset % alignment
+        level_offsets[level] = offset
+        offset += len(levels[level])
+
+    header = KTX2_IDENTIFIER + struct.pack(
+        "<9I4I2Q",
+        texture_format.vk_format,
+        1,  # type size
+        width,
+        height,
+        0,  # depth
+        0,  # layers
+        1,  # faces
+        len(levels),
+        0,  # no supercompression
+        descriptor_offset,
+        len(descriptor),
+        0,  # no key/value data
+        0,
+        0,  # no supercompression global data
+        0,
+    )
+    level_index = b"".join(
+        struct.pack("<3Q", level_offsets[level], len(data), len(data))
+        for level, data in enumerate(levels)
+    )
+
+    directory = os.path.dirname(file_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(file_name, "wb") as file:
+        file.write(header + level_index + descriptor)
+        for level in reversed(range(len(levels))):
+            file.write(b"\0" * (level_offsets[level] - file.tell()))
+            file.write(levels[level])
+
+
+def read_ktx2(file_name: str) -> KTX2Texture:
+    """Read a KTX2 file written by `write_ktx2`."""
+    with open(file_name, "rb") as file:
+        data = memoryview(file.read())
+
+    if bytes(data[:12]) != KTX2_IDENTIFIER:
+        raise ValueError(f"(E) {file_name} is not a KTX2 file")
+
+    vk_format, _, width, height, _, _, faces, level_count, supercompression = (
+        struct.unpack_from("<9I", data, 12)
+    )
+    if faces != 1 or supercompression != 0:
+        raise ValueError(f"(E) {file_name} is a cube map or supercompressed")
+
+    texture_format = next(
+        (format for format in FORMATS.values() if format.vk_format == vk_format), None
+    )
+    if texture_format is None:
+        raise ValueError(f"(E) {file_name} has an unsupported format {vk_format}")
+
+    levels = []
+    for level in range(max(level_count, 1)):
+        offset, length, _ = struct.unpack_from("<3Q", data, 80 + 24 * level)
+        levels.append(data[offset : offset + length])
+
+    return KTX2Texture(texture_format, width, height, levels)
+
+
+#
+# Processing and uploading
+#
+
+
+def processed_file_name(name: str, format_name: str, mip_filter: str) -> str:
+    return os.path.join(CACHE_DIRECTORY, f"{name}.{mip_filter}.{format_name}.ktx2")
+
+
+def is_processed(name: str, format_name: str, mip_filter: str) -> bool:
+    """Whether an image has been processed since it last changed."""
+    target = processed_file_name(name, format_name, mip_filter)
+    return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(
+        f"./textures/{name}"
+    )
+
+
+def process_texture(name: str, format_name="rgba8", mip_filter="kaiser") -> str:
+    """Process an image into a mipmapped KTX2 texture, unless it's already been done.
+
+    Args:
+        name (str): Image in the textures folder
+        format_name (str, optional): One of `FORMATS`. Defaults to "rgba8".
+        mip_filter (str, optional): "box" or "kaiser". Defaults to "kaiser".
+
+    Returns:
+        str: The KTX2 file
+    """
+    if format_name not in FORMATS:
+        raise ValueError(f"(E) Unknown texture format {format_name}")
+
+    target = processed_file_name(name, format_name, mip_filter)
+    if is_processed(name, format_name, mip_filter):
+        return target
+
+    print(f"Processing texture {name} to {format_name}")
+    texture_format = FORMATS[format_name]
+    image = load_image(name)
+    levels = [
+        encode_level(level, texture_format)
+        for level in generate_mipmaps(image, mip_filter)
+    ]
+    write_ktx2(target, texture_format, levels, image.shape[1], image.shape[0])
+    return target
+
+
+def format_supported(texture_format: TextureFormat) -> bool:
+    """Whether the current OpenGL context can sample a texture format."""
+    if not texture_format.compressed:
+        return True
+
+    version = (
+        gl.glGetIntegerv(gl.GL_MAJOR_VERSION),
+        gl.glGetIntegerv(gl.GL_MINOR_VERSION),
+    )
+    if texture_format.name == "bc7":
+        return version >= (4, 2) or has_extension("GL_ARB_texture_compression_bptc")
+    if texture_format.name == "etc2":
+        return version >= (4, 3) or has_extension("GL_ARB_ES3_compatibility")
+    return has_extension("GL_EXT_texture_compression_s3tc")
+
+
+def has_extension(extension: str) -> bool:
+    count = gl.glGetIntegerv(gl.GL_NUM_EXTENSIONS)
+    return any(
+        gl.glGetStringi(gl.GL_EXTENSIONS, i).decode() == extension for i in range(count)
+    )
+
+
+def upload_ktx2(ktx2: KTX2Texture, target=gl.GL_TEXTURE_2D):
+    """Upload every mip level of a KTX2 texture to the bound texture."""
+    texture_format = ktx2.texture_format
+    for level, data in enumerate(ktx2.levels):
+        width = max(ktx2.width >> level, 1)
+        height = max(ktx2.height >> level, 1)
+        pixels = np.frombuffer(data, dtype=np.uint8)
+        if texture_format.compressed:
+            gl.glCompressedTexImage2D(
+                target,
+                level,
+                texture_format.gl_internal_format,
+                width,
+                height,
+                0,
+                pixels,
+            )
+        else:
+            gl.glTexImage2D(
+                target,
+                level,
+                texture_format.gl_internal_format,
+                width,
+                height,
+                0,
+                gl.GL_RGBA,
+                gl.GL_UNSIGNED_BYTE,
+                pixels,
+            )
+
+    gl.glTexParameteri(target, gl.GL_TEXTURE_BASE_LEVEL, 0)
+    gl.glTexParameteri(target, gl.GL_TEXTURE_MAX_LEVEL, len(ktx2.levels) - 1)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Process images in the textures folder into mipmapped KTX2 textures"
+    )
+    parser.add_argument("names", nargs="+", help="images in the textures folder")
+    parser.add_argument("--format", default="rgba8", choices=FORMATS)
+    parser.add_argument("--mip-filter", default="kaiser", choices=MIP_FILTERS)
+    args = parser.parse_args()
+
+    prefetch_images(args.names)
+    for name in args.names:
+        process_texture(name, args.format, args.mip_filter)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
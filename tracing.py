@@ -0,0 +1,211 @@
+"""Low overhead scoped CPU tracing, exported in the Chrome trace event format.
+
+Wrap code in `with trace("name"):` or decorate functions with `@traced`. Scopes are recorded
+into a fixed size ring buffer, so tracing can be left running and only keeps the most recent
+events. Save the buffer with `Tracer.current_tracer.export_chrome_trace("trace.json")` and
+open it in https://ui.perfetto.dev or chrome://tracing.
+
+When tracing is off, a scope costs one attribute lookup.
+"""
+
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, Self
+
+import imgui
+import numpy as np
+
+
+class TraceScope:
+    """Records the time spent inside a `with` block when it exits."""
+
+    __slots__ = ("name_id", "start", "tracer")
+
+    def __init__(self, tracer: "Tracer", name_id: int):
+        self.tracer = tracer
+        self.name_id = name_id
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exception):
+        self.tracer.record(self.name_id, self.start, time.perf_counter_ns())
+
+
+class NullScope:
+    """A scope that does nothing, used while tracing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+
+NULL_SCOPE = NullScope()
+
+
+class Tracer:
+    """A ring buffer of timed scopes."""
+
+    current_tracer: Self = None  # type: ignore
+
+    def __init__(self, capacity=1 << 18, enabled=False):
+        """
+        Args:
+            capacity (int, optional): Number of events kept, older events are overwritten.
+                Defaults to 262144, a few thousand frames.
+            enabled (bool, optional): Start recording straight away. Defaults to False.
+        """
+        self.capacity = capacity
+        self.enabled = enabled
+
+        # Preallocated so that recording never allocates
+        self.name_ids = np.zeros(capacity, dtype=np.int32)
+        self.starts = np.zeros(capacity, dtype=np.int64)
+        self.ends = np.zeros(capacity, dtype=np.int64)
+        self.thread_ids = np.zeros(capacity, dtype=np.int64)
+
+        # next() on a count is atomic, so several threads can record at once. The count of
+        # events recorded only ever grows, under a lock, so a thread that took a lower index
+        # but stores last can't hide the newest events
+        self.counter = itertools.count()
+        self.event_count = 0
+        self.count_lock = threading.Lock()
+
+        self.names: list[str] = []
+        self.name_lookup: dict[str, int] = {}
+        self.names_lock = threading.Lock()
+        self.thread_names: dict[int, str] = {}
+
+    def name_id(self, name: str) -> int:
+        name_id = self.name_lookup.get(name)
+        if name_id is None:
+            with self.names_lock:
+                name_id = self.name_lookup.setdefault(name, len(self.names))
+                if name_id == len(self.names):
+                    self.names.append(name)
+        return name_id
+
+    def scope(self, name: str) -> TraceScope | NullScope:
+        if not self.enabled:
+            return NULL_SCOPE
+        return TraceScope(self, self.name_id(name))
+
+    def record(self, name_id: int, start: int, end: int):
+        """Record a scope that ran from `start` to `end`, in `time.perf_counter_ns` nanoseconds."""
+        index = next(self.counter)
+        with self.count_lock:
+            self.event_count = max(self.event_count, index + 1)
+        slot = index % self.capacity
+
+        thread_id = threading.get_ident()
+        if thread_id not in self.thread_names:
+            self.thread_names[thread_id] = threading.current_thread().name
+
+        self.name_ids[slot] = name_id
+        self.starts[slot] = start
+        self.ends[slot] = end
+        self.thread_ids[slot] = thread_id
+
+    def clear(self):
+        with self.count_lock:
+            self.counter = itertools.count()
+            self.event_count = 0
+
+    def events(self, first_event=0) -> list[tuple[str, int, int, int]]:
+        """The recorded events still in the buffer, oldest first.
+
+        Args:
+            first_event (int, optional): Skip events recorded before this one. Defaults to 0.
+
+        Returns:
+            list[tuple[str, int, int, int]]: (name, start, end, thread id), times in nanoseconds
+        """
+        first_event = max(first_event, self.event_count - self.capacity)
+        slots = np.arange(first_event, self.event_count) % self.capacity
+        return [
+            (self.names[name_id], start, end, thread_id)
+            for name_id, start, end, thread_id in zip(
+                self.name_ids[slots].tolist(),
+                self.starts[slots].tolist(),
+                self.ends[slots].tolist(),
+                self.thread_ids[slots].tolist(),
+            )
+        ]
+
+    def chrome_trace(self, first_event=0) -> dict[str, Any]:
+        """The recorded events as a Chrome trace event format object."""
+        process_id = os.getpid()
+        trace_events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": process_id,
+                "tid": thread_id,
+                "args": {"name": thread_name},
+            }
+            for thread_id, thread_name in self.thread_names.items()
+        ]
+        trace_events += [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (end - start) / 1000,
+                "pid": process_id,
+                "tid": thread_id,
+            }
+            for name, start, end, thread_id in self.events(first_event)
+        ]
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, file_name: str, first_event=0):
+        """Save the recorded events as Chrome trace event JSON, for Perfetto or chrome://tracing."""
+        with open(file_name, "w", encoding="utf-8") as file:
+            json.dump(self.chrome_trace(first_event), file)
+        print(f"Saved trace to {file_name}")
+
+    def debug_menu(self):
+        """Define the debug menu for this class. Uses the ImGui library to construct a UI. Calling this function inside an ImGui context will render this debug menu."""
+        _, self.enabled = imgui.checkbox("Trace", self.enabled)
+        imgui.text(
+            f"{min(self.event_count, self.capacity)}/{self.capacity} events buffered"
+        )
+        if imgui.button("Save trace"):
+            self.export_chrome_trace(time.strftime("trace_%Y%m%d_%H%M%S.json"))
+        imgui.same_line()
+        if imgui.button("Clear"):
+            self.clear()
+
+
+Tracer.current_tracer = Tracer()
+
+
+def trace(name: str) -> TraceScope | NullScope:
+    """Trace the code inside a `with` block."""
+    return Tracer.current_tracer.scope(name)
+
+
+def traced(function: Callable) -> Callable:
+    """Decorator that traces every call of a function, named by its qualified name."""
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        tracer = Tracer.current_tracer
+        if not tracer.enabled:
+            return function(*args, **kwargs)
+        with TraceScope(tracer, tracer.name_id(name)):
+            return function(*args, **kwargs)
+
+    return wrapper